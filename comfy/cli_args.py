@@ -90,6 +90,8 @@ class LatentPreviewMethod(enum.Enum):
     TAESD = "taesd"
 
 parser.add_argument("--preview-method", type=LatentPreviewMethod, default=LatentPreviewMethod.NoPreviews, help="Default preview method for sampler nodes.", action=EnumAction)
+parser.add_argument("--async-previews", action="store_true", help="Decode and encode the sampler previews on a background thread so they don't slow down the steps. Previews that can't keep up are dropped.")
+parser.add_argument("--preview-max-fps", type=float, default=10.0, help="Maximum number of previews per second with --async-previews. 0 means no limit.")
 
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
@@ -107,6 +109,38 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 
+parser.add_argument("--cache-lru", type=int, default=0, metavar="N", help="Keep up to N node results in a content addressed cache so identical parts of different prompts can be reused. May use more RAM/VRAM. 0 disables it.")
+parser.add_argument("--cache-lru-max-ram", type=float, default=0, metavar="GB", help="Limit the RAM used by the --cache-lru node results. 0 means no limit.")
+parser.add_argument("--cache-lru-max-vram", type=float, default=0, metavar="GB", help="Limit the VRAM used by the --cache-lru node results. 0 means no limit.")
+
+parser.add_argument("--parallel-cpu-nodes", type=int, default=0, metavar="N", help="Run the nodes marked as CPU_THREAD_SAFE on N worker threads so independent branches of a prompt can overlap with the nodes using the GPU. 0 disables it.")
+
+parser.add_argument("--async-image-save", type=int, default=0, metavar="WORKERS", help="Encode and write the images of SaveImage/PreviewImage on this many background threads so the next node or prompt can start while they are being compressed. 0 saves them synchronously.")
+parser.add_argument("--async-image-save-max-memory", type=float, default=2048, metavar="MB", help="Maximum size of the images waiting to be written by --async-image-save before the save nodes block.")
+
+parser.add_argument("--prefetch-models", type=int, default=0, metavar="N", help="Load the models of the next N queued prompts into the model cache (--model-cache-ram) in the background while the current one runs.")
+parser.add_argument("--patched-weight-cache-ram", type=float, default=0, metavar="GB", help="Keep the weights with the LoRAs applied in RAM up to this size so loading a model again with the same LoRAs is a copy instead of recomputing them. 0 disables it.")
+parser.add_argument("--model-detection-cache", type=str, default=None, metavar="PATH", help="Cache the detected model types of the checkpoints in this json file so loading them again, also after a restart, skips the detection. Disabled by default.")
+parser.add_argument("--model-cache-ram", type=float, default=0, metavar="GB", help="Keep the models the loader nodes loaded in RAM up to this size so loading them again doesn't read them from disk. The least recently used ones are dropped first. 0 disables it.")
+
+parser.add_argument("--text-encoder-cache", type=int, default=0, metavar="N", help="Keep the last N text encoder results in memory so prompts that were already encoded don't need the text encoder. 0 disables it.")
+parser.add_argument("--text-encoder-cache-dir", type=str, default=None, metavar="PATH", help="Also store the text encoder results as safetensors files in this directory so they are reused after a restart.")
+parser.add_argument("--text-encoder-cache-disk-size", type=float, default=4, metavar="GB", help="Maximum size of --text-encoder-cache-dir, the least recently used files are deleted first. 0 means no limit.")
+
+parser.add_argument("--coalesce-prompts", type=int, default=0, metavar="N", help="Execute up to N queued prompts that are the same workflow with different seeds and prompt texts together, sampling them in a single batch. 0 disables it.")
+
+parser.add_argument("--profile-nodes", action="store_true", help="Synchronize the device around every node to record its CUDA time and peak memory in the prompt profile (/prompt/{prompt_id}/profile). Slows down execution.")
+
+parser.add_argument("--pinned-memory", type=float, default=0, metavar="GB", help="Keep the weights of the models offloaded from the GPU in up to this much pinned RAM so loading them back is faster. 0 disables it.")
+parser.add_argument("--benchmark-model-transfers", action="store_true", help="Log the time and GB/s of every model load to and unload from the device.")
+parser.add_argument("--lowvram-prefetch", type=int, default=0, metavar="N", help="In lowvram mode on CUDA, copy the weights of the next N offloaded modules on a side stream through pinned buffers while the current one computes. 0 disables it. The achieved overlap of each pass is logged with --verbose.")
+
+parser.add_argument("--force-cfg-batch", action="store_true", help="Always run the positive and negative conds of different prompt lengths in the same batch when they fit in memory, by padding them to a common length.")
+
+parser.add_argument("--eviction-policy", type=str, default="refcount", choices=["refcount", "gdsf", "lru-k", "lru"], help="How to pick the models to unload when memory is needed. refcount (the default) unloads the models no node output references first, gdsf (GreedyDual-Size-Frequency) keeps the models that are used often and slow to reload relative to their size, lru-k and lru look at the last uses.")
+
+parser.add_argument("--vae-memory-model", type=str, default=None, metavar="PATH", help="Measure the peak memory of the first VAE decodes and encodes of each model and resolution and size the later batches from these measurements instead of the built in estimates. They are stored in this json file so they are kept after a restart. Only measured on CUDA devices and not while --profile-nodes is used, the existing measurements are still used.")
+
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
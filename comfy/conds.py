@@ -1,6 +1,11 @@
 import torch
 import math
 import comfy.utils
+from comfy.cli_args import args
+
+#limit on the padding of the cross attention conds of different lengths that get batched together, it probably
+#impacts performance negatively if it's too much but --force-cfg-batch lifts it so cond and uncond share a pass
+MAX_CROSSATTN_PADDING = float("inf") if args.force_cfg_batch else 4
 
 
 def lcm(a, b): #TODO: eventually replace by math.lcm (added in python3.9)
@@ -43,7 +48,7 @@ class CONDCrossAttn(CONDRegular):
 
             mult_min = lcm(s1[1], s2[1])
             diff = mult_min // min(s1[1], s2[1])
-            if diff > 4: #arbitrary limit on the padding because it's probably going to impact performance negatively if it's too much
+            if diff > MAX_CROSSATTN_PADDING:
                 return False
         return True
 
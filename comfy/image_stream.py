@@ -0,0 +1,63 @@
+import queue
+import threading
+
+import torch
+
+class ImageStream:
+    #IMAGE_STREAM: a batch of images that is produced chunk by chunk instead of being held in memory all at once.
+    #Iterating it calls chunks_function on the iterating thread (where it can load models) and consumes the iterator
+    #it returns on a background thread that stays at most `ahead` chunks in front of the consumer, so a save node
+    #can encode the frames of one chunk while the next one is decoded. Each iteration produces the chunks again.
+    #chunks_function: returns an iterator of [B, H, W, C] tensors, shape: the [N, H, W, C] shape of all of them
+    def __init__(self, chunks_function, shape, ahead=1):
+        self.chunks_function = chunks_function
+        self.shape = tuple(shape)
+        self.ahead = ahead
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunks(self):
+        q = queue.Queue(maxsize=max(1, self.ahead))
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        chunks = self.chunks_function()
+
+        def produce():
+            try:
+                with torch.inference_mode(): #inference mode is thread local
+                    for chunk in chunks:
+                        if not put(chunk):
+                            return
+            except Exception as e:
+                put(e)
+                return
+            put(end)
+
+        thread = threading.Thread(target=produce, daemon=True, name="image_stream")
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
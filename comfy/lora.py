@@ -11,10 +11,31 @@ LORA_CLIP_MAP = {
 }
 
 
+#key maps by architecture, see cached_key_map
+KEY_MAPS = {}
+
+def lora_key_prefixes(lora):
+    #every name a key of the file can be loaded under: all the names for the key map are "{x}." or "{x}_lora."
+    #followed by a suffix so only the key map entries in this set have to be probed
+    prefixes = set()
+    for k in lora.keys():
+        i = k.find(".")
+        while i >= 0:
+            prefixes.add(k[:i])
+            i = k.find(".", i + 1)
+        i = k.find("_lora.")
+        if i >= 0:
+            prefixes.add(k[:i])
+    return prefixes
+
 def load_lora(lora, to_load):
     patch_dict = {}
     loaded_keys = set()
+    prefixes = lora_key_prefixes(lora)
     for x in to_load:
+        if x not in prefixes:
+            continue
+
         alpha_name = "{}.alpha".format(x)
         alpha = None
         if alpha_name in lora.keys():
@@ -166,9 +187,29 @@ def load_lora(lora, to_load):
             logging.warning("lora key not loaded: {}".format(x))
     return patch_dict
 
+def cached_key_map(name, model, build_function, *extra):
+    #the key maps only depend on the names of the weights of the model so they are built once per architecture
+    sdk = getattr(model, "lora_state_dict_keys", None)
+    if sdk is None:
+        sdk = tuple(model.state_dict().keys())
+        model.lora_state_dict_keys = sdk
+    arch = (name, sdk) + extra
+    key_map = KEY_MAPS.get(arch, None)
+    if key_map is None:
+        key_map = build_function(model, dict.fromkeys(sdk).keys())
+        KEY_MAPS[arch] = key_map
+    return key_map
+
 def model_lora_keys_clip(model, key_map={}):
-    sdk = model.state_dict().keys()
+    key_map.update(cached_key_map("clip", model, clip_key_map))
+    return key_map
 
+def model_lora_keys_unet(model, key_map={}):
+    key_map.update(cached_key_map("unet", model, unet_key_map, repr(model.model_config.unet_config)))
+    return key_map
+
+def clip_key_map(model, sdk):
+    key_map = {}
     text_model_lora_key = "lora_te_text_model_encoder_layers_{}_{}"
     clip_l_present = False
     for b in range(32): #TODO: clean up
@@ -216,9 +257,8 @@ def model_lora_keys_clip(model, key_map={}):
 
     return key_map
 
-def model_lora_keys_unet(model, key_map={}):
-    sdk = model.state_dict().keys()
-
+def unet_key_map(model, sdk):
+    key_map = {}
     for k in sdk:
         if k.startswith("diffusion_model.") and k.endswith(".weight"):
             key_lora = k[len("diffusion_model."):-len(".weight")].replace(".", "_")
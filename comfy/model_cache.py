@@ -0,0 +1,174 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+from comfy.cli_args import args
+import comfy.model_management
+
+def ram_size(obj):
+    #estimate of the memory held by what a loader returned: tensors, ModelPatchers, CLIP/VAE through their patcher,
+    #modules and the attributes of the other comfy objects (controlnets...)
+    size = 0
+    seen = set()
+    to_check = [obj]
+    while len(to_check) > 0:
+        o = to_check.pop()
+        if o is None or id(o) in seen:
+            continue
+        seen.add(id(o))
+
+        if isinstance(o, torch.Tensor):
+            size += o.nelement() * o.element_size()
+        elif isinstance(o, (list, tuple)):
+            to_check.extend(o)
+        elif isinstance(o, dict):
+            to_check.extend(o.values())
+        elif isinstance(o, torch.nn.Module):
+            size += comfy.model_management.module_size(o)
+        elif hasattr(o, "model_size") and hasattr(o, "model"): #ModelPatcher
+            if id(o.model) not in seen:
+                seen.add(id(o.model))
+                size += o.model_size()
+        elif type(o).__module__.startswith("comfy"):
+            to_check.extend(vars(o).values())
+    return size
+
+class ModelCache:
+    #Process wide cache of what the loader nodes loaded, keyed by the files (path, size, mtime) and the load options
+    #so loading a model again after its node output was dropped is a RAM to VRAM copy instead of a disk read and
+    #model detection. The least recently used models are dropped when the total goes over max_ram.
+    def __init__(self, max_ram=0):
+        self.max_ram = max_ram
+        self.entries = OrderedDict()
+        self.ram_used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        #keys being loaded, other threads loading the same model wait for it instead of loading it a second time
+        self.loading = {}
+        #models loaded by prefetch() that weren't used yet
+        self.prefetched = set()
+        self.prefetches = 0
+        self.prefetch_hits = 0
+        self.prefetch_wasted = 0
+        self.local = threading.local()
+
+    def enabled(self):
+        return self.max_ram > 0
+
+    def key(self, paths, options):
+        files = []
+        for p in paths:
+            st = os.stat(p)
+            files.append((os.path.abspath(p), st.st_size, st.st_mtime_ns))
+        return (tuple(files), options)
+
+    def load(self, paths, options, load_function):
+        #paths: the files load_function reads, options: anything else that changes its result (must be hashable)
+        if not self.enabled():
+            return load_function()
+
+        key = self.key(paths, options)
+        prefetch = self.prefetching()
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    if not prefetch:
+                        self.hits += 1
+                        if key in self.prefetched:
+                            self.prefetched.discard(key)
+                            self.prefetch_hits += 1
+                    return self.entries[key][0]
+                loading = self.loading.get(key, None)
+                if loading is None:
+                    loading = threading.Event()
+                    self.loading[key] = loading
+                    if prefetch:
+                        self.prefetches += 1
+                    else:
+                        self.misses += 1
+                    break
+            loading.wait()
+
+        try:
+            value = load_function()
+            size = ram_size(value)
+            with self.lock:
+                if size > self.max_ram:
+                    logging.debug("{} is too large for the model cache: {:.1f} MB".format(paths, size / (1024 * 1024)))
+                    return value
+                self.entries[key] = (value, size)
+                self.ram_used += size
+                if prefetch:
+                    self.prefetched.add(key)
+                while self.ram_used > self.max_ram:
+                    old_key, (_, old_size) = self.entries.popitem(last=False)
+                    self.ram_used -= old_size
+                    if old_key in self.prefetched:
+                        self.prefetched.discard(old_key)
+                        self.prefetch_wasted += 1
+                    logging.debug("model cache: dropped {}".format(old_key[0]))
+            return value
+        finally:
+            with self.lock:
+                self.loading.pop(key)
+            loading.set()
+
+    def references(self, obj):
+        #how many references to obj the cached values hold, the same walk as ram_size without going into the models
+        count = 0
+        seen = set()
+        with self.lock:
+            to_check = list(self.entries.values())
+        while len(to_check) > 0:
+            o = to_check.pop()
+            if id(o) in seen:
+                continue
+            seen.add(id(o))
+
+            if isinstance(o, (list, tuple)):
+                children = o
+            elif isinstance(o, dict):
+                children = o.values()
+            elif isinstance(o, (torch.Tensor, torch.nn.Module)) or (hasattr(o, "model_size") and hasattr(o, "model")):
+                continue
+            elif type(o).__module__.startswith("comfy"):
+                children = vars(o).values()
+            else:
+                continue
+            for c in children:
+                if c is obj:
+                    count += 1
+                else:
+                    to_check.append(c)
+        return count
+
+    def prefetching(self):
+        #True on the prefetch thread while it runs a loader
+        return getattr(self.local, "prefetch", False)
+
+    def prefetch(self, function):
+        #runs function (that loads models through load()) counting what it loads as prefetched
+        self.local.prefetch = True
+        try:
+            return function()
+        finally:
+            self.local.prefetch = False
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "ram_used": self.ram_used,
+                    "prefetches": self.prefetches, "prefetch_hits": self.prefetch_hits, "prefetch_wasted": self.prefetch_wasted}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.ram_used = 0
+            self.prefetch_wasted += len(self.prefetched)
+            self.prefetched.clear()
+
+cache = ModelCache(int(args.model_cache_ram * (1024 ** 3)))
@@ -1,5 +1,11 @@
 import comfy.supported_models
 import comfy.supported_models_base
+import comfy.utils
+from comfy.cli_args import args
+import os
+import json
+import hashlib
+import threading
 import logging
 
 def count_blocks(state_dict_keys, prefix_string):
@@ -190,14 +196,86 @@ def model_config_from_unet_config(unet_config, state_dict=None):
     logging.error("no match {}".format(unet_config))
     return None
 
-def model_config_from_unet(state_dict, unet_key_prefix, use_base_if_no_match=False):
+def model_config_from_unet(state_dict, unet_key_prefix, use_base_if_no_match=False, cache_key=None):
+    #cache_key: detection_cache_key() of the file the state dict was loaded from to reuse a previous detection
+    if cache_key is not None and detection_index is not None:
+        cached = detection_index.get(cache_key)
+        if cached is not None:
+            return cached
+
     unet_config = detect_unet_config(state_dict, unet_key_prefix)
     model_config = model_config_from_unet_config(unet_config, state_dict)
+    if model_config is not None and cache_key is not None and detection_index is not None:
+        detection_index.set(cache_key, unet_config, model_config)
     if model_config is None and use_base_if_no_match:
         return comfy.supported_models_base.BASE(unet_config)
     else:
         return model_config
 
+def detection_cache_key(path, unet_key_prefix):
+    #detection only looks at the keys and shapes so for safetensors files the header is enough to identify the result
+    m = hashlib.sha256()
+    header = None
+    if path.lower().endswith(".safetensors"):
+        header = comfy.utils.safetensors_header(path)
+    if header is not None:
+        m.update(header)
+    else:
+        st = os.stat(path)
+        m.update(repr((os.path.abspath(path), st.st_size, st.st_mtime_ns)).encode("utf-8"))
+    m.update(unet_key_prefix.encode("utf-8"))
+    return m.hexdigest()
+
+class DetectionIndex:
+    #Results of model_config_from_unet by detection_cache_key, stored as json in path (--model-detection-cache)
+    #so they are also reused after a restart. The key prefix of the unet is part of the key, not of the result.
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                logging.warning("could not read the model detection cache {}: {}".format(self.path, e))
+
+    def get(self, key):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+        for model_config in comfy.supported_models.models:
+            if model_config.__name__ == entry["model_config"]:
+                return model_config(entry["unet_config"])
+        return None
+
+    def set(self, key, unet_config, model_config):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            try:
+                entry = json.loads(json.dumps({"unet_config": unet_config, "model_config": type(model_config).__name__}))
+            except (TypeError, ValueError):
+                return
+            self.entries[key] = entry
+            try:
+                temp_path = "{}.tmp".format(self.path)
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.entries, f)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                logging.warning("could not write the model detection cache {}: {}".format(self.path, e))
+
+detection_index = None
+if args.model_detection_cache is not None:
+    detection_index = DetectionIndex(args.model_detection_cache)
+
 def convert_config(unet_config):
     new_config = unet_config.copy()
     num_res_blocks = new_config.get("num_res_blocks", None)
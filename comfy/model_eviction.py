@@ -0,0 +1,98 @@
+import sys
+import time
+import collections
+from abc import ABC, abstractmethod
+
+import comfy.model_cache
+
+#Policies deciding which loaded models free_memory unloads first. Each model's weights (ModelPatcher.model, shared
+#by the clones) carry a ModelUsage with the times it was used and how long loading it took.
+
+class ModelUsage:
+    def __init__(self, history=2):
+        self.uses = collections.deque(maxlen=history)
+        self.use_count = 0
+        self.load_time = None
+        self.priority = 0.0
+
+def model_usage(patcher):
+    usage = getattr(patcher.model, "usage_stats", None)
+    if usage is None:
+        usage = ModelUsage()
+        patcher.model.usage_stats = usage
+    return usage
+
+class EvictionPolicy(ABC):
+    #score(): the models with the lowest scores are unloaded first
+    name = None
+
+    def used(self, patcher):
+        usage = model_usage(patcher)
+        usage.uses.append(time.monotonic())
+        usage.use_count += 1
+
+    def loaded(self, patcher, load_time):
+        #load_time: seconds it took to move the model to its device and patch it
+        usage = model_usage(patcher)
+        if usage.load_time is None:
+            usage.load_time = load_time
+        else:
+            usage.load_time = 0.5 * (usage.load_time + load_time)
+
+    @abstractmethod
+    def score(self, loaded_model):
+        pass
+
+    def evicted(self, loaded_model, score):
+        pass
+
+class RefcountPolicy(EvictionPolicy):
+    #the old behavior: the models with the least references (the ones no node output holds anymore) then the smallest.
+    #The references of the model cache don't count, a cached model nothing else uses can go first.
+    name = "refcount"
+
+    def score(self, loaded_model):
+        references = sys.getrefcount(loaded_model.model) - comfy.model_cache.cache.references(loaded_model.model)
+        return (references, loaded_model.model_memory())
+
+class LRUPolicy(EvictionPolicy):
+    name = "lru"
+
+    def score(self, loaded_model):
+        uses = model_usage(loaded_model.model).uses
+        return uses[-1] if len(uses) > 0 else 0.0
+
+class LRUKPolicy(EvictionPolicy):
+    #LRU-2: evicts the model whose second to last use is the oldest, models used only once go first
+    name = "lru-k"
+
+    def score(self, loaded_model):
+        uses = model_usage(loaded_model.model).uses
+        if len(uses) < uses.maxlen:
+            return (float("-inf"), uses[-1] if len(uses) > 0 else 0.0)
+        return (uses[0], uses[-1])
+
+class GreedyDualSizeFrequencyPolicy(EvictionPolicy):
+    #GreedyDual-Size-Frequency: priority = L + uses * reload cost / size, refreshed on each use. L is raised to the
+    #priority of each evicted model so models that stop being used age out.
+    name = "gdsf"
+
+    def __init__(self):
+        self.inflation = 0.0
+
+    def used(self, patcher):
+        super().used(patcher)
+        usage = model_usage(patcher)
+        size = max(patcher.model_size(), 1) / (1024 * 1024 * 1024)
+        cost = usage.load_time
+        if cost is None:
+            cost = size #unknown until it's loaded once: about 1GB/s
+        usage.priority = self.inflation + usage.use_count * cost / size
+
+    def score(self, loaded_model):
+        return model_usage(loaded_model.model).priority
+
+    def evicted(self, loaded_model, score):
+        self.inflation = max(self.inflation, score)
+
+POLICIES = {p.name: p for p in [RefcountPolicy, LRUPolicy, LRUKPolicy, GreedyDualSizeFrequencyPolicy]}
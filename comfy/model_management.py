@@ -3,8 +3,11 @@ import logging
 from enum import Enum
 from comfy.cli_args import args
 import comfy.utils
+import comfy.model_eviction
+import comfy.pinned_memory
 import torch
 import sys
+import time
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -261,6 +264,9 @@ logging.info("VAE dtype: {}".format(VAE_DTYPE))
 
 current_loaded_models = []
 
+eviction_policy = comfy.model_eviction.POLICIES[args.eviction_policy]()
+logging.info("Model eviction policy: {}".format(eviction_policy.name))
+
 def module_size(module):
     module_mem = 0
     sd = module.state_dict()
@@ -287,6 +293,7 @@ class LoadedModel:
 
     def model_load(self, lowvram_model_memory=0):
         patch_model_to = self.device
+        start = time.perf_counter()
 
         self.model.model_patches_to(self.device)
         self.model.model_patches_to(self.model.model_dtype())
@@ -307,13 +314,26 @@ class LoadedModel:
             self.real_model = torch.xpu.optimize(self.real_model.eval(), inplace=True, auto_kernel_selection=True, graph_mode=True)
 
         self.weights_loaded = True
+        if args.benchmark_model_transfers and load_weights:
+            self.log_transfer("Loaded", self.device, start)
         return self.real_model
 
     def model_unload(self, unpatch_weights=True):
+        start = time.perf_counter()
+        device = self.model.current_device
         self.model.unpatch_model(self.model.offload_device, unpatch_weights=unpatch_weights)
         self.model.model_patches_to(self.model.offload_device)
         self.weights_loaded = self.weights_loaded and not unpatch_weights
         self.real_model = None
+        if args.benchmark_model_transfers and unpatch_weights:
+            self.log_transfer("Unloaded", device, start)
+
+    def log_transfer(self, action, device, start):
+        if is_device_cuda(device):
+            torch.cuda.synchronize(device)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        size = self.model_memory()
+        logging.info("{} {} ({:.0f} MB) in {:.3f}s: {:.2f} GB/s{}".format(action, self.model.model.__class__.__name__, size / (1024 * 1024), elapsed, size / elapsed / (1024 ** 3), ", pinned" if comfy.pinned_memory.pool.is_pinned(self.model.model) else ""))
 
     def __eq__(self, other):
         return self.model is other.model
@@ -358,14 +378,16 @@ def free_memory(memory_required, device, keep_loaded=[]):
         shift_model = current_loaded_models[i]
         if shift_model.device == device:
             if shift_model not in keep_loaded:
-                can_unload.append((sys.getrefcount(shift_model.model), shift_model.model_memory(), i))
+                can_unload.append((eviction_policy.score(shift_model), i))
 
-    for x in sorted(can_unload):
-        i = x[-1]
+    for score, i in sorted(can_unload):
         if not DISABLE_SMART_MEMORY:
             if get_free_memory(device) > memory_required:
                 break
-        current_loaded_models[i].model_unload()
+        shift_model = current_loaded_models[i]
+        shift_model.model_unload()
+        eviction_policy.evicted(shift_model, score)
+        logging.debug("Unloaded {} ({:.0f} MB) to free memory, {} score: {}".format(shift_model.model.model.__class__.__name__, shift_model.model_memory() / (1024 * 1024), eviction_policy.name, score))
         unloaded_model.append(i)
 
     for i in sorted(unloaded_model, reverse=True):
@@ -396,6 +418,7 @@ def load_models_gpu(models, memory_required=0):
             index = current_loaded_models.index(loaded_model)
             current_loaded_models.insert(0, current_loaded_models.pop(index))
             models_already_loaded.append(loaded_model)
+            eviction_policy.used(x)
         else:
             if hasattr(x, "model"):
                 logging.info(f"Requested to load {x.model.__class__.__name__}")
@@ -444,7 +467,10 @@ def load_models_gpu(models, memory_required=0):
         if vram_set_state == VRAMState.NO_VRAM:
             lowvram_model_memory = 64 * 1024 * 1024
 
+        load_start = time.perf_counter()
         cur_loaded_model = loaded_model.model_load(lowvram_model_memory)
+        eviction_policy.loaded(model, time.perf_counter() - load_start)
+        eviction_policy.used(model)
         current_loaded_models.insert(0, loaded_model)
     return
 
@@ -6,6 +6,10 @@ import uuid
 
 import comfy.utils
 import comfy.model_management
+import comfy.weight_cache
+import comfy.weight_streaming
+import comfy.pinned_memory
+from comfy.cli_args import args
 
 def apply_weight_decompose(dora_scale, weight):
     weight_norm = (
@@ -38,6 +42,7 @@ class ModelPatcher:
 
         self.weight_inplace_update = weight_inplace_update
         self.model_lowvram = False
+        self.weight_streamer = None
         self.patches_uuid = uuid.uuid4()
 
     def model_size(self):
@@ -54,6 +59,7 @@ class ModelPatcher:
         for k in self.patches:
             n.patches[k] = self.patches[k][:]
         n.patches_uuid = self.patches_uuid
+        n.key_patches_hashes = getattr(self, "key_patches_hashes", None)
 
         n.object_patches = self.object_patches.copy()
         n.model_options = copy.deepcopy(self.model_options)
@@ -199,11 +205,13 @@ class ModelPatcher:
     def get_key_patches(self, filter_prefix=None):
         comfy.model_management.unload_model_clones(self)
         model_sd = self.model_state_dict()
+        weights_id = comfy.weight_cache.model_weights_id(self.model)
         p = {}
         for k in model_sd:
             if filter_prefix is not None:
                 if not k.startswith(filter_prefix):
                     continue
+            comfy.weight_cache.set_source(model_sd[k], ("model", weights_id, k))
             if k in self.patches:
                 p[k] = [model_sd[k]] + self.patches[k]
             else:
@@ -225,21 +233,100 @@ class ModelPatcher:
 
         weight = comfy.utils.get_attr(self.model, key)
 
+        cache = comfy.weight_cache.cache
+        cached = None
+        if cache.enabled():
+            cached = cache.get(cache.key(self, key))
+        self.patch_weight(key, weight, device_to, cached)
+
+    def patch_weight(self, key, weight, device_to, cached):
+        #cached: the result of the weight cache lookup for key (None on a miss or when the cache is disabled)
+        cache = comfy.weight_cache.cache
+        if cached is not None:
+            out_weight = comfy.model_management.cast_to_device(cached, weight.device if device_to is None else device_to, weight.dtype, copy=True)
+        else:
+            if device_to is not None:
+                temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+            else:
+                temp_weight = weight.to(torch.float32, copy=True)
+            out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
+            if cache.enabled():
+                cache.set(cache.key(self, key), out_weight.to(self.offload_device, copy=True))
+        self.set_patched_weight(key, weight, out_weight)
+
+    def set_patched_weight(self, key, weight, out_weight):
         inplace_update = self.weight_inplace_update
 
         if key not in self.backup:
             self.backup[key] = weight.to(device=self.offload_device, copy=inplace_update)
 
-        if device_to is not None:
-            temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
-        else:
-            temp_weight = weight.to(torch.float32, copy=True)
-        out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
         if inplace_update:
             comfy.utils.copy_to_param(self.model, key, out_weight)
         else:
             comfy.utils.set_attr_param(self.model, key, out_weight)
 
+    def lora_factors(self, patches):
+        #(up, down, scale) when every patch of a key is a plain lora so they can be applied as a single product:
+        #up is [up_1 up_2 ...], down is [down_1; down_2; ...] and scale the alpha of each rank
+        ups = []
+        downs = []
+        scale = []
+        for strength_patch, v, strength_model in patches:
+            if strength_model != 1.0 or isinstance(v, list) or len(v) != 2 or v[0] != "lora":
+                return None
+            up, down, alpha, mid, dora_scale = v[1]
+            if mid is not None or dora_scale is not None:
+                return None
+            if len(ups) > 0 and (up.dtype != ups[0].dtype or up.device != ups[0].device or down.dtype != downs[0].dtype):
+                return None
+            if alpha is not None:
+                strength_patch *= alpha / down.shape[0]
+            ups.append(up.flatten(start_dim=1))
+            downs.append(down.flatten(start_dim=1))
+            scale += [strength_patch] * down.shape[0]
+        if len(ups) == 0:
+            return None
+        return torch.cat(ups, dim=1), torch.cat(downs, dim=0), scale
+
+    def patch_weights_to_device(self, keys, device_to=None, max_batch_size=256 * 1024 * 1024):
+        #same result as patch_weight_to_device on each key but the keys with only plain loras are grouped by shape
+        #and patched with one baddbmm per group instead of a few small ops per key and lora
+        cache = comfy.weight_cache.cache
+        groups = {}
+        for key in keys:
+            if key not in self.patches:
+                continue
+            weight = comfy.utils.get_attr(self.model, key)
+            cached = None
+            if cache.enabled():
+                cached = cache.get(cache.key(self, key))
+            if cached is not None:
+                self.patch_weight(key, weight, device_to, cached)
+                continue
+
+            factors = self.lora_factors(self.patches[key])
+            if factors is None or weight.ndim < 2 or weight.shape[0] != factors[0].shape[0] or weight[0].numel() != factors[1].shape[1]:
+                self.patch_weight(key, weight, device_to, None) #already a cache miss, don't look it up again
+                continue
+            group = (tuple(weight.shape), weight.dtype, weight.device, factors[0].shape[1], factors[0].dtype, factors[0].device, factors[1].dtype)
+            groups.setdefault(group, []).append((key, weight, factors))
+
+        for group, items in groups.items():
+            device = group[2] if device_to is None else device_to
+            chunk_size = max(1, max_batch_size // (items[0][1].numel() * 4))
+            for i in range(0, len(items), chunk_size):
+                chunk = items[i:i + chunk_size]
+                weights = comfy.model_management.cast_to_device(torch.stack([w.flatten(start_dim=1) for _, w, _ in chunk]), device, torch.float32)
+                ups = comfy.model_management.cast_to_device(torch.stack([f[0] for _, _, f in chunk]), device, torch.float32)
+                downs = comfy.model_management.cast_to_device(torch.stack([f[1] for _, _, f in chunk]), device, torch.float32)
+                ups *= torch.tensor([f[2] for _, _, f in chunk], dtype=torch.float32, device=device).unsqueeze(1)
+                weights.baddbmm_(ups, downs)
+                for (key, weight, _), out_weight in zip(chunk, weights):
+                    out_weight = out_weight.reshape(weight.shape).to(weight.dtype, copy=True)
+                    if cache.enabled():
+                        cache.set(cache.key(self, key), out_weight.to(self.offload_device, copy=True))
+                    self.set_patched_weight(key, weight, out_weight)
+
     def patch_model(self, device_to=None, patch_weights=True):
         for k in self.object_patches:
             old = comfy.utils.set_attr(self.model, k, self.object_patches[k])
@@ -248,15 +335,19 @@ class ModelPatcher:
 
         if patch_weights:
             model_sd = self.model_state_dict()
+            keys = []
             for key in self.patches:
                 if key not in model_sd:
                     logging.warning("could not patch. key doesn't exist in model: {}".format(key))
                     continue
+                keys.append(key)
 
-                self.patch_weight_to_device(key, device_to)
+            self.patch_weights_to_device(keys, device_to)
 
             if device_to is not None:
-                self.model.to(device_to)
+                pool = comfy.pinned_memory.pool
+                self.model.to(device_to, non_blocking=pool.is_pinned(self.model))
+                pool.loaded(self.model)
                 self.current_device = device_to
 
         return self.model
@@ -270,9 +361,15 @@ class ModelPatcher:
                 self.key = key
                 self.model_patcher = model_patcher
             def __call__(self, weight):
+                cache = comfy.weight_cache.cache
+                if cache.enabled():
+                    cached = cache.get(cache.key(self.model_patcher, self.key))
+                    if cached is not None:
+                        return comfy.model_management.cast_to_device(cached, weight.device, weight.dtype, copy=True)
                 return self.model_patcher.calculate_weight(self.model_patcher.patches[self.key], weight, self.key)
 
         mem_counter = 0
+        streamed_modules = []
         for n, m in self.model.named_modules():
             lowvram_weight = False
             if hasattr(m, "comfy_cast_weights"):
@@ -291,6 +388,8 @@ class ModelPatcher:
 
                 m.prev_comfy_cast_weights = m.comfy_cast_weights
                 m.comfy_cast_weights = True
+                if getattr(m, "weight", None) is not None:
+                    streamed_modules.append(m)
             else:
                 if hasattr(m, "weight"):
                     self.patch_weight_to_device(weight_key, device_to)
@@ -299,6 +398,9 @@ class ModelPatcher:
                     mem_counter += comfy.model_management.module_size(m)
                     logging.debug("lowvram: loaded module regularly {}".format(m))
 
+        if args.lowvram_prefetch > 0 and len(streamed_modules) > 0 and comfy.model_management.is_device_cuda(device_to):
+            self.weight_streamer = comfy.weight_streaming.WeightStreamer(streamed_modules, device_to, args.lowvram_prefetch)
+
         self.model_lowvram = True
         return self.model
 
@@ -450,6 +552,9 @@ class ModelPatcher:
                     m.weight_function = None
                     m.bias_function = None
 
+                if self.weight_streamer is not None:
+                    self.weight_streamer.detach()
+                    self.weight_streamer = None
                 self.model_lowvram = False
 
             keys = list(self.backup.keys())
@@ -464,7 +569,7 @@ class ModelPatcher:
             self.backup.clear()
 
             if device_to is not None:
-                self.model.to(device_to)
+                comfy.pinned_memory.pool.offload(self.model, device_to, self.current_device)
                 self.current_device = device_to
 
         keys = list(self.object_patches_backup.keys())
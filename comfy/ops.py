@@ -20,6 +20,14 @@ import torch
 import comfy.model_management
 
 def cast_bias_weight(s, input):
+    if s.weight_streamer is not None:
+        weight, bias = s.weight_streamer.get(s, input.dtype)
+        if bias is not None and s.bias_function is not None:
+            bias = s.bias_function(bias)
+        if s.weight_function is not None:
+            weight = s.weight_function(weight)
+        return weight, bias
+
     bias = None
     non_blocking = comfy.model_management.device_supports_non_blocking(input.device)
     if s.bias is not None:
@@ -35,6 +43,7 @@ class CastWeightBiasOp:
     comfy_cast_weights = False
     weight_function = None
     bias_function = None
+    weight_streamer = None #see comfy.weight_streaming
 
 class disable_weight_init:
     class Linear(torch.nn.Linear, CastWeightBiasOp):
@@ -0,0 +1,65 @@
+import logging
+import threading
+import weakref
+
+import torch
+
+from comfy.cli_args import args
+import comfy.model_management
+
+class PinnedMemoryPool:
+    #Keeps the weights of the models offloaded from a CUDA device in pinned (page locked) host memory, up to
+    #max_size bytes, so moving them back is a direct DMA copy that doesn't block the host. Over the limit models
+    #are offloaded to regular pageable memory like before. The pinned blocks freed when a model is moved back to the
+    #device stay cached in the torch host allocator and are reused by the next offload.
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        #module: pinned bytes, the entries of the modules that are garbage collected go away with them
+        self.modules = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def used(self):
+        #call with the lock held
+        return sum(self.modules.values())
+
+    def enabled(self):
+        return self.max_size > 0 and torch.cuda.is_available()
+
+    def is_pinned(self, module):
+        with self.lock:
+            return module in self.modules
+
+    def offload(self, module, device, from_device):
+        #same as module.to(device)
+        if not self.enabled() or not comfy.model_management.is_device_cpu(device) or not comfy.model_management.is_device_cuda(from_device):
+            module.to(device)
+            return
+
+        size = comfy.model_management.module_size(module)
+        with self.lock:
+            self.modules.pop(module, None)
+            pin = self.used() + size <= self.max_size
+            if pin:
+                self.modules[module] = size
+
+        if not pin:
+            logging.debug("pinned memory pool full, offloading {} to pageable memory".format(module.__class__.__name__))
+            module.to(device)
+            return
+
+        def to_pinned(t):
+            if t.device.type == "cpu" and t.is_pinned():
+                return t
+            out = torch.empty_like(t, device="cpu", pin_memory=True)
+            out.copy_(t, non_blocking=True)
+            return out
+
+        module._apply(to_pinned)
+        torch.cuda.synchronize(from_device)
+
+    def loaded(self, module):
+        #the module was moved back to the device, its pinned memory can be reused
+        with self.lock:
+            self.modules.pop(module, None)
+
+pool = PinnedMemoryPool(int(args.pinned_memory * (1024 ** 3)))
@@ -2,6 +2,7 @@ import torch
 import comfy.model_management
 import comfy.samplers
 import comfy.utils
+import comfy.conds
 import numpy as np
 import logging
 
@@ -42,3 +43,49 @@ def sample_custom(model, noise, cfg, sampler, sigmas, positive, negative, latent
     samples = comfy.samplers.sample(model, noise, positive, negative, cfg, model.load_device, sampler, sigmas, model_options=model.model_options, latent_image=latent_image, denoise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=seed)
     samples = samples.to(comfy.model_management.intermediate_device())
     return samples
+
+def _same_value(a, b):
+    if a is b:
+        return True
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        return isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor) and a.shape == b.shape and torch.equal(a, b)
+    try:
+        return bool(a == b)
+    except:
+        return False
+
+def batch_conditioning(conds, batch_sizes):
+    """
+    stacks the conditionings of independent latents along the batch dimension so they can be sampled together.
+    the entries are matched by position and can only differ in their cross attention tensor and pooled output.
+    returns None if the conditionings can't be combined.
+    """
+    if any(len(c) != len(conds[0]) for c in conds):
+        return None
+
+    out = []
+    for entries in zip(*conds):
+        length = 1
+        for (cond, options), batch_size in zip(entries, batch_sizes):
+            if cond.shape[0] not in (1, batch_size) or cond.shape[2] != entries[0][0].shape[2] or options.keys() != entries[0][1].keys():
+                return None
+            length = comfy.conds.lcm(length, cond.shape[1])
+        if length // min(e[0].shape[1] for e in entries) > comfy.conds.MAX_CROSSATTN_PADDING: #same padding limit as CONDCrossAttn.can_concat
+            return None
+
+        tensors = []
+        for (cond, _), batch_size in zip(entries, batch_sizes):
+            cond = cond.repeat(1, length // cond.shape[1], 1) #padding with repeat doesn't change result
+            tensors.append(comfy.utils.repeat_to_batch_size(cond, batch_size))
+
+        options = {}
+        for k in entries[0][1]:
+            values = [e[1][k] for e in entries]
+            if all(_same_value(values[0], v) for v in values[1:]):
+                options[k] = values[0]
+            elif k == "pooled_output" and all(isinstance(v, torch.Tensor) and v.shape[0] in (1, batch_size) for v, batch_size in zip(values, batch_sizes)):
+                options[k] = torch.cat([comfy.utils.repeat_to_batch_size(v, batch_size) for v, batch_size in zip(values, batch_sizes)])
+            else:
+                return None
+        out.append([torch.cat(tensors), options])
+    return out
@@ -128,14 +128,83 @@ def cond_cat(c_list):
 
     return out
 
+class CondBatchPlan:
+    #How many conds of each input shape calc_cond_batch runs in one forward pass. The free memory is measured once
+    #and the batch size of a shape is computed the first time it is seen so sampling runs that keep the plan in
+    #model_options["cond_batch_plan"] reuse it for every step.
+    max_workspaces = 4
+
+    def __init__(self, model):
+        self.model = model
+        self.free_memory = None
+        self.max_batch = {}
+        self.workspaces = {}
+
+    def workspace(self, x_in, count):
+        #accumulation buffers for the outputs and the counts of calc_cond_batch, reused every step. They never leave
+        #calc_cond_batch which returns new tensors. The count buffers are only allocated when a cond doesn't cover
+        #the full latent. One entry per input shape and cond count so samplers that alternate between calls with
+        #different numbers of conds (cfg1 optimization, guiders with several cond sets) don't reallocate every call.
+        key = (x_in.shape, x_in.dtype, x_in.device, count)
+        workspace = self.workspaces.get(key, None)
+        if workspace is None:
+            if len(self.workspaces) >= self.max_workspaces:
+                self.workspaces.pop(next(iter(self.workspaces)))
+            workspace = ([torch.empty_like(x_in) for _ in range(count)], [None] * count)
+            self.workspaces[key] = workspace
+        return workspace
+
+    def max_batch_size(self, shape, device):
+        shape = tuple(shape)
+        if shape not in self.max_batch:
+            if self.free_memory is None:
+                self.free_memory = model_management.get_free_memory(device)
+            low, high = 1, 1024
+            while low < high:
+                mid = (low + high + 1) // 2
+                if self.model.memory_required([mid * shape[0]] + list(shape[1:])) < self.free_memory:
+                    low = mid
+                else:
+                    high = mid - 1
+            self.max_batch[shape] = low
+        return self.max_batch[shape]
+
+    def batches(self, to_run, device):
+        #groups the conds that can be concatenated then splits each group in the fewest batches that fit, of
+        #about the same size
+        groups = []
+        for x in to_run:
+            for g in groups:
+                if can_concat_cond(x[0], g[0][0]):
+                    g.append(x)
+                    break
+            else:
+                groups.append([x])
+
+        out = []
+        for g in groups:
+            max_size = self.max_batch_size(g[0][0].input_x.shape, device)
+            batch_count = math.ceil(len(g) / max_size)
+            batch_size = math.ceil(len(g) / batch_count)
+            for i in range(0, len(g), batch_size):
+                out.append(g[i:i + batch_size])
+        return out
+
 def calc_cond_batch(model, conds, x_in, timestep, model_options):
-    out_conds = []
-    out_counts = []
+    plan = model_options.get("cond_batch_plan", None)
+    if plan is None:
+        plan = CondBatchPlan(model)
+
+    out_conds, count_buffers = plan.workspace(x_in, len(conds))
+    out_counts = [None] * len(conds)
+    #when all the conds of an index cover the full latent without a mask their mult is just the strength: the
+    #count is the sum of the strengths and doesn't need a buffer
+    strengths = [0.0] * len(conds)
+    full_area = (x_in.shape[2], x_in.shape[3], 0, 0)
     to_run = []
 
     for i in range(len(conds)):
-        out_conds.append(torch.zeros_like(x_in))
-        out_counts.append(torch.ones_like(x_in) * 1e-37)
+        out_conds[i].zero_()
 
         cond = conds[i]
         if cond is not None:
@@ -144,42 +213,30 @@ def calc_cond_batch(model, conds, x_in, timestep, model_options):
                 if p is None:
                     continue
 
-                to_run += [(p, i)]
-
-    while len(to_run) > 0:
-        first = to_run[0]
-        first_shape = first[0][0].shape
-        to_batch_temp = []
-        for x in range(len(to_run)):
-            if can_concat_cond(to_run[x][0], first[0]):
-                to_batch_temp += [x]
-
-        to_batch_temp.reverse()
-        to_batch = to_batch_temp[:1]
-
-        free_memory = model_management.get_free_memory(x_in.device)
-        for i in range(1, len(to_batch_temp) + 1):
-            batch_amount = to_batch_temp[:len(to_batch_temp)//i]
-            input_shape = [len(batch_amount) * first_shape[0]] + list(first_shape)[1:]
-            if model.memory_required(input_shape) < free_memory:
-                to_batch = batch_amount
-                break
+                if out_counts[i] is None and ('mask' in x or tuple(p.area) != full_area):
+                    if count_buffers[i] is None:
+                        count_buffers[i] = torch.empty_like(x_in)
+                    out_counts[i] = count_buffers[i].fill_(1e-37)
+                strengths[i] += x.get('strength', 1.0)
+                to_run += [(p, i, x.get('strength', 1.0))]
 
+    for to_batch in plan.batches(to_run, x_in.device):
         input_x = []
         mult = []
         c = []
         cond_or_uncond = []
+        c_strengths = []
         area = []
         control = None
         patches = None
-        for x in to_batch:
-            o = to_run.pop(x)
+        for o in to_batch:
             p = o[0]
             input_x.append(p.input_x)
             mult.append(p.mult)
             c.append(p.conditioning)
             area.append(p.area)
             cond_or_uncond.append(o[1])
+            c_strengths.append(o[2])
             control = p.control
             patches = p.patches
 
@@ -219,13 +276,21 @@ def calc_cond_batch(model, conds, x_in, timestep, model_options):
 
         for o in range(batch_chunks):
             cond_index = cond_or_uncond[o]
+            if out_counts[cond_index] is None:
+                out_conds[cond_index].add_(output[o], alpha=c_strengths[o])
+                continue
             out_conds[cond_index][:,:,area[o][2]:area[o][0] + area[o][2],area[o][3]:area[o][1] + area[o][3]] += output[o] * mult[o]
             out_counts[cond_index][:,:,area[o][2]:area[o][0] + area[o][2],area[o][3]:area[o][1] + area[o][3]] += mult[o]
 
+    out = []
     for i in range(len(out_conds)):
-        out_conds[i] /= out_counts[i]
-
-    return out_conds
+        if out_counts[i] is not None:
+            out.append(out_conds[i] / out_counts[i])
+        elif strengths[i] != 0.0 and strengths[i] != 1.0:
+            out.append(out_conds[i] / strengths[i])
+        else:
+            out.append(out_conds[i].clone())
+    return out
 
 def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options): #TODO: remove
     logging.warning("WARNING: The comfy.samplers.calc_cond_uncond_batch function is deprecated please use the calc_cond_batch one instead.")
@@ -508,6 +573,14 @@ KSAMPLER_NAMES = ["euler", "euler_ancestral", "heun", "heunpp2","dpm_2", "dpm_2_
                   "lms", "dpm_fast", "dpm_adaptive", "dpmpp_2s_ancestral", "dpmpp_sde", "dpmpp_sde_gpu",
                   "dpmpp_2m", "dpmpp_2m_sde", "dpmpp_2m_sde_gpu", "dpmpp_3m_sde", "dpmpp_3m_sde_gpu", "ddpm", "lcm"]
 
+#samplers that draw new noise from the seed while sampling, a batch gets the noise of a single seed
+NOISE_SAMPLERS = set(("euler_ancestral", "dpm_2_ancestral", "dpmpp_2s_ancestral", "dpmpp_sde", "dpmpp_sde_gpu", "dpmpp_2m_sde", "dpmpp_2m_sde_gpu",
+                      "dpmpp_3m_sde", "dpmpp_3m_sde_gpu", "ddpm", "lcm"))
+
+def sampler_uses_noise(sampler_name):
+    #samplers added by custom nodes are assumed to
+    return sampler_name in NOISE_SAMPLERS or sampler_name not in KSAMPLER_NAMES + ["ddim", "uni_pc", "uni_pc_bh2"]
+
 class KSAMPLER(Sampler):
     def __init__(self, sampler_function, extra_options={}, inpaint_options={}):
         self.sampler_function = sampler_function
@@ -618,7 +691,9 @@ class CFGGuider:
 
         self.conds = process_conds(self.inner_model, noise, self.conds, device, latent_image, denoise_mask, seed)
 
-        extra_args = {"model_options": self.model_options, "seed":seed}
+        model_options = self.model_options.copy()
+        model_options["cond_batch_plan"] = CondBatchPlan(self.inner_model)
+        extra_args = {"model_options": model_options, "seed":seed}
 
         samples = sampler.sample(self, sigmas, extra_args, callback, noise, latent_image, denoise_mask, disable_pbar)
         return self.inner_model.process_latent_out(samples.to(torch.float32))
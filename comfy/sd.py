@@ -10,6 +10,11 @@ from .ldm.cascade.stage_c_coder import StageC_coder
 import yaml
 
 import comfy.utils
+import comfy.text_encoder_cache
+import comfy.image_stream
+import comfy.vae_memory
+import comfy.model_cache
+import comfy.weight_cache
 
 from . import clip_vision
 from . import gligen
@@ -57,7 +62,8 @@ def load_clip_weights(model, sd):
     return load_model_weights(model, sd)
 
 
-def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
+def load_lora_for_models(model, clip, lora, strength_model, strength_clip, source=None):
+    #source: identifies the file lora was loaded from, the patched weight cache then keys on it instead of the content
     key_map = {}
     if model is not None:
         key_map = comfy.lora.model_lora_keys_unet(model.model, key_map)
@@ -65,6 +71,8 @@ def load_lora_for_models(model, clip, lora, strength_model, strength_clip):
         key_map = comfy.lora.model_lora_keys_clip(clip.cond_stage_model, key_map)
 
     loaded = comfy.lora.load_lora(lora, key_map)
+    if source is not None:
+        comfy.weight_cache.set_patches_source(loaded, source)
     if model is not None:
         new_modelpatcher = model.clone()
         k = new_modelpatcher.add_patches(loaded, strength_model)
@@ -105,6 +113,7 @@ class CLIP:
         self.tokenizer = tokenizer(embedding_directory=embedding_directory)
         self.patcher = comfy.model_patcher.ModelPatcher(self.cond_stage_model, load_device=load_device, offload_device=offload_device)
         self.layer_idx = None
+        self.weights_id = None #set by the loaders to identify the weights across restarts, see comfy.text_encoder_cache
 
     def clone(self):
         n = CLIP(no_init=True)
@@ -112,6 +121,7 @@ class CLIP:
         n.cond_stage_model = self.cond_stage_model
         n.tokenizer = self.tokenizer
         n.layer_idx = self.layer_idx
+        n.weights_id = self.weights_id
         return n
 
     def add_patches(self, patches, strength_patch=1.0, strength_model=1.0):
@@ -124,6 +134,15 @@ class CLIP:
         return self.tokenizer.tokenize_with_weights(text, return_word_ids)
 
     def encode_from_tokens(self, tokens, return_pooled=False):
+        cache = comfy.text_encoder_cache.cache
+        if cache.enabled():
+            key, persistent = cache.key(self, tokens, return_pooled)
+            cached = cache.get(key, persistent)
+            if cached is not None:
+                if return_pooled:
+                    return cached
+                return cached[0]
+
         self.cond_stage_model.reset_clip_options()
 
         if self.layer_idx is not None:
@@ -134,6 +153,8 @@ class CLIP:
 
         self.load_model()
         cond, pooled = self.cond_stage_model.encode_token_weights(tokens)
+        if cache.enabled():
+            cache.set(key, persistent, cond, pooled)
         if return_pooled:
             return cond, pooled
         return cond
@@ -252,52 +273,84 @@ class VAE:
             pixels = pixels[:, x_offset:x + x_offset, y_offset:y + y_offset, :]
         return pixels
 
+    def memory_used(self, operation, shape):
+        #memory needed per batch item, from the measured model if there is one
+        if operation == "decode":
+            fallback = self.memory_used_decode(shape, self.vae_dtype)
+        else:
+            fallback = self.memory_used_encode(shape, self.vae_dtype)
+        return comfy.vae_memory.model.estimate(self.first_stage_model, self.vae_dtype, operation, shape, fallback)
+
+    def tile_batch_size(self, memory_used_tile):
+        free_memory = model_management.get_free_memory(self.device)
+        return max(1, int(free_memory / memory_used_tile))
+
     def decode_tiled_(self, samples, tile_x=64, tile_y=64, overlap = 16):
         steps = samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x, tile_y, overlap)
-        steps += samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x // 2, tile_y * 2, overlap)
-        steps += samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x * 2, tile_y // 2, overlap)
         pbar = comfy.utils.ProgressBar(steps)
+        max_batch = self.tile_batch_size(self.memory_used("decode", (1, samples.shape[1], tile_y, tile_x)))
 
         decode_fn = lambda a: self.first_stage_model.decode(a.to(self.vae_dtype).to(self.device)).float()
-        output = self.process_output(
-            (comfy.utils.tiled_scale(samples, decode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar) +
-            comfy.utils.tiled_scale(samples, decode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar) +
-             comfy.utils.tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar))
-            / 3.0)
+        output = self.process_output(comfy.utils.tiled_scale(samples, decode_fn, tile_x, tile_y, overlap, upscale_amount = self.upscale_ratio, output_device=self.output_device, pbar = pbar, max_batch = max_batch))
         return output
 
     def encode_tiled_(self, pixel_samples, tile_x=512, tile_y=512, overlap = 64):
         steps = pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x, tile_y, overlap)
-        steps += pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x // 2, tile_y * 2, overlap)
-        steps += pixel_samples.shape[0] * comfy.utils.get_tiled_scale_steps(pixel_samples.shape[3], pixel_samples.shape[2], tile_x * 2, tile_y // 2, overlap)
         pbar = comfy.utils.ProgressBar(steps)
+        max_batch = self.tile_batch_size(self.memory_used("encode", (1, pixel_samples.shape[1], tile_y, tile_x)))
 
         encode_fn = lambda a: self.first_stage_model.encode((self.process_input(a)).to(self.vae_dtype).to(self.device)).float()
-        samples = comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x * 2, tile_y // 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples += comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x // 2, tile_y * 2, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar)
-        samples /= 3.0
+        samples = comfy.utils.tiled_scale(pixel_samples, encode_fn, tile_x, tile_y, overlap, upscale_amount = (1/self.downscale_ratio), out_channels=self.latent_channels, output_device=self.output_device, pbar=pbar, max_batch = max_batch)
         return samples
 
-    def decode(self, samples_in):
+    def decode_chunks(self, samples_in, max_batch=0):
+        #loads the VAE right away and returns an iterator that decodes the batch in as large sub batches as fit in
+        #memory (at most max_batch when it's not 0), yielding each one channels last on the output device as soon as
+        #it's done. The iterator doesn't load models so it can run on another thread.
         try:
-            memory_used = self.memory_used_decode(samples_in.shape, self.vae_dtype)
+            memory_used = self.memory_used("decode", samples_in.shape)
             model_management.load_models_gpu([self.patcher], memory_required=memory_used)
             free_memory = model_management.get_free_memory(self.device)
             batch_number = int(free_memory / memory_used)
             batch_number = max(1, batch_number)
-
-            pixel_samples = torch.empty((samples_in.shape[0], 3, round(samples_in.shape[2] * self.upscale_ratio), round(samples_in.shape[3] * self.upscale_ratio)), device=self.output_device)
-            for x in range(0, samples_in.shape[0], batch_number):
-                samples = samples_in[x:x+batch_number].to(self.vae_dtype).to(self.device)
-                pixel_samples[x:x+batch_number] = self.process_output(self.first_stage_model.decode(samples).to(self.output_device).float())
+            tiled = False
         except model_management.OOM_EXCEPTION as e:
             logging.warning("Warning: Ran out of memory when regular VAE decoding, retrying with tiled VAE decoding.")
-            pixel_samples = self.decode_tiled_(samples_in)
+            batch_number = samples_in.shape[0]
+            tiled = True
+        if max_batch > 0:
+            batch_number = min(batch_number, max_batch)
+
+        def chunks(tiled):
+            for x in range(0, samples_in.shape[0], batch_number):
+                pixel_samples = None
+                if not tiled:
+                    try:
+                        samples = samples_in[x:x+batch_number].to(self.vae_dtype).to(self.device)
+                        with comfy.vae_memory.model.measure(self.first_stage_model, self.vae_dtype, "decode", samples.shape, self.device):
+                            pixel_samples = self.first_stage_model.decode(samples)
+                        pixel_samples = self.process_output(pixel_samples.to(self.output_device).float())
+                    except model_management.OOM_EXCEPTION as e:
+                        logging.warning("Warning: Ran out of memory when regular VAE decoding, retrying with tiled VAE decoding.")
+                        pixel_samples = None
+                        tiled = True
+                if pixel_samples is None:
+                    pixel_samples = self.decode_tiled_(samples_in[x:x+batch_number])
+                yield pixel_samples.to(self.output_device).movedim(1,-1)
+        return chunks(tiled)
 
-        pixel_samples = pixel_samples.to(self.output_device).movedim(1,-1)
+    def decode(self, samples_in):
+        pixel_samples = torch.empty((samples_in.shape[0], round(samples_in.shape[2] * self.upscale_ratio), round(samples_in.shape[3] * self.upscale_ratio), 3), device=self.output_device)
+        x = 0
+        for chunk in self.decode_chunks(samples_in):
+            pixel_samples[x:x+chunk.shape[0]] = chunk
+            x += chunk.shape[0]
         return pixel_samples
 
+    def decode_stream(self, samples_in, max_batch=0):
+        shape = (samples_in.shape[0], round(samples_in.shape[2] * self.upscale_ratio), round(samples_in.shape[3] * self.upscale_ratio), 3)
+        return comfy.image_stream.ImageStream(lambda: self.decode_chunks(samples_in, max_batch), shape)
+
     def decode_tiled(self, samples, tile_x=64, tile_y=64, overlap = 16):
         model_management.load_model_gpu(self.patcher)
         output = self.decode_tiled_(samples, tile_x, tile_y, overlap)
@@ -307,7 +360,7 @@ class VAE:
         pixel_samples = self.vae_encode_crop_pixels(pixel_samples)
         pixel_samples = pixel_samples.movedim(-1,1)
         try:
-            memory_used = self.memory_used_encode(pixel_samples.shape, self.vae_dtype)
+            memory_used = self.memory_used("encode", pixel_samples.shape)
             model_management.load_models_gpu([self.patcher], memory_required=memory_used)
             free_memory = model_management.get_free_memory(self.device)
             batch_number = int(free_memory / memory_used)
@@ -315,7 +368,9 @@ class VAE:
             samples = torch.empty((pixel_samples.shape[0], self.latent_channels, round(pixel_samples.shape[2] // self.downscale_ratio), round(pixel_samples.shape[3] // self.downscale_ratio)), device=self.output_device)
             for x in range(0, pixel_samples.shape[0], batch_number):
                 pixels_in = self.process_input(pixel_samples[x:x+batch_number]).to(self.vae_dtype).to(self.device)
-                samples[x:x+batch_number] = self.first_stage_model.encode(pixels_in).to(self.output_device).float()
+                with comfy.vae_memory.model.measure(self.first_stage_model, self.vae_dtype, "encode", pixels_in.shape, self.device):
+                    out = self.first_stage_model.encode(pixels_in)
+                samples[x:x+batch_number] = out.to(self.output_device).float()
 
         except model_management.OOM_EXCEPTION as e:
             logging.warning("Warning: Ran out of memory when regular VAE encoding, retrying with tiled VAE encoding.")
@@ -391,6 +446,7 @@ def load_clip(ckpt_paths, embedding_directory=None, clip_type=CLIPType.STABLE_DI
         clip_target.tokenizer = sdxl_clip.SDXLTokenizer
 
     clip = CLIP(clip_target, embedding_directory=embedding_directory)
+    clip.weights_id = comfy.text_encoder_cache.file_identity(ckpt_paths, clip_type.name)
     for c in clip_data:
         m, u = clip.load_sd(c)
         if len(m) > 0:
@@ -492,7 +548,7 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
     return (comfy.model_patcher.ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device), clip, vae)
 
 def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True):
-    sd = comfy.utils.load_torch_file(ckpt_path)
+    sd = comfy.utils.load_torch_file(ckpt_path, lazy=True)
     sd_keys = sd.keys()
     clip = None
     clipvision = None
@@ -504,7 +560,10 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     parameters = comfy.utils.calculate_parameters(sd, "model.diffusion_model.")
     load_device = model_management.get_torch_device()
 
-    model_config = model_detection.model_config_from_unet(sd, "model.diffusion_model.")
+    cache_key = None
+    if model_detection.detection_index is not None:
+        cache_key = model_detection.detection_cache_key(ckpt_path, "model.diffusion_model.")
+    model_config = model_detection.model_config_from_unet(sd, "model.diffusion_model.", cache_key=cache_key)
     unet_dtype = model_management.unet_dtype(model_params=parameters, supported_dtypes=model_config.supported_inference_dtypes)
     manual_cast_dtype = model_management.unet_manual_cast(unet_dtype, load_device, model_config.supported_inference_dtypes)
     model_config.set_inference_dtype(unet_dtype, manual_cast_dtype)
@@ -518,6 +577,8 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
 
     if output_model:
         inital_load_device = model_management.unet_inital_load_device(parameters, unet_dtype)
+        if comfy.model_cache.cache.prefetching(): #the prompt thread moves it to the GPU when it uses it
+            inital_load_device = torch.device("cpu")
         offload_device = model_management.unet_offload_device()
         model = model_config.get_model(sd, "model.diffusion_model.", device=inital_load_device)
         model.load_model_weights(sd, "model.diffusion_model.")
@@ -533,6 +594,7 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
             clip_sd = model_config.process_clip_state_dict(sd)
             if len(clip_sd) > 0:
                 clip = CLIP(clip_target, embedding_directory=embedding_directory)
+                clip.weights_id = comfy.text_encoder_cache.file_identity([ckpt_path])
                 m, u = clip.load_sd(clip_sd, full_model=True)
                 if len(m) > 0:
                     logging.warning("clip missing: {}".format(m))
@@ -593,7 +655,7 @@ def load_unet_state_dict(sd): #load unet in diffusers format
     return comfy.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=offload_device)
 
 def load_unet(unet_path):
-    sd = comfy.utils.load_torch_file(unet_path)
+    sd = comfy.utils.load_torch_file(unet_path, lazy=True)
     model = load_unet_state_dict(sd)
     if model is None:
         logging.error("ERROR UNSUPPORTED UNET {}".format(unet_path))
@@ -0,0 +1,185 @@
+import os
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+import safetensors.torch
+
+from comfy.cli_args import args
+
+def hash_value(m, value):
+    #feeds tokens, patches and other nested lists/tuples/dicts of tensors into the hash m
+    if isinstance(value, torch.Tensor):
+        t = value.detach().cpu().contiguous().reshape(-1)
+        m.update(repr((str(t.dtype), tuple(value.shape))).encode("utf-8"))
+        m.update(t.view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, (list, tuple)):
+        m.update(b"(")
+        for v in value:
+            hash_value(m, v)
+        m.update(b")")
+    elif isinstance(value, dict):
+        m.update(b"{")
+        for k in sorted(value, key=repr):
+            m.update(repr(k).encode("utf-8"))
+            hash_value(m, value[k])
+        m.update(b"}")
+    else:
+        m.update(repr(value).encode("utf-8"))
+        m.update(b",")
+
+def file_identity(paths, *extra):
+    #identifies the weights loaded from these files without reading them, changes if a file is replaced
+    m = hashlib.sha256()
+    for p in paths:
+        st = os.stat(p)
+        m.update(repr((os.path.abspath(p), st.st_size, st.st_mtime_ns)).encode("utf-8"))
+    m.update(repr(extra).encode("utf-8"))
+    return m.hexdigest()
+
+def patches_hash(patcher):
+    #content hash of the patches (LoRAs) of a ModelPatcher, computed once per patches_uuid
+    cached = getattr(patcher, "patches_hash", None)
+    if cached is not None and cached[0] == patcher.patches_uuid:
+        return cached[1]
+    m = hashlib.sha256()
+    for k in sorted(patcher.patches):
+        m.update(k.encode("utf-8"))
+        hash_value(m, patcher.patches[k])
+    patcher.patches_hash = (patcher.patches_uuid, m.hexdigest())
+    return patcher.patches_hash[1]
+
+class TextEncoderCache:
+    #Results of CLIP.encode_from_tokens keyed by the text encoder weights, its patches, the clip options and the
+    #tokens. The memory tier is an LRU of max_entries results, the optional disk tier keeps them as safetensors
+    #files in directory (up to max_disk_size bytes) so they survive restarts.
+    def __init__(self, max_entries=0, directory=None, max_disk_size=0):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_size = None
+
+    def enabled(self):
+        return self.max_entries > 0 or self.directory is not None
+
+    def key(self, clip, tokens, return_pooled):
+        #returns (key, persistent), only the weights loaded from files have an identity that is valid after a restart
+        weights_id = getattr(clip, "weights_id", None)
+        persistent = weights_id is not None
+        if weights_id is None:
+            weights_id = getattr(clip.cond_stage_model, "encode_cache_id", None)
+            if weights_id is None:
+                weights_id = uuid.uuid4().hex
+                clip.cond_stage_model.encode_cache_id = weights_id
+
+        m = hashlib.sha256()
+        dtype = None
+        for p in clip.cond_stage_model.parameters():
+            dtype = p.dtype
+            break
+        m.update(repr((weights_id, str(dtype), patches_hash(clip.patcher), clip.layer_idx, return_pooled)).encode("utf-8"))
+        hash_value(m, tokens)
+        return m.hexdigest(), persistent
+
+    def get(self, key, persistent):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if persistent and self.directory is not None:
+            path = os.path.join(self.directory, "{}.safetensors".format(key))
+            try:
+                sd = safetensors.torch.load_file(path)
+                os.utime(path) #most recently used files are the last to be pruned
+            except FileNotFoundError:
+                sd = None
+            except Exception as e:
+                logging.warning("could not load cached text encoder output {}: {}".format(path, e))
+                sd = None
+            if sd is not None:
+                result = (sd["cond"], sd.get("pooled", None))
+                with self.lock:
+                    self.disk_hits += 1
+                    self.add(key, result)
+                return result
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def add(self, key, result):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def set(self, key, persistent, cond, pooled):
+        with self.lock:
+            self.add(key, (cond, pooled))
+
+        if persistent and self.directory is not None and isinstance(cond, torch.Tensor):
+            sd = {"cond": cond.contiguous()}
+            if isinstance(pooled, torch.Tensor):
+                sd["pooled"] = pooled.contiguous()
+            elif pooled is not None:
+                return
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, "{}.safetensors".format(key))
+                temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+                safetensors.torch.save_file(sd, temp_path)
+                os.replace(temp_path, path)
+                self.prune_disk(os.path.getsize(path))
+            except Exception as e:
+                logging.warning("could not save text encoder output to the cache: {}".format(e))
+
+    def prune_disk(self, added_size):
+        if self.max_disk_size <= 0:
+            return
+        if self.disk_size is None:
+            self.disk_size = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".safetensors"):
+                    self.disk_size += entry.stat().st_size
+        else:
+            self.disk_size += added_size
+
+        if self.disk_size <= self.max_disk_size:
+            return
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".safetensors"):
+                st = entry.stat()
+                files.append((st.st_mtime, entry.path, st.st_size))
+        files.sort()
+        self.disk_size = sum(f[2] for f in files)
+        for _, path, size in files:
+            if self.disk_size <= self.max_disk_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.disk_size -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "entries": len(self.entries)}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+cache = TextEncoderCache(args.text_encoder_cache, args.text_encoder_cache_dir, int(args.text_encoder_cache_disk_size * (1024 ** 3)))
@@ -1,16 +1,66 @@
 import torch
 import math
 import struct
+import collections.abc
 import comfy.checkpoint_pickle
+import safetensors
 import safetensors.torch
 import numpy as np
 from PIL import Image
 import logging
 
-def load_torch_file(ckpt, safe_load=False, device=None):
+_NOT_LOADED = object()
+
+class LazySafetensorsDict(collections.abc.MutableMapping):
+    #State dict of a memory mapped safetensors file where each tensor is only read the first time its key is
+    #accessed, keys that are never accessed (the VAE when it isn't loaded, EMA weights...) are never read.
+    #A tensor that was read stays in the dict like in a normal dict until it gets popped.
+    def __init__(self, path, device="cpu"):
+        self.file = safetensors.safe_open(path, framework="pt", device=device)
+        self.entries = dict.fromkeys(self.file.keys(), _NOT_LOADED)
+
+    def __getitem__(self, key):
+        value = self.entries[key]
+        if value is _NOT_LOADED:
+            value = self.file.get_tensor(key)
+            self.entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+
+    def __delitem__(self, key):
+        del self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def shape(self, key):
+        #without reading the tensor
+        value = self.entries[key]
+        if value is _NOT_LOADED:
+            return torch.Size(self.file.get_slice(key).get_shape())
+        return value.shape
+
+    def numel(self, key):
+        return self.shape(key).numel()
+
+def load_torch_file(ckpt, safe_load=False, device=None, lazy=False):
+    #lazy: return a LazySafetensorsDict for safetensors files so only the tensors that get used are read
     if device is None:
         device = torch.device("cpu")
     if ckpt.lower().endswith(".safetensors"):
+        if lazy:
+            return LazySafetensorsDict(ckpt, device=str(device))
         sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
@@ -36,10 +86,12 @@ def save_torch_file(sd, ckpt, metadata=None):
         safetensors.torch.save_file(sd, ckpt)
 
 def calculate_parameters(sd, prefix=""):
+    #a LazySafetensorsDict counts them from the file header without reading the tensors
+    numel = getattr(sd, "numel", lambda k: sd[k].nelement())
     params = 0
     for k in sd.keys():
         if k.startswith(prefix):
-            params += sd[k].nelement()
+            params += numel(k)
     return params
 
 def state_dict_key_replace(state_dict, keys_to_replace):
@@ -424,33 +476,60 @@ def common_upscale(samples, width, height, upscale_method, crop):
 def get_tiled_scale_steps(width, height, tile_x, tile_y, overlap):
     return math.ceil((height / (tile_y - overlap))) * math.ceil((width / (tile_x - overlap)))
 
+FEATHER_WINDOWS = {}
+
+def feather_window(height, width, feather, device):
+    #blending weights of a tile: ramps from 1/feather to 1 over the first and last feather pixels of each side,
+    #the outer product of one ramp per axis. Cached per tile shape since most tiles of an image have the same one.
+    key = (height, width, feather, str(device))
+    window = FEATHER_WINDOWS.get(key, None)
+    if window is None:
+        def ramp(size):
+            r = torch.ones(size)
+            if feather > 0:
+                t = torch.arange(size, dtype=torch.float32)
+                r = torch.clamp((t + 1) / feather, max=1.0) * torch.clamp((size - t) / feather, max=1.0)
+            return r
+        window = (ramp(height).unsqueeze(1) * ramp(width).unsqueeze(0)).to(device)
+        if len(FEATHER_WINDOWS) > 64:
+            FEATHER_WINDOWS.clear()
+        FEATHER_WINDOWS[key] = window
+    return window
+
 @torch.inference_mode()
-def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None):
-    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)), device=output_device)
-    for b in range(samples.shape[0]):
-        s = samples[b:b+1]
-        out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
-        out_div = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)), device=output_device)
-        for y in range(0, s.shape[2], tile_y - overlap):
-            for x in range(0, s.shape[3], tile_x - overlap):
-                x = max(0, min(s.shape[-1] - overlap, x))
-                y = max(0, min(s.shape[-2] - overlap, y))
-                s_in = s[:,:,y:y+tile_y,x:x+tile_x]
-
-                ps = function(s_in).to(output_device)
-                mask = torch.ones_like(ps)
-                feather = round(overlap * upscale_amount)
-                for t in range(feather):
-                        mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
-                        mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
-                out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
-                out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
-                if pbar is not None:
-                    pbar.update(1)
-
-        output[b:b+1] = out/out_div
+def tiled_scale(samples, function, tile_x=64, tile_y=64, overlap = 8, upscale_amount = 4, out_channels = 3, output_device="cpu", pbar = None, max_batch = 1):
+    #max_batch: how many tiles of the same shape can be stacked into one call of function
+    out_h = round(samples.shape[2] * upscale_amount)
+    out_w = round(samples.shape[3] * upscale_amount)
+    output = torch.zeros((samples.shape[0], out_channels, out_h, out_w), device=output_device)
+    out_div = torch.zeros((out_h, out_w), device=output_device)
+    feather = round(overlap * upscale_amount)
+
+    tiles = {}
+    for y in range(0, samples.shape[2], tile_y - overlap):
+        for x in range(0, samples.shape[3], tile_x - overlap):
+            x = max(0, min(samples.shape[-1] - overlap, x))
+            y = max(0, min(samples.shape[-2] - overlap, y))
+            shape = (min(tile_y, samples.shape[2] - y), min(tile_x, samples.shape[3] - x))
+            tiles.setdefault(shape, []).append((y, x))
+
+    step = max(1, max_batch)
+    for shape, positions in tiles.items():
+        items = [(b, y, x) for b in range(samples.shape[0]) for y, x in positions]
+        for i in range(0, len(items), step):
+            chunk = items[i:i + step]
+            s_in = torch.cat([samples[b:b+1,:,y:y+shape[0],x:x+shape[1]] for b, y, x in chunk])
+            ps = function(s_in).to(output_device)
+            window = feather_window(ps.shape[-2], ps.shape[-1], feather, output_device)
+            for (b, y, x), p in zip(chunk, ps):
+                area = (slice(round(y*upscale_amount), round((y+shape[0])*upscale_amount)), slice(round(x*upscale_amount), round((x+shape[1])*upscale_amount)))
+                output[b][(slice(None),) + area].addcmul_(p, window)
+                if b == 0:
+                    out_div[area] += window
+            if pbar is not None:
+                pbar.update(len(chunk))
+
+    output /= out_div
     return output
 
 PROGRESS_BAR_ENABLED = True
@@ -463,6 +542,18 @@ def set_progress_bar_global_hook(function):
     global PROGRESS_BAR_HOOK
     PROGRESS_BAR_HOOK = function
 
+PREVIEW_HOOK = None
+def set_preview_global_hook(function):
+    #function() is called on the thread running the node and returns the function that sends its encoded preview
+    #images, which can then be called from any thread
+    global PREVIEW_HOOK
+    PREVIEW_HOOK = function
+
+def preview_sender():
+    if PREVIEW_HOOK is None:
+        return None
+    return PREVIEW_HOOK()
+
 class ProgressBar:
     def __init__(self, total):
         global PROGRESS_BAR_HOOK
@@ -0,0 +1,120 @@
+import os
+import json
+import logging
+import threading
+import contextlib
+
+import torch
+
+from comfy.cli_args import args
+import comfy.model_management
+
+def model_signature(model):
+    #the vae classes are shared by models of different sizes, the parameter count tells them apart
+    signature = getattr(model, "vae_memory_signature", None)
+    if signature is None:
+        signature = "{}_{}".format(type(model).__name__, sum(p.numel() for p in model.parameters()))
+        model.vae_memory_signature = signature
+    return signature
+
+class VAEMemoryModel:
+    #Peak device memory per batch item of the VAE decodes and encodes, measured the first `samples` times for each
+    #model, dtype, operation and resolution and stored as json in path (--vae-memory-model) so it's kept across
+    #restarts. Batches are sized from the measurement of the same resolution when there is one, else from a linear
+    #fit over the pixel counts of the measured resolutions, else from the static memory_used_* formulas.
+    def __init__(self, path=None, samples=3, margin=1.15):
+        self.path = path
+        self.samples = samples
+        self.margin = margin
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.path is not None
+
+    def load(self):
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                logging.warning("could not read the vae memory model {}: {}".format(self.path, e))
+
+    def save(self):
+        try:
+            temp_path = "{}.tmp".format(self.path)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logging.warning("could not write the vae memory model {}: {}".format(self.path, e))
+
+    def measurements(self, model, dtype, operation):
+        #{"HxW": [bytes per batch item, ...]}, call with the lock held
+        if self.entries is None:
+            self.load()
+        return self.entries.setdefault("{}_{}_{}".format(model_signature(model), dtype, operation), {})
+
+    def estimate(self, model, dtype, operation, shape, fallback):
+        #memory needed per batch item of shape ([B, C, H, W] input of the operation)
+        if not self.enabled():
+            return fallback
+        with self.lock:
+            measured = self.measurements(model, dtype, operation)
+            values = measured.get("{}x{}".format(shape[2], shape[3]), None)
+            if values is not None:
+                return max(values) * self.margin
+
+            points = []
+            for resolution, v in measured.items():
+                h, w = resolution.split("x")
+                points.append((int(h) * int(w), max(v)))
+        if len(points) == 0:
+            return fallback
+
+        pixels = shape[2] * shape[3]
+        if len(points) == 1:
+            return points[0][1] * pixels / points[0][0] * self.margin
+        mean_x = sum(p[0] for p in points) / len(points)
+        mean_y = sum(p[1] for p in points) / len(points)
+        var = sum((p[0] - mean_x) ** 2 for p in points)
+        slope = sum((p[0] - mean_x) * (p[1] - mean_y) for p in points) / var if var > 0 else 0
+        if slope <= 0:
+            slope = max(p[1] / p[0] for p in points)
+            intercept = 0
+        else:
+            intercept = mean_y - slope * mean_x
+        return max(slope * pixels + intercept, 1) * self.margin
+
+    def needs_measurement(self, model, dtype, operation, shape, device):
+        if not self.enabled() or not comfy.model_management.is_device_cuda(device):
+            return False
+        if args.profile_nodes: #resetting the peak memory stats would break the peak_memory_delta of the node profiler
+            return False
+        with self.lock:
+            return len(self.measurements(model, dtype, operation).get("{}x{}".format(shape[2], shape[3]), [])) < self.samples
+
+    @contextlib.contextmanager
+    def measure(self, model, dtype, operation, shape, device):
+        #records the peak memory allocated while running the block on a batch of shape
+        if not self.needs_measurement(model, dtype, operation, shape, device):
+            yield
+            return
+
+        torch.cuda.synchronize(device)
+        start = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        yield
+        torch.cuda.synchronize(device)
+        used = (torch.cuda.max_memory_allocated(device) - start) / shape[0]
+        if used <= 0:
+            return
+        resolution = "{}x{}".format(shape[2], shape[3])
+        with self.lock:
+            measured = self.measurements(model, dtype, operation)
+            measured.setdefault(resolution, []).append(used)
+            logging.debug("vae {} at {} used {:.1f} MB per batch item".format(operation, resolution, used / (1024 * 1024)))
+            self.save()
+
+model = VAEMemoryModel(args.vae_memory_model)
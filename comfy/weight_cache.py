@@ -0,0 +1,118 @@
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+from comfy.cli_args import args
+from comfy.text_encoder_cache import hash_value
+
+def model_weights_id(model):
+    #identifies the unpatched weights of a model object, the patchers of all its clones share it
+    weights_id = getattr(model, "weights_cache_id", None)
+    if weights_id is None:
+        weights_id = uuid.uuid4().hex
+        model.weights_cache_id = weights_id
+    return weights_id
+
+def set_source(tensor, source):
+    #names where a patch tensor comes from (a file and key, the weights of a model) so the cache key can use that
+    #instead of hashing its content
+    tensor.weight_cache_source = source
+
+def set_patches_source(patches, source):
+    #patches: {key: patch} as made by comfy.lora.load_lora from the file identified by source
+    for key, patch in patches.items():
+        tensors = []
+        collect_tensors(patch, tensors)
+        for i, t in enumerate(tensors):
+            set_source(t, (source, key, i))
+
+def collect_tensors(value, out):
+    if isinstance(value, torch.Tensor):
+        out.append(value)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            collect_tensors(v, out)
+
+def hash_patches(m, value):
+    #like hash_value but the tensors with a source are hashed by their source, only the others by content
+    if isinstance(value, torch.Tensor):
+        source = getattr(value, "weight_cache_source", None)
+        if source is None:
+            hash_value(m, value)
+        else:
+            m.update(repr(("source", source, str(value.dtype), tuple(value.shape))).encode("utf-8"))
+    elif isinstance(value, (list, tuple)):
+        m.update(b"(")
+        for v in value:
+            hash_patches(m, v)
+        m.update(b")")
+    else:
+        hash_value(m, value)
+
+def key_patches_hash(patcher, key):
+    #hash of the patches (LoRA file and key, strengths) of one key, memoized per patches_uuid
+    hashes = getattr(patcher, "key_patches_hashes", None)
+    if hashes is None or hashes[0] != patcher.patches_uuid:
+        hashes = (patcher.patches_uuid, {})
+        patcher.key_patches_hashes = hashes
+    h = hashes[1].get(key, None)
+    if h is None:
+        m = hashlib.sha256()
+        hash_patches(m, patcher.patches[key])
+        h = m.hexdigest()
+        hashes[1][key] = h
+    return h
+
+class PatchedWeightCache:
+    #Results of ModelPatcher.calculate_weight kept in host RAM, keyed by the base weights, the key and the source
+    #and strengths of its patches so loading a model with a LoRA combination that was already used is a copy instead of running
+    #the patch math again. The least recently used weights are dropped when the total goes over max_ram.
+    def __init__(self, max_ram=0):
+        self.max_ram = max_ram
+        self.entries = OrderedDict()
+        self.ram_used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.max_ram > 0
+
+    def key(self, patcher, key):
+        return (model_weights_id(patcher.model), key, key_patches_hash(patcher, key))
+
+    def get(self, cache_key):
+        with self.lock:
+            weight = self.entries.get(cache_key, None)
+            if weight is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(cache_key)
+            return weight
+
+    def set(self, cache_key, weight):
+        #weight: a copy on the offload device that nothing else writes to
+        size = weight.nelement() * weight.element_size()
+        with self.lock:
+            if size > self.max_ram or cache_key in self.entries:
+                return
+            self.entries[cache_key] = weight
+            self.ram_used += size
+            while self.ram_used > self.max_ram:
+                _, old = self.entries.popitem(last=False)
+                self.ram_used -= old.nelement() * old.element_size()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "ram_used": self.ram_used}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.ram_used = 0
+
+cache = PatchedWeightCache(int(args.patched_weight_cache_ram * (1024 ** 3)))
@@ -0,0 +1,129 @@
+import time
+import logging
+
+import torch
+
+class WeightStreamer:
+    #Streams the weights of the modules that lowvram mode leaves on the offload device. When one of them runs, the
+    #copies of the next `lookahead` ones are started on a side stream through pinned staging buffers so they overlap
+    #with its compute instead of stalling the device right before each forward.
+    #modules: in the order they are expected to run (named_modules order), the prediction wraps around at the end.
+    def __init__(self, modules, device, lookahead):
+        self.modules = modules
+        self.device = device
+        self.lookahead = lookahead
+        self.stream = torch.cuda.Stream(device)
+        slot_size = max(self.module_bytes(m) for m in modules)
+        #one more than the lookahead for the weights of the module that is running
+        self.slots = [[torch.empty(slot_size, dtype=torch.uint8, pin_memory=True), None] for _ in range(lookahead + 1)]
+        self.next_slot = 0
+        self.prefetched = {}
+        for i, m in enumerate(modules):
+            m.weight_streamer = self
+            m.weight_stream_index = i
+        self.last_index = len(modules)
+        #per pass stats, the events are only recorded with debug logging
+        self.timed = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.events = []
+        self.hits = 0
+        self.misses = 0
+        self.pass_start = None
+
+    @staticmethod
+    def module_bytes(m):
+        size = 0
+        for t in (m.weight, m.bias):
+            if t is not None:
+                size += (t.nelement() * t.element_size() + 63) // 64 * 64
+        return size
+
+    def stage(self, i):
+        m = self.modules[i]
+        slot = self.slots[self.next_slot]
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        if slot[1] is not None:
+            slot[1].synchronize() #the previous copy from this buffer has to be done before overwriting it
+
+        out = []
+        offset = 0
+        with torch.cuda.stream(self.stream):
+            start = None
+            if self.timed:
+                start = torch.cuda.Event(enable_timing=True)
+                start.record(self.stream)
+            for t in (m.weight, m.bias):
+                if t is None:
+                    out.append(None)
+                    continue
+                size = t.nelement() * t.element_size()
+                staging = slot[0][offset:offset + size].view(t.dtype).view(t.shape)
+                staging.copy_(t)
+                out.append(staging.to(self.device, non_blocking=True))
+                offset += (size + 63) // 64 * 64
+            end = torch.cuda.Event(enable_timing=self.timed)
+            end.record(self.stream)
+        slot[1] = end
+        return (out[0], out[1], start, end)
+
+    def pass_finished(self):
+        if self.pass_start is None:
+            return
+        if self.timed and len(self.events) > 0:
+            self.events[-1][3].synchronize()
+            copy_time = sum(e[0].elapsed_time(e[1]) for e in self.events)
+            stall_time = sum(e[2].elapsed_time(e[3]) for e in self.events)
+            overlap = 1.0 - stall_time / copy_time if copy_time > 0 else 1.0
+            logging.debug("lowvram streaming: {:.1f} ms pass, {:.1f} ms of weight copies, {:.1f} ms stalled waiting for them ({:.0%} overlapped), {}/{} modules prefetched".format(
+                (time.perf_counter() - self.pass_start) * 1000, copy_time, stall_time, overlap, self.hits, self.hits + self.misses))
+        self.events = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, s, dtype):
+        #weight and bias of module s on the device, called instead of copying them in ops.cast_bias_weight
+        i = s.weight_stream_index
+        if i <= self.last_index:
+            self.pass_finished()
+            self.pass_start = time.perf_counter()
+        self.last_index = i
+
+        entry = self.prefetched.pop(i, None)
+        if entry is None:
+            self.misses += 1
+            entry = self.stage(i)
+        else:
+            self.hits += 1
+        #drop the prefetched weights of the modules that were skipped
+        count = len(self.modules)
+        for k in list(self.prefetched.keys()):
+            if (k - i) % count > self.lookahead:
+                self.prefetched.pop(k)
+
+        weight, bias, start, end = entry
+        stream = torch.cuda.current_stream(self.device)
+        if self.timed:
+            wait_start = torch.cuda.Event(enable_timing=True)
+            wait_start.record(stream)
+        stream.wait_event(end)
+        if self.timed:
+            wait_end = torch.cuda.Event(enable_timing=True)
+            wait_end.record(stream)
+            self.events.append((start, end, wait_start, wait_end))
+        for t in (weight, bias):
+            if t is not None:
+                t.record_stream(stream) #allocated on the side stream but used on this one
+
+        for j in range(i + 1, i + 1 + self.lookahead):
+            j = j % count
+            if j != i and j not in self.prefetched:
+                self.prefetched[j] = self.stage(j)
+
+        if bias is not None:
+            bias = bias.to(dtype)
+        return weight.to(dtype), bias
+
+    def detach(self):
+        for m in self.modules:
+            m.weight_streamer = None
+        self.prefetched.clear()
+        self.slots = []
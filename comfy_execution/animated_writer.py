@@ -0,0 +1,138 @@
+import io
+import struct
+import zlib
+
+#Animated PNG and WEBP files written one frame at a time for the streaming save nodes. PIL only saves animations
+#from a list of all the frames, here each frame is encoded on its own with PIL and its compressed data is appended
+#to the file so only one frame is in memory. The frame count and the file size are filled in when it's closed.
+#Frames are always stored whole, without the inter frame optimizations of PIL so the files can be a bit larger.
+
+def png_chunks(data):
+    #(type, body) of the chunks of an encoded PNG file
+    offset = 8
+    while offset < len(data):
+        size, = struct.unpack(">I", data[offset:offset + 4])
+        yield data[offset + 4:offset + 8], data[offset + 8:offset + 8 + size]
+        offset += 12 + size
+
+def riff_chunks(data):
+    #(type, body) of the chunks of an encoded WEBP file, odd sized chunks are followed by a padding byte
+    offset = 12
+    while offset < len(data):
+        size, = struct.unpack("<I", data[offset + 4:offset + 8])
+        yield data[offset:offset + 4], data[offset + 8:offset + 8 + size]
+        offset += 8 + size + (size & 1)
+
+class APNGWriter:
+    def __init__(self, path, fps, compress_level=4, metadata=None):
+        #metadata: PngInfo, its chunks are written after the frames
+        self.file = open(path, "wb")
+        self.delay = int(1000.0 / fps)
+        self.compress_level = compress_level
+        self.metadata = metadata
+        self.frames = 0
+        self.sequence = 0
+        self.actl_offset = None
+
+    def write_chunk(self, chunk_type, body):
+        self.file.write(struct.pack(">I", len(body)) + chunk_type + body + struct.pack(">I", zlib.crc32(chunk_type + body) & 0xffffffff))
+
+    def next_sequence(self):
+        s = self.sequence
+        self.sequence += 1
+        return struct.pack(">I", s)
+
+    def add(self, image):
+        #image: a PIL image with the same size and mode as the first one
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", compress_level=self.compress_level)
+        chunks = list(png_chunks(buffer.getvalue()))
+        if self.frames == 0:
+            self.file.write(b"\x89PNG\r\n\x1a\n")
+            self.write_chunk(b"IHDR", chunks[0][1])
+            self.actl_offset = self.file.tell()
+            self.write_chunk(b"acTL", struct.pack(">II", 0, 0))
+            if self.metadata is not None:
+                for chunk in self.metadata.chunks:
+                    if len(chunk) < 3 or not chunk[2]:
+                        self.write_chunk(chunk[0], chunk[1])
+
+        width, height = struct.unpack(">II", chunks[0][1][:8])
+        self.write_chunk(b"fcTL", self.next_sequence() + struct.pack(">IIIIHHBB", width, height, 0, 0, self.delay, 1000, 0, 0))
+        for chunk_type, body in chunks:
+            if chunk_type == b"IDAT":
+                if self.frames == 0:
+                    self.write_chunk(b"IDAT", body)
+                else:
+                    self.write_chunk(b"fdAT", self.next_sequence() + body)
+        self.frames += 1
+
+    def close(self):
+        if self.frames > 0:
+            if self.metadata is not None:
+                for chunk in self.metadata.chunks:
+                    if len(chunk) >= 3 and chunk[2]:
+                        self.write_chunk(chunk[0], chunk[1])
+            self.write_chunk(b"IEND", b"")
+            self.file.seek(self.actl_offset)
+            self.write_chunk(b"acTL", struct.pack(">II", self.frames, 0))
+        self.file.close()
+
+class WEBPWriter:
+    def __init__(self, path, fps, lossless=True, quality=80, method=4, exif=None):
+        #exif: the bytes of the EXIF chunk (Image.Exif.tobytes())
+        self.file = open(path, "wb")
+        self.duration = int(1000.0 / fps)
+        self.options = {"lossless": lossless, "quality": quality, "method": method}
+        self.exif = exif
+        self.frames = 0
+        self.alpha = False
+        self.size = None
+        self.vp8x_offset = None
+
+    def write_chunk(self, chunk_type, body):
+        self.file.write(chunk_type + struct.pack("<I", len(body)) + body)
+        if len(body) & 1:
+            self.file.write(b"\x00")
+
+    def vp8x(self, width, height):
+        flags = 0x02 #animation
+        if self.alpha:
+            flags |= 0x10
+        if self.exif:
+            flags |= 0x08
+        return struct.pack("<I", flags) + struct.pack("<I", width - 1)[:3] + struct.pack("<I", height - 1)[:3]
+
+    def add(self, image):
+        buffer = io.BytesIO()
+        image.save(buffer, format="WEBP", **self.options)
+        frame = b""
+        for chunk_type, body in riff_chunks(buffer.getvalue()):
+            if chunk_type in (b"ALPH", b"VP8 ", b"VP8L"):
+                frame += chunk_type + struct.pack("<I", len(body)) + body + (b"\x00" if len(body) & 1 else b"")
+            if chunk_type == b"ALPH" or (chunk_type == b"VP8L" and image.mode == "RGBA"):
+                self.alpha = True
+
+        width, height = image.size
+        if self.frames == 0:
+            self.size = (width, height)
+            self.file.write(b"RIFF\x00\x00\x00\x00WEBP")
+            self.vp8x_offset = self.file.tell()
+            self.write_chunk(b"VP8X", self.vp8x(width, height))
+            self.write_chunk(b"ANIM", struct.pack("<IH", 0, 0))
+
+        header = struct.pack("<I", 0)[:3] * 2 + struct.pack("<I", width - 1)[:3] + struct.pack("<I", height - 1)[:3]
+        header += struct.pack("<I", self.duration)[:3] + b"\x02" #no blending, no disposal
+        self.write_chunk(b"ANMF", header + frame)
+        self.frames += 1
+
+    def close(self):
+        if self.frames > 0:
+            if self.exif:
+                self.write_chunk(b"EXIF", self.exif)
+            end = self.file.tell()
+            self.file.seek(4)
+            self.file.write(struct.pack("<I", end - 8))
+            self.file.seek(self.vp8x_offset)
+            self.write_chunk(b"VP8X", self.vp8x(*self.size))
+        self.file.close()
@@ -0,0 +1,82 @@
+import hashlib
+
+import nodes
+
+#Prompt coalescing (--coalesce-prompts): queued prompts that are the same graph and only differ in the inputs their
+#nodes list in COALESCE_INPUTS (seeds, prompt texts) are executed together. The nodes that don't depend on those
+#inputs run once, nodes with a BATCHED_FUNCTION (the samplers) run once for the whole group and everything else
+#runs once per prompt.
+
+def coalesced_inputs(class_def):
+    return getattr(class_def, "COALESCE_INPUTS", ())
+
+def coalesce_key(prompt, execute_outputs):
+    #Prompts with the same key can be executed together, None if the prompt has nothing that can be batched.
+    can_batch = False
+    structure = []
+    for unique_id in sorted(prompt):
+        node = prompt[unique_id]
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(node['class_type'], None)
+        if class_def is None:
+            return None
+        if hasattr(class_def, "BATCHED_FUNCTION"):
+            can_batch = True
+        varying = coalesced_inputs(class_def)
+        inputs = []
+        for x in sorted(node['inputs']):
+            value = node['inputs'][x]
+            if x in varying and not isinstance(value, list):
+                value = None
+            inputs.append((x, value))
+        structure.append((unique_id, node['class_type'], tuple(inputs)))
+
+    if not can_batch:
+        return None
+    m = hashlib.sha256()
+    m.update(repr((tuple(structure), tuple(sorted(execute_outputs)))).encode("utf-8"))
+    return m.hexdigest()
+
+def varying_nodes(prompts):
+    #nodes with a COALESCE_INPUTS value that isn't the same in every prompt
+    out = set()
+    for unique_id, node in prompts[0].items():
+        class_def = nodes.NODE_CLASS_MAPPINGS[node['class_type']]
+        for x in coalesced_inputs(class_def):
+            if x in node['inputs'] and any(p[unique_id]['inputs'].get(x, None) != node['inputs'][x] for p in prompts[1:]):
+                out.add(unique_id)
+                break
+    return out
+
+class BatchServer:
+    #Stands in for the server while executing a node for several prompts at once, the events are sent
+    #to the client of each of the prompts with their own prompt_id.
+    def __init__(self, server, targets):
+        #targets: list of (prompt_id, client_id)
+        self.server = server
+        self.targets = targets
+        self.client_id = None
+        for prompt_id, client_id in targets:
+            if client_id is not None:
+                self.client_id = client_id
+
+    @property
+    def last_node_id(self):
+        return self.server.last_node_id
+
+    @last_node_id.setter
+    def last_node_id(self, node_id):
+        self.server.last_node_id = node_id
+
+    def set_progress_target(self, node_id, targets):
+        #the progress and previews of the node go to every prompt of the batch
+        self.server.set_progress_target(node_id, [x for x in self.targets if x[1] is not None])
+
+    def send_sync(self, event, data, sid=None):
+        for prompt_id, client_id in self.targets:
+            if client_id is None:
+                continue
+            d = data
+            if isinstance(data, dict) and "prompt_id" in data:
+                d = dict(data)
+                d["prompt_id"] = prompt_id
+            self.server.send_sync(event, d, client_id)
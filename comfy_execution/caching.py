@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import math
+from collections import OrderedDict
+
+import torch
+import nodes
+
+def _is_nan(value):
+    if isinstance(value, float):
+        return math.isnan(value)
+    if isinstance(value, (list, tuple)):
+        return any(_is_nan(v) for v in value)
+    return False
+
+def node_signature(prompt, unique_id, signatures):
+    #Returns a hex digest identifying the outputs of this node by content instead of by node id:
+    #class_type, literal inputs, IS_CHANGED results and the signatures of the linked upstream nodes.
+    #The upstream signatures have to already be in signatures (see compute_signatures).
+    #None means the outputs of the node can't be shared (IS_CHANGED failed or returned NaN upstream).
+    node = prompt[unique_id]
+    class_type = node['class_type']
+    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+
+    if hasattr(class_def, 'IS_CHANGED'):
+        if 'is_changed' not in node:
+            return None
+        is_changed = node['is_changed']
+        if _is_nan(is_changed):
+            return None
+    else:
+        is_changed = None
+
+    inputs = []
+    for x in sorted(node['inputs']):
+        input_data = node['inputs'][x]
+        if isinstance(input_data, list):
+            upstream = signatures.get(input_data[0], None)
+            if upstream is None:
+                return None
+            inputs.append((x, ("link", upstream, input_data[1])))
+        else:
+            inputs.append((x, input_data))
+
+    #nodes that are told their own id may behave differently depending on it
+    node_id = None
+    hidden = class_def.INPUT_TYPES().get("hidden", {})
+    if "UNIQUE_ID" in hidden.values():
+        node_id = unique_id
+
+    m = hashlib.sha256()
+    m.update(repr((class_type, node_id, tuple(inputs), is_changed)).encode("utf-8"))
+    return m.hexdigest()
+
+def compute_signatures(prompt, graph):
+    signatures = {}
+    for unique_id in graph.topological_sort(prompt):
+        signatures[unique_id] = node_signature(prompt, unique_id, signatures)
+    return signatures
+
+def output_memory_usage(outputs):
+    #Estimate of the (ram, vram) bytes kept alive by a node output.
+    ram = 0
+    vram = 0
+    seen = set()
+    to_check = [outputs]
+    while len(to_check) > 0:
+        o = to_check.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+
+        if isinstance(o, torch.Tensor):
+            size = o.nelement() * o.element_size()
+            if o.device.type == "cpu":
+                ram += size
+            else:
+                vram += size
+        elif isinstance(o, (list, tuple)):
+            to_check.extend(o)
+        elif isinstance(o, dict):
+            to_check.extend(o.values())
+        elif hasattr(o, "patcher"): #CLIP, VAE
+            to_check.append(o.patcher)
+        elif hasattr(o, "model_size") and hasattr(o, "current_device"): #ModelPatcher
+            if id(o.model) in seen:
+                continue
+            seen.add(id(o.model))
+            if o.current_device is not None and torch.device(o.current_device).type != "cpu":
+                vram += o.model_size()
+            else:
+                ram += o.model_size()
+    return ram, vram
+
+class OutputCache:
+    #LRU cache of node outputs keyed by node_signature so that identical subgraphs get reused
+    #across prompts and node ids. A limit of 0 means no limit for the byte budgets.
+    def __init__(self, max_entries=0, max_ram=0, max_vram=0):
+        self.max_entries = max_entries
+        self.max_ram = max_ram
+        self.max_vram = max_vram
+        self.entries = OrderedDict()
+        self.ram_used = 0
+        self.vram_used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.max_entries > 0
+
+    def __contains__(self, signature):
+        return signature in self.entries
+
+    def get(self, signature):
+        if signature not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(signature)
+        outputs, ui, _, _ = self.entries[signature]
+        return outputs, ui
+
+    def set(self, signature, outputs, ui):
+        if not self.enabled():
+            return
+        self.pop(signature)
+        ram, vram = output_memory_usage(outputs)
+        if (self.max_ram > 0 and ram > self.max_ram) or (self.max_vram > 0 and vram > self.max_vram):
+            logging.debug("output too large to be cached {} {}".format(ram, vram))
+            return
+
+        self.entries[signature] = (outputs, ui, ram, vram)
+        self.ram_used += ram
+        self.vram_used += vram
+        self.evict()
+
+    def pop(self, signature):
+        entry = self.entries.pop(signature, None)
+        if entry is not None:
+            self.ram_used -= entry[2]
+            self.vram_used -= entry[3]
+
+    def over_budget(self):
+        if len(self.entries) > self.max_entries:
+            return True
+        if self.max_ram > 0 and self.ram_used > self.max_ram:
+            return True
+        if self.max_vram > 0 and self.vram_used > self.max_vram:
+            return True
+        return False
+
+    def evict(self):
+        while len(self.entries) > 0 and self.over_budget():
+            self.pop(next(iter(self.entries)))
+
+    def clear(self):
+        self.entries.clear()
+        self.ram_used = 0
+        self.vram_used = 0
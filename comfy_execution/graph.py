@@ -0,0 +1,133 @@
+import collections
+import heapq
+
+class DependencyCycleError(Exception):
+    pass
+
+class ExecutionGraph:
+    #Explicit DAG of a prompt built once so that nothing has to walk the links with python recursion.
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.upstream = {}
+        self.downstream = {}
+        for unique_id in prompt:
+            self.upstream[unique_id] = []
+            self.downstream[unique_id] = []
+
+        for unique_id, node in prompt.items():
+            upstream = self.upstream[unique_id]
+            for input_data in node.get('inputs', {}).values():
+                if isinstance(input_data, list) and len(input_data) == 2 and isinstance(input_data[0], (str, int)):
+                    input_unique_id = input_data[0]
+                    if input_unique_id in self.downstream and input_unique_id not in upstream:
+                        upstream.append(input_unique_id)
+                        self.downstream[input_unique_id].append(unique_id)
+
+    def ancestors(self, unique_id, outputs):
+        #Nodes that have to run before unique_id can be executed including itself, nodes already in outputs are skipped.
+        #The order is the depth first post order the old recursive executor used.
+        order = []
+        if unique_id in outputs:
+            return order
+
+        visited = set([unique_id])
+        stack = [(unique_id, iter(self.upstream[unique_id]))]
+        while len(stack) > 0:
+            current, upstream = stack[-1]
+            for input_unique_id in upstream:
+                if input_unique_id not in visited and input_unique_id not in outputs:
+                    visited.add(input_unique_id)
+                    stack.append((input_unique_id, iter(self.upstream[input_unique_id])))
+                    break
+            else:
+                stack.pop()
+                order.append(current)
+        return order
+
+    def descendants(self, node_ids):
+        #node_ids and every node that depends on one of them
+        found = set(node_ids)
+        to_visit = list(found)
+        while len(to_visit) > 0:
+            for output_unique_id in self.downstream[to_visit.pop()]:
+                if output_unique_id not in found:
+                    found.add(output_unique_id)
+                    to_visit.append(output_unique_id)
+        return found
+
+    def topological_sort(self, node_ids, key=None):
+        #Kahn's algorithm, when several nodes are ready the one with the smallest key runs first.
+        #Nodes that are part of a cycle can never become ready and are left out of the result.
+        in_degree = {}
+        for unique_id in node_ids:
+            in_degree[unique_id] = 0
+        for unique_id in in_degree:
+            for input_unique_id in self.upstream[unique_id]:
+                if input_unique_id in in_degree:
+                    in_degree[unique_id] += 1
+
+        if key is None:
+            position = {}
+            for i, unique_id in enumerate(self.prompt):
+                position[unique_id] = i
+            key = position.get
+
+        ready = [(key(unique_id), unique_id) for unique_id, degree in in_degree.items() if degree == 0]
+        heapq.heapify(ready)
+        order = []
+        while len(ready) > 0:
+            _, unique_id = heapq.heappop(ready)
+            order.append(unique_id)
+            for output_unique_id in self.downstream[unique_id]:
+                if output_unique_id in in_degree:
+                    in_degree[output_unique_id] -= 1
+                    if in_degree[output_unique_id] == 0:
+                        heapq.heappush(ready, (key(output_unique_id), output_unique_id))
+        return order
+
+    def execution_order(self, execute_outputs, outputs):
+        #Computed once per prompt: the output that depends on the least amount of unexecuted nodes goes first
+        #and the nodes of each output are executed in the same depth first order as before.
+        execute_outputs = list(dict.fromkeys(execute_outputs))
+        pending = set()
+        visited = set(outputs)
+        for output_unique_id in execute_outputs:
+            needed = self.ancestors(output_unique_id, visited)
+            pending.update(needed)
+            visited.update(needed)
+
+        order = self.topological_sort(pending)
+        if len(order) != len(pending):
+            in_cycle = sorted(pending - set(order))
+            raise DependencyCycleError("Dependency cycle detected between nodes: {}".format(", ".join(map(str, in_cycle))))
+
+        #bit i of dependent_outputs[x] is set when execute_outputs[i] needs x, one pass from the outputs upwards
+        output_bits = {}
+        for i, output_unique_id in enumerate(execute_outputs):
+            output_bits[output_unique_id] = 1 << i
+        dependent_outputs = {}
+        for unique_id in reversed(order):
+            mask = output_bits.get(unique_id, 0)
+            for output_unique_id in self.downstream[unique_id]:
+                mask |= dependent_outputs.get(output_unique_id, 0)
+            dependent_outputs[unique_id] = mask
+
+        counts = [0] * len(execute_outputs)
+        for mask, count in collections.Counter(dependent_outputs.values()).items():
+            i = 0
+            while mask:
+                if mask & 1:
+                    counts[i] += count
+                mask >>= 1
+                i += 1
+
+        priority = {}
+        scheduled = set(outputs)
+        ranked = sorted(range(len(execute_outputs)), key=lambda i: (counts[i], execute_outputs[i]))
+        for rank, i in enumerate(ranked):
+            needed = self.ancestors(execute_outputs[i], scheduled)
+            for position, unique_id in enumerate(needed):
+                priority[unique_id] = (rank, position)
+            scheduled.update(needed)
+
+        return self.topological_sort(priority, key=priority.get)
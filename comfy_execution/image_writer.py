@@ -0,0 +1,135 @@
+import os
+import threading
+import logging
+import concurrent.futures
+
+import numpy as np
+from PIL import Image
+
+import folder_paths
+from comfy.cli_args import args
+
+def image_to_uint8(image):
+    i = 255. * image.cpu().numpy()
+    return np.clip(i, 0, 255).astype(np.uint8)
+
+def encode_png(pixels, path, metadata, compress_level):
+    img = Image.fromarray(pixels)
+    img.save(path, pnginfo=metadata, compress_level=compress_level)
+
+class ImageWriter:
+    #Encodes and writes the images of the save nodes on background threads so the next node or prompt can start.
+    #With 0 workers everything is written inline like before. Counters handed out by get_save_image_path account
+    #for the files that are still pending so the filenames are the same as when saving synchronously.
+    def __init__(self, workers=0, max_memory=0):
+        self.pool = None
+        if workers > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image_writer")
+        #runs the flush callbacks one after the other so prompts are reported as done in order
+        self.completion_pool = None
+        self.max_memory = max_memory
+        self.memory_in_flight = 0
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.reserved_counters = {}
+
+    def get_save_image_path(self, filename_prefix, output_dir, image_width=0, image_height=0, reserve=0):
+        #same as folder_paths.get_save_image_path but skips the counters of the files that haven't been written yet
+        #reserve: how many counters the caller is going to use for files written with save_png, the ones it doesn't
+        #end up passing to save_png have to be given back with release_counter
+        with self.lock:
+            full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, output_dir, image_width, image_height)
+            key = (full_output_folder, filename)
+            if key in self.reserved_counters:
+                next_counter, pending = self.reserved_counters[key]
+                counter = max(counter, next_counter)
+            else:
+                pending = 0
+            if reserve > 0:
+                self.reserved_counters[key] = (counter + reserve, pending + reserve)
+            return full_output_folder, filename, counter, subfolder, filename_prefix
+
+    def release_counter(self, key, count=1):
+        with self.lock:
+            if key not in self.reserved_counters or count <= 0:
+                return
+            next_counter, pending = self.reserved_counters[key]
+            if pending <= count:
+                self.reserved_counters.pop(key)
+            else:
+                self.reserved_counters[key] = (next_counter, pending - count)
+
+    def save_png(self, image, full_output_folder, filename, file, metadata=None, compress_level=4):
+        #full_output_folder and filename are the values get_save_image_path returned when reserving the counter,
+        #the counter is released when the file is written or if it fails
+        key = (full_output_folder, filename)
+        path = os.path.normpath(os.path.abspath(os.path.join(full_output_folder, file)))
+        if self.pool is None:
+            try:
+                encode_png(image_to_uint8(image), path, metadata, compress_level)
+            finally:
+                self.release_counter(key)
+            return
+
+        try:
+            #queued as 8 bit pixels on the cpu so the memory held is what the limit counts and not a device tensor
+            pixels = image_to_uint8(image)
+        except:
+            self.release_counter(key)
+            raise
+        size = pixels.nbytes
+        with self.lock:
+            #bound the memory held by queued images, a single image larger than the limit still goes through
+            while self.memory_in_flight > 0 and self.memory_in_flight + size > self.max_memory > 0:
+                self.lock.wait()
+            try:
+                future = self.pool.submit(encode_png, pixels, path, metadata, compress_level)
+            except:
+                self.release_counter(key)
+                raise
+            self.memory_in_flight += size
+            self.pending[path] = future
+
+        def done(future):
+            with self.lock:
+                self.memory_in_flight -= size
+                if self.pending.get(path, None) is future:
+                    self.pending.pop(path)
+                self.lock.notify_all()
+            self.release_counter(key)
+            if future.exception() is not None:
+                logging.error("Error saving image {}: {}".format(path, future.exception()))
+
+        future.add_done_callback(done)
+
+    def pending_file(self, path):
+        #future of the write of this file if it hasn't finished yet
+        with self.lock:
+            return self.pending.get(os.path.normpath(os.path.abspath(path)), None)
+
+    def flush(self):
+        with self.lock:
+            futures = list(self.pending.values())
+        concurrent.futures.wait(futures)
+
+    def run_when_flushed(self, function):
+        #calls function once every image queued until now has been written
+        if self.pool is None:
+            function()
+            return
+
+        with self.lock:
+            futures = list(self.pending.values())
+            if self.completion_pool is None:
+                self.completion_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="image_writer_done")
+
+        def wait_and_run():
+            concurrent.futures.wait(futures)
+            try:
+                function()
+            except Exception as e:
+                logging.error("Error after flushing images: {}".format(e))
+
+        self.completion_pool.submit(wait_and_run)
+
+writer = ImageWriter(args.async_image_save, int(args.async_image_save_max_memory * 1024 * 1024))
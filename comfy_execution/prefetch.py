@@ -0,0 +1,64 @@
+import logging
+import threading
+
+import torch
+
+import nodes
+import comfy.model_cache
+
+class ModelPrefetcher:
+    #Loads the models of the next queued prompts into comfy.model_cache on a background thread so their loaders
+    #get them from RAM instead of reading and building them while the prompt runs. Only nodes with PREFETCH = True
+    #are run, those are loaders that go through the model cache and only take widget values.
+    def __init__(self, prompt_queue, lookahead=1):
+        self.prompt_queue = prompt_queue
+        self.lookahead = lookahead
+        self.event = threading.Event()
+        #loads already done for the prompts currently in the lookahead window
+        self.done = set()
+        threading.Thread(target=self.run, daemon=True, name="model_prefetch").start()
+
+    def notify(self):
+        self.event.set()
+
+    def pending_loads(self):
+        with self.prompt_queue.mutex:
+            queued = sorted(self.prompt_queue.queue)[:self.lookahead]
+
+        loads = {}
+        for item in queued:
+            prompt = item[2]
+            for unique_id in prompt:
+                class_type = prompt[unique_id]['class_type']
+                class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+                if class_def is None or not getattr(class_def, "PREFETCH", False):
+                    continue
+                inputs = prompt[unique_id]['inputs']
+                if any(isinstance(v, list) for v in inputs.values()): #linked inputs aren't known before execution
+                    continue
+                key = (class_type, repr(sorted(inputs.items())))
+                if key not in loads:
+                    loads[key] = (class_def, inputs)
+        return loads
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            if not comfy.model_cache.cache.enabled():
+                continue
+
+            loads = self.pending_loads()
+            self.done &= set(loads.keys())
+            for key, (class_def, inputs) in loads.items():
+                if key in self.done:
+                    continue
+                self.done.add(key)
+                obj = class_def()
+                function = getattr(obj, class_def.FUNCTION)
+                try:
+                    with torch.inference_mode(): #inference mode is thread local
+                        comfy.model_cache.cache.prefetch(lambda: function(**inputs))
+                    logging.debug("prefetched {} {}".format(key[0], key[1]))
+                except Exception as e:
+                    logging.warning("model prefetch of {} failed: {}".format(key[0], e))
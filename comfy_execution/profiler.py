@@ -0,0 +1,94 @@
+import time
+import threading
+
+import torch
+import comfy.model_management
+
+class PromptProfiler:
+    #Per node records of one prompt execution. Wall time, cache status and list iterations are always recorded.
+    #With detailed=True the device is synchronized around each node to get the CUDA time and the peak memory,
+    #this stalls the GPU queue so it is only done when asked for (--profile-nodes).
+    def __init__(self, detailed=False):
+        self.device = None
+        if detailed:
+            device = comfy.model_management.get_torch_device()
+            if comfy.model_management.is_device_cuda(device):
+                self.device = device
+        self.start_time = time.perf_counter()
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def node_started(self, synchronize=True):
+        #synchronize=False for nodes running on the worker pool, the device and the memory stats are shared
+        #between threads so they would only measure the nodes running next to them
+        state = {"iterations": 0}
+        if self.device is not None and synchronize:
+            torch.cuda.synchronize(self.device)
+            state["memory"] = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        state["start"] = time.perf_counter()
+        return state
+
+    def node_finished(self, node_id, class_type, state):
+        end = time.perf_counter()
+        record = {
+            "node_id": node_id,
+            "class_type": class_type,
+            "cache": "miss",
+            "start": state["start"] - self.start_time,
+            "wall_time": end - state["start"],
+            "cuda_time": None,
+            "peak_memory_delta": None,
+            "iterations": state["iterations"],
+            "thread": threading.current_thread().name,
+        }
+        if "memory" in state:
+            torch.cuda.synchronize(self.device)
+            record["cuda_time"] = time.perf_counter() - state["start"]
+            record["peak_memory_delta"] = torch.cuda.max_memory_allocated(self.device) - state["memory"]
+        with self.lock:
+            self.records[node_id] = record
+
+    def node_cached(self, node_id, class_type):
+        with self.lock:
+            self.records[node_id] = {
+                "node_id": node_id,
+                "class_type": class_type,
+                "cache": "hit",
+                "start": time.perf_counter() - self.start_time,
+                "wall_time": 0.0,
+                "cuda_time": None,
+                "peak_memory_delta": None,
+                "iterations": 0,
+                "thread": threading.current_thread().name,
+            }
+
+    def get_records(self):
+        with self.lock:
+            return sorted(self.records.values(), key=lambda r: r["start"])
+
+def chrome_trace(records):
+    #Trace Event Format that chrome://tracing and ui.perfetto.dev can open, one row per thread.
+    events = []
+    thread_ids = {}
+    for r in records:
+        if r["thread"] not in thread_ids:
+            thread_ids[r["thread"]] = len(thread_ids)
+            events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": thread_ids[r["thread"]], "args": {"name": r["thread"]}})
+
+        event = {
+            "name": "{} #{}".format(r["class_type"], r["node_id"]),
+            "cat": "cached" if r["cache"] == "hit" else "node",
+            "pid": 0,
+            "tid": thread_ids[r["thread"]],
+            "ts": r["start"] * 1000000,
+            "args": {k: r[k] for k in ("node_id", "cache", "cuda_time", "peak_memory_delta", "iterations")},
+        }
+        if r["cache"] == "hit":
+            event["ph"] = "i"
+            event["s"] = "t"
+        else:
+            event["ph"] = "X"
+            event["dur"] = r["wall_time"] * 1000000
+        events.append(event)
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
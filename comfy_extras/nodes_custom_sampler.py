@@ -5,6 +5,8 @@ import latent_preview
 import torch
 import comfy.utils
 import node_helpers
+import logging
+import math
 
 
 class BasicScheduler:
@@ -428,6 +430,101 @@ class CFGGuider:
         guider.set_cfg(cfg)
         return (guider,)
 
+class Guider_AcceleratedCFG(comfy.samplers.CFGGuider):
+    #CFG that doesn't run the negative on every model call: the difference between the positive and negative
+    #predictions is only recomputed every uncond_interval calls and reused in between on top of the fresh positive
+    #prediction, and after skip_uncond_percent of the schedule the negative is dropped (cfg 1).
+    #The sampler_post_cfg_function hooks (SAG...) only run on the calls that evaluate the negative, on the reused
+    #calls the uncond_denoised they would get is extrapolated and the state they keep from the negative model call
+    #is from an earlier step.
+    uncond_interval = 1
+    skip_uncond_percent = 1.0
+
+    def set_schedule(self, uncond_interval=1, skip_uncond_percent=1.0):
+        self.uncond_interval = max(1, uncond_interval)
+        self.skip_uncond_percent = skip_uncond_percent
+
+    def set_sigmas(self, sigmas):
+        #the step from which the negative is dropped, computed on the host from the schedule before sampling so
+        #predict_noise doesn't have to read the timestep back from the device
+        self.step = 0
+        self.skip_uncond_step = len(sigmas)
+        if self.skip_uncond_percent < 1.0:
+            skip_uncond_sigma = self.inner_model.model_sampling.percent_to_sigma(self.skip_uncond_percent)
+            for i, sigma in enumerate(sigmas.tolist()):
+                if sigma <= skip_uncond_sigma:
+                    self.skip_uncond_step = i
+                    break
+
+    def inner_sample(self, noise, latent_image, device, sampler, sigmas, denoise_mask, callback, disable_pbar, seed):
+        self.calls = 0
+        self.uncond_saved = 0
+        self.guidance_delta = None
+        self.set_sigmas(sigmas)
+
+        def step_callback(step, x0, x, total_steps):
+            self.step = step + 1
+            if callback is not None:
+                callback(step, x0, x, total_steps)
+
+        try:
+            return super().inner_sample(noise, latent_image, device, sampler, sigmas, denoise_mask, step_callback, disable_pbar, seed)
+        finally:
+            if self.calls > 0:
+                logging.info("accelerated cfg: skipped {} of {} negative model evaluations".format(self.uncond_saved, self.calls))
+            self.guidance_delta = None
+
+    def predict_noise(self, x, timestep, model_options={}, seed=None):
+        negative_cond = self.conds.get("negative", None)
+        positive_cond = self.conds.get("positive", None)
+        if negative_cond is None or math.isclose(self.cfg, 1.0):
+            return super().predict_noise(x, timestep, model_options=model_options, seed=seed)
+
+        call = self.calls
+        self.calls += 1
+        if self.step >= self.skip_uncond_step:
+            self.uncond_saved += 1
+            out = comfy.samplers.calc_cond_batch(self.inner_model, [positive_cond, None], x, timestep, model_options)
+            return comfy.samplers.cfg_function(self.inner_model, out[0], out[1], 1.0, x, timestep, model_options=model_options, cond=positive_cond, uncond=None)
+
+        delta = self.guidance_delta
+        if call % self.uncond_interval == 0 or delta is None or delta.shape != x.shape:
+            out = comfy.samplers.calc_cond_batch(self.inner_model, [positive_cond, negative_cond], x, timestep, model_options)
+            cond_pred, uncond_pred = out
+            self.guidance_delta = cond_pred - uncond_pred
+        else:
+            self.uncond_saved += 1
+            out = comfy.samplers.calc_cond_batch(self.inner_model, [positive_cond, None], x, timestep, model_options)
+            cond_pred = out[0]
+            uncond_pred = cond_pred - delta
+            model_options = {k: v for k, v in model_options.items() if k != "sampler_post_cfg_function"}
+        return comfy.samplers.cfg_function(self.inner_model, cond_pred, uncond_pred, self.cfg, x, timestep, model_options=model_options, cond=positive_cond, uncond=negative_cond)
+
+class AcceleratedCFGGuider:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"model": ("MODEL",),
+                    "positive": ("CONDITIONING", ),
+                    "negative": ("CONDITIONING", ),
+                    "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0, "step":0.1, "round": 0.01}),
+                    "uncond_interval": ("INT", {"default": 2, "min": 1, "max": 100}),
+                    "skip_uncond_percent": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01}),
+                     }
+                }
+
+    RETURN_TYPES = ("GUIDER",)
+
+    FUNCTION = "get_guider"
+    CATEGORY = "sampling/custom_sampling/guiders"
+
+    def get_guider(self, model, positive, negative, cfg, uncond_interval, skip_uncond_percent):
+        guider = Guider_AcceleratedCFG(model)
+        guider.set_conds(positive, negative)
+        guider.set_cfg(cfg)
+        guider.set_schedule(uncond_interval, skip_uncond_percent)
+        return (guider,)
+
 class Guider_DualCFG(comfy.samplers.CFGGuider):
     def set_cfg(self, cfg1, cfg2):
         self.cfg1 = cfg1
@@ -604,6 +701,7 @@ NODE_CLASS_MAPPINGS = {
 
     "CFGGuider": CFGGuider,
     "DualCFGGuider": DualCFGGuider,
+    "AcceleratedCFGGuider": AcceleratedCFGGuider,
     "BasicGuider": BasicGuider,
     "RandomNoise": RandomNoise,
     "DisableNoise": DisableNoise,
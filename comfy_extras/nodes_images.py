@@ -1,5 +1,7 @@
 import nodes
 import folder_paths
+import comfy_execution.image_writer
+import comfy_execution.animated_writer
 from comfy.cli_args import args
 
 from PIL import Image
@@ -98,7 +100,7 @@ class SaveAnimatedWEBP:
     def save_images(self, images, fps, filename_prefix, lossless, quality, method, num_frames=0, prompt=None, extra_pnginfo=None):
         method = self.methods.get(method)
         filename_prefix += self.prefix_append
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        full_output_folder, filename, counter, subfolder, filename_prefix = comfy_execution.image_writer.writer.get_save_image_path(filename_prefix, self.output_dir, images.shape[2], images.shape[1])
         results = list()
         pil_images = []
         for image in images:
@@ -159,7 +161,7 @@ class SaveAnimatedPNG:
 
     def save_images(self, images, fps, compress_level, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
         filename_prefix += self.prefix_append
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        full_output_folder, filename, counter, subfolder, filename_prefix = comfy_execution.image_writer.writer.get_save_image_path(filename_prefix, self.output_dir, images.shape[2], images.shape[1])
         results = list()
         pil_images = []
         for image in images:
@@ -186,10 +188,97 @@ class SaveAnimatedPNG:
 
         return { "ui": { "images": results, "animated": (True,)} }
 
+def tensor_to_pil(image):
+    i = 255. * image.cpu().numpy()
+    return Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+
+class SaveAnimatedWEBPStream(SaveAnimatedWEBP):
+    #encodes each frame as soon as the stream yields it instead of collecting all of them first
+    @classmethod
+    def INPUT_TYPES(s):
+        inputs = super().INPUT_TYPES()
+        inputs["required"]["images"] = ("IMAGE_STREAM", )
+        return inputs
+
+    def save_images(self, images, fps, filename_prefix, lossless, quality, method, num_frames=0, prompt=None, extra_pnginfo=None):
+        method = self.methods.get(method)
+        filename_prefix += self.prefix_append
+        full_output_folder, filename, counter, subfolder, filename_prefix = comfy_execution.image_writer.writer.get_save_image_path(filename_prefix, self.output_dir, images.shape[2], images.shape[1])
+        results = list()
+
+        metadata = Image.Exif()
+        if not args.disable_metadata:
+            if prompt is not None:
+                metadata[0x0110] = "prompt:{}".format(json.dumps(prompt))
+            if extra_pnginfo is not None:
+                inital_exif = 0x010f
+                for x in extra_pnginfo:
+                    metadata[inital_exif] = "{}:{}".format(x, json.dumps(extra_pnginfo[x]))
+                    inital_exif -= 1
+        exif = metadata.tobytes() if len(metadata) > 0 else None
+
+        if num_frames == 0:
+            num_frames = len(images)
+
+        writer = None
+        try:
+            for i, image in enumerate(images):
+                if i % num_frames == 0:
+                    if writer is not None:
+                        writer.close()
+                    file = f"{filename}_{counter:05}_.webp"
+                    writer = comfy_execution.animated_writer.WEBPWriter(os.path.join(full_output_folder, file), fps, lossless=lossless, quality=quality, method=method, exif=exif)
+                    results.append({
+                        "filename": file,
+                        "subfolder": subfolder,
+                        "type": self.type
+                    })
+                    counter += 1
+                writer.add(tensor_to_pil(image))
+        finally:
+            if writer is not None:
+                writer.close()
+
+        animated = num_frames != 1
+        return { "ui": { "images": results, "animated": (animated,) } }
+
+class SaveAnimatedPNGStream(SaveAnimatedPNG):
+    #encodes each frame as soon as the stream yields it instead of collecting all of them first
+    @classmethod
+    def INPUT_TYPES(s):
+        inputs = super().INPUT_TYPES()
+        inputs["required"]["images"] = ("IMAGE_STREAM", )
+        return inputs
+
+    def save_images(self, images, fps, compress_level, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
+        filename_prefix += self.prefix_append
+        full_output_folder, filename, counter, subfolder, filename_prefix = comfy_execution.image_writer.writer.get_save_image_path(filename_prefix, self.output_dir, images.shape[2], images.shape[1])
+
+        metadata = None
+        if not args.disable_metadata:
+            metadata = PngInfo()
+            if prompt is not None:
+                metadata.add(b"comf", "prompt".encode("latin-1", "strict") + b"\0" + json.dumps(prompt).encode("latin-1", "strict"), after_idat=True)
+            if extra_pnginfo is not None:
+                for x in extra_pnginfo:
+                    metadata.add(b"comf", x.encode("latin-1", "strict") + b"\0" + json.dumps(extra_pnginfo[x]).encode("latin-1", "strict"), after_idat=True)
+
+        file = f"{filename}_{counter:05}_.png"
+        writer = comfy_execution.animated_writer.APNGWriter(os.path.join(full_output_folder, file), fps, compress_level=compress_level, metadata=metadata)
+        try:
+            for image in images:
+                writer.add(tensor_to_pil(image))
+        finally:
+            writer.close()
+
+        return { "ui": { "images": [{"filename": file, "subfolder": subfolder, "type": self.type}], "animated": (True,)} }
+
 NODE_CLASS_MAPPINGS = {
     "ImageCrop": ImageCrop,
     "RepeatImageBatch": RepeatImageBatch,
     "ImageFromBatch": ImageFromBatch,
     "SaveAnimatedWEBP": SaveAnimatedWEBP,
     "SaveAnimatedPNG": SaveAnimatedPNG,
+    "SaveAnimatedWEBPStream": SaveAnimatedWEBPStream,
+    "SaveAnimatedPNGStream": SaveAnimatedPNGStream,
 }
@@ -56,6 +56,7 @@ class LatentCompositeMasked:
         }
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "composite"
+    CPU_THREAD_SAFE = True
 
     CATEGORY = "latent"
 
@@ -83,6 +84,7 @@ class ImageCompositeMasked:
         }
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "composite"
+    CPU_THREAD_SAFE = True
 
     CATEGORY = "image"
 
@@ -104,6 +106,7 @@ class MaskToImage:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "mask_to_image"
+    CPU_THREAD_SAFE = True
 
     def mask_to_image(self, mask):
         result = mask.reshape((-1, 1, mask.shape[-2], mask.shape[-1])).movedim(1, -1).expand(-1, -1, -1, 3)
@@ -123,6 +126,7 @@ class ImageToMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "image_to_mask"
+    CPU_THREAD_SAFE = True
 
     def image_to_mask(self, image, channel):
         channels = ["red", "green", "blue", "alpha"]
@@ -143,6 +147,7 @@ class ImageColorToMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "image_to_mask"
+    CPU_THREAD_SAFE = True
 
     def image_to_mask(self, image, color):
         temp = (torch.clamp(image, 0, 1.0) * 255.0).round().to(torch.int)
@@ -166,6 +171,7 @@ class SolidMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "solid"
+    CPU_THREAD_SAFE = True
 
     def solid(self, value, width, height):
         out = torch.full((1, height, width), value, dtype=torch.float32, device="cpu")
@@ -185,6 +191,7 @@ class InvertMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "invert"
+    CPU_THREAD_SAFE = True
 
     def invert(self, mask):
         out = 1.0 - mask
@@ -208,6 +215,7 @@ class CropMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "crop"
+    CPU_THREAD_SAFE = True
 
     def crop(self, mask, x, y, width, height):
         mask = mask.reshape((-1, mask.shape[-2], mask.shape[-1]))
@@ -232,6 +240,7 @@ class MaskComposite:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "combine"
+    CPU_THREAD_SAFE = True
 
     def combine(self, destination, source, x, y, operation):
         output = destination.reshape((-1, destination.shape[-2], destination.shape[-1])).clone()
@@ -279,6 +288,7 @@ class FeatherMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "feather"
+    CPU_THREAD_SAFE = True
 
     def feather(self, mask, left, top, right, bottom):
         output = mask.reshape((-1, mask.shape[-2], mask.shape[-1])).clone()
@@ -322,6 +332,7 @@ class GrowMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "expand_mask"
+    CPU_THREAD_SAFE = True
 
     def expand_mask(self, mask, expand, tapered_corners):
         c = 0 if tapered_corners else 1
@@ -355,6 +366,7 @@ class ThresholdMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "image_to_mask"
+    CPU_THREAD_SAFE = True
 
     def image_to_mask(self, mask, value):
         mask = (mask > value).float()
@@ -3,14 +3,23 @@ import copy
 import logging
 import threading
 import heapq
+import collections
+import time
+import concurrent.futures
 import traceback
 import inspect
 from typing import List, Literal, NamedTuple, Optional
 
 import torch
 import nodes
+import latent_preview
 
 import comfy.model_management
+from comfy.cli_args import args
+import comfy_execution.batching
+import comfy_execution.caching
+import comfy_execution.graph
+import comfy_execution.profiler
 
 def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_data={}):
     valid_inputs = class_def.INPUT_TYPES()
@@ -74,6 +83,12 @@ def map_node_over_list(obj, input_data_all, func, allow_interrupt=False):
             results.append(getattr(obj, func)(**slice_dict(input_data_all, i)))
     return results
 
+def get_list_length(obj, input_data_all):
+    #how many times map_node_over_list calls the node function
+    if getattr(obj, "INPUT_IS_LIST", False) or len(input_data_all) == 0:
+        return 1
+    return max([len(x) for x in input_data_all.values()])
+
 def get_output_data(obj, input_data_all):
     
     results = []
@@ -116,7 +131,9 @@ def format_value(x):
     else:
         return str(x)
 
-def recursive_execute(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage):
+def execute_node(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage, profile=None, prompt_thread=True):
+    #the outputs of the linked nodes must already be in outputs, see ExecutionGraph.execution_order
+    #prompt_thread=False for the nodes running on the worker pool, they don't change the node the client shows as executing
     unique_id = current_item
     inputs = prompt[unique_id]['inputs']
     class_type = prompt[unique_id]['class_type']
@@ -124,18 +141,6 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
     if unique_id in outputs:
         return (True, None, None)
 
-    for x in inputs:
-        input_data = inputs[x]
-
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                result = recursive_execute(server, prompt, outputs, input_unique_id, extra_data, executed, prompt_id, outputs_ui, object_storage)
-                if result[0] is not True:
-                    # Another node failed further upstream
-                    return result
-
     input_data_all = None
     try:
         input_data_all = get_input_data(inputs, class_def, unique_id, outputs, prompt, extra_data)
@@ -143,7 +148,8 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
         if server is None:
             print(f"executing node {unique_id}, prompt_id: {prompt_id}")
         else:
-            if server.client_id is not None:
+            server.set_progress_target(unique_id, [(prompt_id, server.client_id)])
+            if prompt_thread and server.client_id is not None:
                 server.last_node_id = unique_id
                 server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, server.client_id)
 
@@ -152,7 +158,12 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
             obj = class_def()
             object_storage[(unique_id, class_type)] = obj
 
-        output_data, output_ui = get_output_data(obj, input_data_all)
+        if profile is not None:
+            profile["iterations"] = get_list_length(obj, input_data_all)
+        try:
+            output_data, output_ui = get_output_data(obj, input_data_all)
+        finally:
+            latent_preview.preview_worker.discard()
         outputs[unique_id] = output_data
         if len(output_ui) > 0:
             outputs_ui[unique_id] = output_ui
@@ -180,7 +191,7 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
                 input_data_formatted[name] = [format_value(x) for x in inputs]
 
         output_data_formatted = {}
-        for node_id, node_outputs in outputs.items():
+        for node_id, node_outputs in list(outputs.items()):
             output_data_formatted[node_id] = [[format_value(x) for x in l] for l in node_outputs]
 
         logging.error("!!! Exception during processing !!!")
@@ -200,84 +211,71 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
 
     return (True, None, None)
 
-def recursive_will_execute(prompt, outputs, current_item, memo={}):
-    unique_id = current_item
-
-    if unique_id in memo:
-        return memo[unique_id]
-
-    inputs = prompt[unique_id]['inputs']
-    will_execute = []
-    if unique_id in outputs:
-        return []
-
-    for x in inputs:
-        input_data = inputs[x]
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                will_execute += recursive_will_execute(prompt, outputs, input_unique_id, memo)
-
-    memo[unique_id] = will_execute + [unique_id]
-    return memo[unique_id]
+def output_delete_if_changed(prompt, old_prompt, outputs, graph):
+    #nodes are visited upstream first so a node only keeps its output if all the nodes it depends on kept theirs
+    order = graph.topological_sort(prompt)
+    for unique_id in order:
+        inputs = prompt[unique_id]['inputs']
+        class_type = prompt[unique_id]['class_type']
+        class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+
+        is_changed_old = ''
+        is_changed = ''
+        to_delete = False
+        if hasattr(class_def, 'IS_CHANGED'):
+            if unique_id in old_prompt and 'is_changed' in old_prompt[unique_id]:
+                is_changed_old = old_prompt[unique_id]['is_changed']
+            if 'is_changed' not in prompt[unique_id]:
+                input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
+                if input_data_all is not None:
+                    try:
+                        #is_changed = class_def.IS_CHANGED(**input_data_all)
+                        is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
+                        prompt[unique_id]['is_changed'] = is_changed
+                    except:
+                        to_delete = True
+            else:
+                is_changed = prompt[unique_id]['is_changed']
 
-def recursive_output_delete_if_changed(prompt, old_prompt, outputs, current_item):
-    unique_id = current_item
-    inputs = prompt[unique_id]['inputs']
-    class_type = prompt[unique_id]['class_type']
-    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+        if unique_id not in outputs:
+            continue
 
-    is_changed_old = ''
-    is_changed = ''
-    to_delete = False
-    if hasattr(class_def, 'IS_CHANGED'):
-        if unique_id in old_prompt and 'is_changed' in old_prompt[unique_id]:
-            is_changed_old = old_prompt[unique_id]['is_changed']
-        if 'is_changed' not in prompt[unique_id]:
-            input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
-            if input_data_all is not None:
-                try:
-                    #is_changed = class_def.IS_CHANGED(**input_data_all)
-                    is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
-                    prompt[unique_id]['is_changed'] = is_changed
-                except:
-                    to_delete = True
-        else:
-            is_changed = prompt[unique_id]['is_changed']
+        if not to_delete:
+            if is_changed != is_changed_old:
+                to_delete = True
+            elif unique_id not in old_prompt:
+                to_delete = True
+            elif inputs == old_prompt[unique_id]['inputs']:
+                for x in inputs:
+                    input_data = inputs[x]
+
+                    if isinstance(input_data, list):
+                        input_unique_id = input_data[0]
+                        if input_unique_id not in outputs:
+                            to_delete = True
+                            break
+            else:
+                to_delete = True
 
-    if unique_id not in outputs:
-        return True
+        if to_delete:
+            d = outputs.pop(unique_id)
+            del d
 
-    if not to_delete:
-        if is_changed != is_changed_old:
-            to_delete = True
-        elif unique_id not in old_prompt:
-            to_delete = True
-        elif inputs == old_prompt[unique_id]['inputs']:
-            for x in inputs:
-                input_data = inputs[x]
-
-                if isinstance(input_data, list):
-                    input_unique_id = input_data[0]
-                    output_index = input_data[1]
-                    if input_unique_id in outputs:
-                        to_delete = recursive_output_delete_if_changed(prompt, old_prompt, outputs, input_unique_id)
-                    else:
-                        to_delete = True
-                    if to_delete:
-                        break
-        else:
-            to_delete = True
+    #nodes stuck in a dependency cycle can't have valid outputs
+    if len(order) != len(prompt):
+        for unique_id in set(prompt) - set(order):
+            outputs.pop(unique_id, None)
 
-    if to_delete:
-        d = outputs.pop(unique_id)
-        del d
-    return to_delete
+def is_cpu_thread_safe(class_def):
+    #only a flag the class sets itself counts, subclasses (custom nodes) have to opt in on their own
+    return class_def.__dict__.get("CPU_THREAD_SAFE", False) == True
 
 class PromptExecutor:
     def __init__(self, server = None):
         self.server = server
+        self.node_pool = None
+        if args.parallel_cpu_nodes > 0:
+            self.node_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel_cpu_nodes, thread_name_prefix="cpu_node")
         self.reset()
 
     def reset(self):
@@ -286,7 +284,13 @@ class PromptExecutor:
         self.outputs_ui = {}
         self.status_messages = []
         self.success = True
+        self.batch_results = []
         self.old_prompt = {}
+        self.execution_order = []
+        self.profiler = comfy_execution.profiler.PromptProfiler()
+        self.output_cache = comfy_execution.caching.OutputCache(max_entries=args.cache_lru,
+                                                                max_ram=int(args.cache_lru_max_ram * (1024 ** 3)),
+                                                                max_vram=int(args.cache_lru_max_vram * (1024 ** 3)))
 
     def add_message(self, event, data, broadcast: bool):
         if self.server is None:
@@ -297,12 +301,11 @@ class PromptExecutor:
         if self.server.client_id is not None or broadcast:
             self.server.send_sync(event, data, self.server.client_id)
 
-    def handle_execution_error(self, prompt_id, prompt, current_outputs, executed, error, ex):
+    def execution_error_message(self, prompt_id, prompt, executed, error, ex):
+        #returns (event, data, broadcast)
         node_id = error["node_id"]
         class_type = prompt[node_id]["class_type"]
 
-        # First, send back the status to the frontend depending
-        # on the exception type
         if isinstance(ex, comfy.model_management.InterruptProcessingException):
             mes = {
                 "prompt_id": prompt_id,
@@ -310,7 +313,7 @@ class PromptExecutor:
                 "node_type": class_type,
                 "executed": list(executed),
             }
-            self.add_message("execution_interrupted", mes, broadcast=True)
+            return ("execution_interrupted", mes, True)
         else:
             mes = {
                 "prompt_id": prompt_id,
@@ -324,8 +327,16 @@ class PromptExecutor:
                 "current_inputs": error["current_inputs"],
                 "current_outputs": error["current_outputs"],
             }
-            self.add_message("execution_error", mes, broadcast=False)
-        
+            return ("execution_error", mes, False)
+
+    def handle_execution_error(self, prompt_id, prompt, current_outputs, executed, error, ex):
+        # First, send back the status to the frontend depending
+        # on the exception type
+        event, mes, broadcast = self.execution_error_message(prompt_id, prompt, executed, error, ex)
+        self.add_message(event, mes, broadcast=broadcast)
+        self.drop_unexecuted_outputs(current_outputs, executed)
+
+    def drop_unexecuted_outputs(self, current_outputs, executed):
         # Next, remove the subsequent outputs since they will not be executed
         to_delete = []
         for o in self.outputs:
@@ -338,6 +349,147 @@ class PromptExecutor:
             d = self.outputs.pop(o)
             del d
 
+    def restore_cached_outputs(self, prompt, graph, invalidate=()):
+        #fill in the outputs of nodes that an identical node from a previous prompt already computed
+        if not self.output_cache.enabled():
+            return {}
+
+        signatures = comfy_execution.caching.compute_signatures(prompt, graph)
+        for x in invalidate:
+            signatures[x] = None
+        for x in signatures:
+            if x in self.outputs or signatures[x] is None:
+                continue
+            cached = self.output_cache.get(signatures[x])
+            if cached is not None:
+                self.outputs[x] = cached[0]
+                if len(cached[1]) > 0:
+                    self.outputs_ui[x] = cached[1]
+                self.old_prompt[x] = copy.deepcopy(prompt[x])
+        return signatures
+
+    def cache_executed_outputs(self, prompt, executed, signatures):
+        for x in executed:
+            signature = signatures.get(x, None)
+            if signature is None or signature in self.output_cache:
+                continue
+            class_def = nodes.NODE_CLASS_MAPPINGS[prompt[x]['class_type']]
+            if getattr(class_def, 'OUTPUT_NODE', False) == True: #output nodes have side effects like saving files
+                continue
+            self.output_cache.set(signature, self.outputs[x], self.outputs_ui.get(x, {}))
+
+    def run_node(self, prompt, prompt_id, node_id, extra_data, executed, prompt_thread=True):
+        profile = self.profiler.node_started(synchronize=prompt_thread)
+        # This call shouldn't raise anything if there's an error deep in
+        # the actual SD code, instead it will report the node where the
+        # error was raised
+        result = execute_node(self.server, prompt, self.outputs, node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage, profile, prompt_thread)
+        if node_id in executed:
+            self.profiler.node_finished(node_id, prompt[node_id]['class_type'], profile)
+        return result
+
+    def run_node_in_pool(self, prompt, prompt_id, node_id, extra_data, executed):
+        with torch.inference_mode(): #inference mode is thread local
+            return self.run_node(prompt, prompt_id, node_id, extra_data, executed, prompt_thread=False)
+
+    def execute_parallel(self, graph, prompt, prompt_id, extra_data, executed):
+        #CPU_THREAD_SAFE nodes are sent to the worker pool as soon as their inputs are ready, every other node
+        #(anything that might touch the models or the GPU) stays serialized on this thread in execution_order.
+        priority = {}
+        for i, node_id in enumerate(self.execution_order):
+            priority[node_id] = i
+
+        in_degree = {}
+        for node_id in self.execution_order:
+            in_degree[node_id] = len([x for x in graph.upstream[node_id] if x in priority])
+        ready = [(priority[x], x) for x in in_degree if in_degree[x] == 0]
+        heapq.heapify(ready)
+
+        def node_done(node_id):
+            for x in graph.downstream[node_id]:
+                if x in in_degree:
+                    in_degree[x] -= 1
+                    if in_degree[x] == 0:
+                        heapq.heappush(ready, (priority[x], x))
+
+        result = (True, None, None)
+        running = {}
+        while True:
+            for future in [f for f in running if f.done()]:
+                node_id = running.pop(future)
+                r = future.result()
+                if r[0] is True:
+                    node_done(node_id)
+                elif result[0] is True:
+                    result = r
+
+            if result[0] is True and len(ready) > 0:
+                _, node_id = heapq.heappop(ready)
+                class_def = nodes.NODE_CLASS_MAPPINGS[prompt[node_id]['class_type']]
+                if is_cpu_thread_safe(class_def):
+                    running[self.node_pool.submit(self.run_node_in_pool, prompt, prompt_id, node_id, extra_data, executed)] = node_id
+                else:
+                    r = self.run_node(prompt, prompt_id, node_id, extra_data, executed)
+                    if r[0] is True:
+                        node_done(node_id)
+                    else:
+                        result = r
+                continue
+
+            if len(running) == 0:
+                break
+            #stop scheduling on errors but let the nodes already running finish
+            concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        return result
+
+    def log_node_timings(self):
+        records = [r for r in self.profiler.get_records() if r["cache"] == "miss"]
+        if len(records) == 0:
+            return
+        wall_time = time.perf_counter() - self.profiler.start_time
+        node_time = 0
+        for r in records:
+            node_time += r["wall_time"]
+            logging.debug("node {} on {}: started at {:.3f}s, took {:.3f}s".format(r["node_id"], r["thread"], r["start"], r["wall_time"]))
+        logging.info("Executed {} nodes in {:.2f} seconds, {:.2f} seconds of node time overlapped".format(len(records), wall_time, max(0.0, node_time - wall_time)))
+
+    def prepare_outputs(self, prompt, graph, invalidate=()):
+        #drops the outputs of the previous prompt that can't be reused for this one and fills in the ones from
+        #the output cache, the outputs of the nodes in invalidate are always dropped
+        #delete cached outputs if nodes don't exist for them
+        to_delete = []
+        for o in self.outputs:
+            if o not in prompt:
+                to_delete += [o]
+        for o in to_delete:
+            d = self.outputs.pop(o)
+            del d
+        to_delete = []
+        for o in self.object_storage:
+            if o[0] not in prompt:
+                to_delete += [o]
+            else:
+                p = prompt[o[0]]
+                if o[1] != p['class_type']:
+                    to_delete += [o]
+        for o in to_delete:
+            d = self.object_storage.pop(o)
+            del d
+
+        output_delete_if_changed(prompt, self.old_prompt, self.outputs, graph)
+        for x in invalidate:
+            self.outputs.pop(x, None)
+            self.old_prompt.pop(x, None)
+
+        signatures = self.restore_cached_outputs(prompt, graph, invalidate)
+
+        for x in list(self.outputs_ui.keys()):
+            if x not in self.outputs:
+                d = self.outputs_ui.pop(x)
+                del d
+        return signatures
+
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
         nodes.interrupt_processing(False)
 
@@ -351,59 +503,35 @@ class PromptExecutor:
         self.add_message("execution_start", { "prompt_id": prompt_id}, broadcast=False)
 
         with torch.inference_mode():
-            #delete cached outputs if nodes don't exist for them
-            to_delete = []
-            for o in self.outputs:
-                if o not in prompt:
-                    to_delete += [o]
-            for o in to_delete:
-                d = self.outputs.pop(o)
-                del d
-            to_delete = []
-            for o in self.object_storage:
-                if o[0] not in prompt:
-                    to_delete += [o]
-                else:
-                    p = prompt[o[0]]
-                    if o[1] != p['class_type']:
-                        to_delete += [o]
-            for o in to_delete:
-                d = self.object_storage.pop(o)
-                del d
-
-            for x in prompt:
-                recursive_output_delete_if_changed(prompt, self.old_prompt, self.outputs, x)
-
+            graph = comfy_execution.graph.ExecutionGraph(prompt)
+            signatures = self.prepare_outputs(prompt, graph)
             current_outputs = set(self.outputs.keys())
-            for x in list(self.outputs_ui.keys()):
-                if x not in current_outputs:
-                    d = self.outputs_ui.pop(x)
-                    del d
 
             comfy.model_management.cleanup_models(keep_clone_weights_loaded=True)
             self.add_message("execution_cached",
                           { "nodes": list(current_outputs) , "prompt_id": prompt_id},
                           broadcast=False)
             executed = set()
-            output_node_id = None
-            to_execute = []
-
-            for node_id in list(execute_outputs):
-                to_execute += [(0, node_id)]
-
-            while len(to_execute) > 0:
-                #always execute the output that depends on the least amount of unexecuted nodes first
-                memo = {}
-                to_execute = sorted(list(map(lambda a: (len(recursive_will_execute(prompt, self.outputs, a[-1], memo)), a[-1]), to_execute)))
-                output_node_id = to_execute.pop(0)[-1]
-
-                # This call shouldn't raise anything if there's an error deep in
-                # the actual SD code, instead it will report the node where the
-                # error was raised
-                self.success, error, ex = recursive_execute(self.server, prompt, self.outputs, output_node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage)
-                if self.success is not True:
-                    self.handle_execution_error(prompt_id, prompt, current_outputs, executed, error, ex)
-                    raise ex
+            self.execution_order = graph.execution_order(execute_outputs, self.outputs)
+            self.profiler = comfy_execution.profiler.PromptProfiler(detailed=args.profile_nodes)
+            for x in current_outputs:
+                self.profiler.node_cached(x, prompt[x]['class_type'])
+
+            if self.node_pool is not None:
+                self.success, error, ex = self.execute_parallel(graph, prompt, prompt_id, extra_data, executed)
+                self.log_node_timings()
+            else:
+                for node_id in self.execution_order:
+                    self.success, error, ex = self.run_node(prompt, prompt_id, node_id, extra_data, executed)
+                    if self.success is not True:
+                        break
+
+            if self.success is not True:
+                self.cache_executed_outputs(prompt, executed, signatures)
+                self.handle_execution_error(prompt_id, prompt, current_outputs, executed, error, ex)
+                raise ex
+
+            self.cache_executed_outputs(prompt, executed, signatures)
 
             for x in executed:
                 self.old_prompt[x] = copy.deepcopy(prompt[x])
@@ -415,6 +543,164 @@ class PromptExecutor:
                 comfy.model_management.unload_all_models()
 
 
+    def execute_batch(self, items):
+        #Executes prompts that comfy_execution.batching.coalesce_key grouped together, items is a list of
+        #(prompt, prompt_id, extra_data, execute_outputs). The nodes that don't depend on the inputs that differ
+        #between the prompts run once and keep their outputs in self.outputs like with execute(), the others run
+        #once per prompt with their outputs in a separate dict for each prompt except for the ones with a
+        #BATCHED_FUNCTION which get called once for all of them.
+        #The (success, status_messages, outputs_ui, profile) of each prompt are put in self.batch_results, like
+        #execute() the exception of the first prompt that failed is raised after the error messages were sent.
+        nodes.interrupt_processing(False)
+        self.batch_results = []
+        prompts = [x[0] for x in items]
+        prompt, _, extra_data, execute_outputs = items[0]
+        targets = [(x[1], x[2].get("client_id", None)) for x in items]
+        messages = [[] for x in items]
+        errors = [None] * len(items)
+        item_outputs = [{} for x in items]
+        item_outputs_ui = [{} for x in items]
+        item_executed = [set() for x in items]
+        profilers = [comfy_execution.profiler.PromptProfiler(detailed=args.profile_nodes) for x in items]
+
+        def send(indices, event, data, broadcast):
+            for i in indices:
+                data = dict(data)
+                data["prompt_id"] = targets[i][0]
+                messages[i].append((event, data))
+                if self.server is not None and (targets[i][1] is not None or broadcast):
+                    self.server.send_sync(event, data, targets[i][1])
+
+        def server_for(indices):
+            if self.server is None:
+                return None
+            return comfy_execution.batching.BatchServer(self.server, [targets[i] for i in indices])
+
+        def run(indices, node_id, function):
+            profile = profilers[indices[0]].node_started()
+            result = function(profile)
+            for i in indices:
+                if node_id in item_executed[i] or node_id in executed:
+                    profilers[i].node_finished(node_id, prompt[node_id]['class_type'], profile)
+            return result
+
+        all_items = list(range(len(items)))
+        send(all_items, "execution_start", {}, False)
+
+        with torch.inference_mode():
+            graph = comfy_execution.graph.ExecutionGraph(prompt)
+            per_item = graph.descendants(comfy_execution.batching.varying_nodes(prompts))
+            signatures = self.prepare_outputs(prompt, graph, per_item)
+            current_outputs = set(self.outputs.keys())
+
+            comfy.model_management.cleanup_models(keep_clone_weights_loaded=True)
+            send(all_items, "execution_cached", { "nodes": list(current_outputs) }, False)
+            for x in current_outputs:
+                for profiler in profilers:
+                    profiler.node_cached(x, prompt[x]['class_type'])
+
+            executed = set()
+            self.execution_order = graph.execution_order(execute_outputs, self.outputs)
+            for node_id in self.execution_order:
+                live = [i for i in all_items if errors[i] is None]
+                if len(live) == 0:
+                    break
+
+                if node_id not in per_item:
+                    r = run(live, node_id, lambda profile: execute_node(server_for(live), prompt, self.outputs, node_id, extra_data, executed, targets[live[0]][0],
+                                                                          self.outputs_ui, self.object_storage, profile))
+                    if r[0] is not True:
+                        for i in live:
+                            errors[i] = (r[1], r[2])
+                    continue
+
+                if run(live, node_id, lambda profile: self.run_batched_node(node_id, live, items, item_outputs, item_executed, errors)):
+                    continue
+
+                for i in live:
+                    outputs = collections.ChainMap(item_outputs[i], self.outputs)
+                    r = run([i], node_id, lambda profile: execute_node(server_for([i]), prompts[i], outputs, node_id, items[i][2], item_executed[i], targets[i][0],
+                                                                         item_outputs_ui[i], self.object_storage, profile))
+                    if r[0] is not True:
+                        errors[i] = (r[1], r[2])
+
+            self.cache_executed_outputs(prompt, executed, signatures)
+            failed = [i for i in all_items if errors[i] is not None]
+            if len(failed) > 0:
+                self.drop_unexecuted_outputs(current_outputs, executed)
+            for x in executed:
+                self.old_prompt[x] = copy.deepcopy(prompt[x])
+
+            results = []
+            for i in all_items:
+                if errors[i] is not None:
+                    event, mes, broadcast = self.execution_error_message(targets[i][0], prompts[i], executed | item_executed[i], errors[i][0], errors[i][1])
+                    send([i], event, mes, broadcast)
+                outputs_ui = {}
+                for x in self.outputs_ui:
+                    if x not in per_item:
+                        outputs_ui[x] = self.outputs_ui[x]
+                outputs_ui.update(item_outputs_ui[i])
+                results.append((errors[i] is None, messages[i], outputs_ui, profilers[i].get_records()))
+            self.batch_results = results
+
+            if len(failed) > 0:
+                raise errors[failed[0]][1]
+
+            if self.server is not None:
+                self.server.last_node_id = None
+
+            if comfy.model_management.DISABLE_SMART_MEMORY:
+                comfy.model_management.unload_all_models()
+
+    def run_batched_node(self, node_id, indices, items, item_outputs, item_executed, errors):
+        #Calls the BATCHED_FUNCTION of the node once for the prompts in indices, returns False if the
+        #node has to be executed separately for each of them instead.
+        class_type = items[0][0][node_id]['class_type']
+        class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+        if not hasattr(class_def, "BATCHED_FUNCTION") or getattr(class_def, "INPUT_IS_LIST", False) or len(indices) < 2:
+            return False
+
+        input_data = []
+        for i in indices:
+            prompt, prompt_id, extra_data, _ = items[i]
+            data = get_input_data(prompt[node_id]['inputs'], class_def, node_id, collections.ChainMap(item_outputs[i], self.outputs), prompt, extra_data)
+            if any(len(x) != 1 for x in data.values()):
+                return False
+            input_data.append({k: v[0] for k, v in data.items()})
+
+        if self.server is not None:
+            server = comfy_execution.batching.BatchServer(self.server, [(items[i][1], items[i][2].get("client_id", None)) for i in indices])
+            server.set_progress_target(node_id, None)
+            server.last_node_id = node_id
+            server.send_sync("executing", { "node": node_id, "prompt_id": None })
+
+        obj = self.object_storage.get((node_id, class_type), None)
+        if obj is None:
+            obj = class_def()
+            self.object_storage[(node_id, class_type)] = obj
+
+        try:
+            nodes.before_node_execution()
+            results = getattr(obj, class_def.BATCHED_FUNCTION)(input_data)
+        except comfy.model_management.InterruptProcessingException as iex:
+            logging.info("Processing interrupted")
+            for i in indices:
+                errors[i] = ({"node_id": node_id}, iex)
+            return True
+        except Exception as ex:
+            logging.warning("batched execution of node {} failed, executing it separately for each prompt: {}".format(node_id, ex))
+            return False
+        finally:
+            latent_preview.preview_worker.discard()
+
+        if results is None:
+            return False
+        for i, r in zip(indices, results):
+            item_outputs[i][node_id] = [[x] for x in r]
+            item_executed[i].add(node_id)
+        return True
+
 
 def validate_inputs(prompt, item, validated):
     unique_id = item
@@ -654,6 +940,17 @@ def validate_prompt(prompt):
     errors = []
     node_errors = {}
     validated = {}
+
+    # validate upstream nodes first so validate_inputs only ever has to recurse one level deep,
+    # failures are left for the recursive call to report from the point of view of the linked node.
+    graph = comfy_execution.graph.ExecutionGraph(prompt)
+    for o in outputs:
+        for node_id in graph.ancestors(o, validated)[:-1]:
+            try:
+                validate_inputs(prompt, node_id, validated)
+            except Exception:
+                pass
+
     for o in outputs:
         valid = False
         reasons = []
@@ -735,12 +1032,23 @@ class PromptQueue:
         self.currently_running = {}
         self.history = {}
         self.flags = {}
+        self.prefetcher = None
+        self.coalesce_keys = {}
         server.prompt_queue = self
 
+    def queue_changed(self):
+        self.server.queue_updated()
+        if self.prefetcher is not None:
+            self.prefetcher.notify()
+
     def put(self, item):
+        key = None
+        if args.coalesce_prompts > 1: #computed once here and not while get_coalesced holds the mutex
+            key = comfy_execution.batching.coalesce_key(item[2], item[4])
         with self.mutex:
+            self.coalesce_keys[item[1]] = key
             heapq.heappush(self.queue, item)
-            self.server.queue_updated()
+            self.queue_changed()
             self.not_empty.notify()
 
     def get(self, timeout=None):
@@ -750,19 +1058,50 @@ class PromptQueue:
                 if timeout is not None and len(self.queue) == 0:
                     return None
             item = heapq.heappop(self.queue)
+            self.coalesce_keys.pop(item[1], None)
             i = self.task_counter
             self.currently_running[i] = copy.deepcopy(item)
             self.task_counter += 1
-            self.server.queue_updated()
+            self.queue_changed()
             return (item, i)
 
+    def get_coalesced(self, timeout=None, max_items=1):
+        #Like get() but also takes up to max_items - 1 of the queued prompts that can be executed together
+        #with the next one (see PromptExecutor.execute_batch), returns a list of (item, item_id).
+        with self.not_empty:
+            while len(self.queue) == 0:
+                self.not_empty.wait(timeout=timeout)
+                if timeout is not None and len(self.queue) == 0:
+                    return None
+            items = [heapq.heappop(self.queue)]
+            key = self.coalesce_keys.get(items[0][1], None)
+            if key is not None and max_items > 1:
+                for x in sorted(self.queue):
+                    if len(items) >= max_items:
+                        break
+                    if self.coalesce_keys.get(x[1], None) == key:
+                        items.append(x)
+                if len(items) > 1:
+                    self.queue = [x for x in self.queue if not any(x is y for y in items)]
+                    heapq.heapify(self.queue)
+
+            out = []
+            for item in items:
+                self.coalesce_keys.pop(item[1], None)
+                i = self.task_counter
+                self.currently_running[i] = copy.deepcopy(item)
+                self.task_counter += 1
+                out.append((item, i))
+            self.queue_changed()
+            return out
+
     class ExecutionStatus(NamedTuple):
         status_str: Literal['success', 'error']
         completed: bool
         messages: List[str]
 
     def task_done(self, item_id, outputs,
-                  status: Optional['PromptQueue.ExecutionStatus']):
+                  status: Optional['PromptQueue.ExecutionStatus'], profile=None):
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
             if len(self.history) > MAXIMUM_HISTORY_SIZE:
@@ -777,6 +1116,8 @@ class PromptQueue:
                 "outputs": copy.deepcopy(outputs),
                 'status': status_dict,
             }
+            if profile is not None:
+                self.history[prompt[1]]["profile"] = profile
             self.server.queue_updated()
 
     def get_current_queue(self):
@@ -793,6 +1134,7 @@ class PromptQueue:
     def wipe_queue(self):
         with self.mutex:
             self.queue = []
+            self.coalesce_keys = {}
             self.server.queue_updated()
 
     def delete_queue_item(self, function):
@@ -802,7 +1144,7 @@ class PromptQueue:
                     if len(self.queue) == 1:
                         self.wipe_queue()
                     else:
-                        self.queue.pop(x)
+                        self.coalesce_keys.pop(self.queue.pop(x)[1], None)
                         heapq.heapify(self.queue)
                     self.server.queue_updated()
                     return True
@@ -1,7 +1,10 @@
 import torch
-from PIL import Image
+from PIL import Image, ImageOps
 import struct
 import numpy as np
+import threading
+import time
+from io import BytesIO
 from comfy.cli_args import args, LatentPreviewMethod
 from comfy.taesd.taesd import TAESD
 import folder_paths
@@ -47,9 +50,100 @@ class Latent2RGBPreviewer(LatentPreviewer):
         return Image.fromarray(latents_ubyte.numpy())
 
 
-def get_previewer(device, latent_format):
+def encode_preview_image(image_data):
+    #("JPEG" or "PNG", PIL image, max size) to the bytes of a PREVIEW_IMAGE message
+    image_type, image, max_size = image_data
+    if max_size is not None:
+        if hasattr(Image, 'Resampling'):
+            resampling = Image.Resampling.BILINEAR
+        else:
+            resampling = Image.ANTIALIAS
+
+        image = ImageOps.contain(image, (max_size, max_size), resampling)
+    type_num = 1
+    if image_type == "JPEG":
+        type_num = 1
+    elif image_type == "PNG":
+        type_num = 2
+
+    bytesIO = BytesIO()
+    header = struct.pack(">I", type_num)
+    bytesIO.write(header)
+    image.save(bytesIO, format=image_type, quality=95, compress_level=1)
+    return bytesIO.getvalue()
+
+class PreviewWorker:
+    #Makes the previews of the sampler steps on a background thread: the callback leaves a copy of the latest x0 in
+    #a single slot mailbox and returns, the worker decodes, downscales and encodes it. A preview that is still
+    #waiting when the next one arrives is dropped so slow previews never hold back sampling, and at most max_fps
+    #previews are made per second. The previews are tagged with the thread running the node so the ones it still
+    #has pending when it finishes can be discarded.
+    def __init__(self, max_fps=0):
+        self.max_fps = max_fps
+        self.condition = threading.Condition()
+        self.slot = None
+        self.current = None
+        self.thread = None
+        self.last_preview = 0
+        self.dropped = 0
+
+    def submit(self, previewer, preview_format, x0, send):
+        #send: called on the worker thread with the encoded preview
+        x0 = x0[:1].detach().clone() #the copy is queued on the device, it doesn't wait for the step to finish
+        with self.condition:
+            if self.slot is not None:
+                self.dropped += 1
+            self.slot = (previewer, preview_format, x0, send, threading.get_ident())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name="latent_preview")
+                self.thread.start()
+            self.condition.notify()
+
+    def discard(self):
+        #called when the node running on this thread finishes, none of the previews it submitted is sent after this
+        node_thread = threading.get_ident()
+        with self.condition:
+            if self.slot is not None and self.slot[4] == node_thread:
+                self.slot = None
+            if self.current == node_thread:
+                self.current = None
+
+    def next_item(self):
+        while True:
+            with self.condition:
+                while self.slot is None:
+                    self.condition.wait()
+            if self.max_fps > 0:
+                delay = self.last_preview + 1.0 / self.max_fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay) #a newer x0 can arrive in the meantime
+            with self.condition:
+                item = self.slot
+                self.slot = None
+                if item is None: #discarded while waiting
+                    continue
+                self.current = item[4]
+            self.last_preview = time.perf_counter()
+            return item
+
+    def run(self):
+        while True:
+            previewer, preview_format, x0, send, node_thread = self.next_item()
+            try:
+                with torch.inference_mode():
+                    preview_image = previewer.decode_latent_to_preview_image(preview_format, x0)
+                preview_bytes = encode_preview_image(preview_image)
+                with self.condition:
+                    if self.current == node_thread:
+                        send(preview_bytes)
+                    self.current = None
+            except Exception as e:
+                logging.warning("latent preview failed: {}".format(e))
+
+preview_worker = PreviewWorker(args.preview_max_fps)
+
+def create_previewer(device, latent_format, method):
     previewer = None
-    method = args.preview_method
     if method != LatentPreviewMethod.NoPreviews:
         # TODO previewer methods
         taesd_decoder_path = None
@@ -78,6 +172,34 @@ def get_previewer(device, latent_format):
                 previewer = Latent2RGBPreviewer(latent_format.latent_rgb_factors)
     return previewer
 
+class PreviewerRegistry:
+    #Previewers by latent format, device and preview method, kept for the whole process so the sampler nodes of
+    #every prompt don't look up the TAESD decoder file and load it again. The TAESD decoders (a few MB) stay on their
+    #device until clear() is called when the models are unloaded.
+    def __init__(self):
+        self.previewers = {}
+        self.lock = threading.Lock()
+
+    def get(self, device, latent_format, method):
+        key = (type(latent_format).__name__, str(device), method)
+        with self.lock:
+            if key in self.previewers:
+                return self.previewers[key]
+        previewer = create_previewer(device, latent_format, method)
+        with self.lock:
+            return self.previewers.setdefault(key, previewer)
+
+    def clear(self):
+        with self.lock:
+            self.previewers.clear()
+
+previewers = PreviewerRegistry()
+
+def get_previewer(device, latent_format):
+    if args.preview_method == LatentPreviewMethod.NoPreviews:
+        return None
+    return previewers.get(device, latent_format, args.preview_method)
+
 def prepare_callback(model, steps, x0_output_dict=None):
     preview_format = "JPEG"
     if preview_format not in ["JPEG", "PNG"]:
@@ -86,12 +208,18 @@ def prepare_callback(model, steps, x0_output_dict=None):
     previewer = get_previewer(model.load_device, model.model.latent_format)
 
     pbar = comfy.utils.ProgressBar(steps)
+    send_preview = None
+    if args.async_previews and previewer:
+        send_preview = comfy.utils.preview_sender()
+
     def callback(step, x0, x, total_steps):
         if x0_output_dict is not None:
             x0_output_dict["x0"] = x0
 
         preview_bytes = None
-        if previewer:
+        if send_preview is not None:
+            preview_worker.submit(previewer, preview_format, x0, send_preview)
+        elif previewer:
             preview_bytes = previewer.decode_latent_to_preview_image(preview_format, x0)
         pbar.update_absolute(step + 1, total_steps, preview_bytes)
     return callback
@@ -52,6 +52,7 @@ import itertools
 import shutil
 import threading
 import gc
+import functools
 
 from comfy.cli_args import args
 from workflow import run_workflow
@@ -75,9 +76,14 @@ import comfy.utils
 import yaml
 
 import execution
+import comfy_execution.image_writer
+import comfy_execution.prefetch
+import latent_preview
 from server import PromptServer, BinaryEventTypes
 from nodes import init_custom_nodes
 import comfy.model_management
+import comfy.model_cache
+import comfy.weight_cache
 
 def cuda_malloc_warning():
     device = comfy.model_management.get_torch_device()
@@ -90,6 +96,14 @@ def cuda_malloc_warning():
         if cuda_malloc_warning:
             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
+def prompt_done(q, server, item_id, prompt_id, client_id, outputs_ui, status, profile, execution_start_time):
+    q.task_done(item_id, outputs_ui, status=status, profile=profile)
+    if client_id is not None:
+        server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, client_id)
+
+    execution_time = time.perf_counter() - execution_start_time
+    logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
+
 def prompt_worker(q, server):
     e = execution.PromptExecutor(server)
     last_gc_collect = 0
@@ -101,38 +115,68 @@ def prompt_worker(q, server):
         if need_gc:
             timeout = max(gc_collect_interval - (current_time - last_gc_collect), 0.0)
 
-        queue_item = q.get(timeout=timeout)
-        if queue_item is not None:
-            item, item_id = queue_item
+        if args.coalesce_prompts > 1:
+            queue_items = q.get_coalesced(timeout=timeout, max_items=args.coalesce_prompts)
+        else:
+            queue_item = q.get(timeout=timeout)
+            queue_items = None if queue_item is None else [queue_item]
+
+        if queue_items is not None and len(queue_items) == 1:
+            item, item_id = queue_items[0]
             execution_start_time = time.perf_counter()
             prompt_id = item[1]
             server.last_prompt_id = prompt_id
 
-            e.execute(item[2], prompt_id, item[3], item[4])
+            try:
+                e.execute(item[2], prompt_id, item[3], item[4])
+            except Exception:
+                if e.success: #node errors were already sent to the client and are in e.status_messages
+                    raise
             need_gc = True
-            q.task_done(item_id,
-                        e.outputs_ui,
-                        status=execution.PromptQueue.ExecutionStatus(
-                            status_str='success' if e.success else 'error',
-                            completed=e.success,
-                            messages=e.status_messages))
-            if server.client_id is not None:
-                server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
 
+            status = execution.PromptQueue.ExecutionStatus(
+                status_str='success' if e.success else 'error',
+                completed=e.success,
+                messages=e.status_messages)
+
+            #the prompt is only done once the images it saved are on disk, the next one can start running meanwhile
+            comfy_execution.image_writer.writer.run_when_flushed(functools.partial(prompt_done, q, server, item_id, prompt_id, server.client_id,
+                                                                                   dict(e.outputs_ui), status, e.profiler.get_records(), execution_start_time))
+            current_time = time.perf_counter()
+        elif queue_items is not None:
+            execution_start_time = time.perf_counter()
+            server.last_prompt_id = queue_items[-1][0][1]
+            logging.info("Executing {} prompts as one batch".format(len(queue_items)))
+
+            try:
+                e.execute_batch([(item[2], item[1], item[3], item[4]) for item, item_id in queue_items])
+            except Exception:
+                if len(e.batch_results) != len(queue_items):
+                    raise
+            need_gc = True
+
+            for (item, item_id), (success, messages, outputs_ui, profile) in zip(queue_items, e.batch_results):
+                status = execution.PromptQueue.ExecutionStatus(
+                    status_str='success' if success else 'error',
+                    completed=success,
+                    messages=messages)
+                comfy_execution.image_writer.writer.run_when_flushed(functools.partial(prompt_done, q, server, item_id, item[1], item[3].get("client_id", None),
+                                                                                       outputs_ui, status, profile, execution_start_time))
             current_time = time.perf_counter()
-            execution_time = current_time - execution_start_time
-            logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
 
         flags = q.get_flags()
         free_memory = flags.get("free_memory", False)
 
         if flags.get("unload_models", free_memory):
             comfy.model_management.unload_all_models()
+            latent_preview.previewers.clear()
             need_gc = True
             last_gc_collect = 0
 
         if free_memory:
             e.reset()
+            comfy.model_cache.cache.clear()
+            comfy.weight_cache.cache.clear()
             need_gc = True
             last_gc_collect = 0
 
@@ -152,13 +196,22 @@ async def run(server, address='', port=8188, verbose=True, call_on_start=None):
 def hijack_progress(server):
     def hook(value, total, preview_image):
         comfy.model_management.throw_exception_if_processing_interrupted()
-        progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": server.last_node_id}
-
-        server.send_sync("progress", progress, server.client_id)
-        if preview_image is not None:
-            server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, server.client_id)
+        node_id, targets = server.get_progress_target()
+        for prompt_id, client_id in targets:
+            progress = {"value": value, "max": total, "prompt_id": prompt_id, "node": node_id}
+            server.send_sync("progress", progress, client_id)
+            if preview_image is not None:
+                server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, client_id)
     comfy.utils.set_progress_bar_global_hook(hook)
 
+    def preview_hook():
+        _, targets = server.get_progress_target()
+        def send(preview_bytes):
+            for prompt_id, client_id in targets:
+                server.send_sync(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, client_id)
+        return send
+    comfy.utils.set_preview_global_hook(preview_hook)
+
 
 def cleanup_temp():
     temp_dir = folder_paths.get_temp_directory()
@@ -208,6 +261,8 @@ if __name__ == "__main__":
         asyncio.set_event_loop(loop)
         server = PromptServer(loop)
         q = execution.PromptQueue(server)
+        if args.prefetch_models > 0:
+            q.prefetcher = comfy_execution.prefetch.ModelPrefetcher(q, args.prefetch_models)
 
     extra_model_paths_config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "extra_model_paths.yaml")
     if os.path.isfile(extra_model_paths_config_path):
@@ -28,6 +28,8 @@ import comfy.controlnet
 import comfy.clip_vision
 
 import comfy.model_management
+import comfy.model_cache
+import comfy.text_encoder_cache
 from comfy.cli_args import args
 
 import importlib
@@ -35,6 +37,7 @@ import importlib
 import folder_paths
 import latent_preview
 import node_helpers
+import comfy_execution.image_writer
 
 def before_node_execution():
     comfy.model_management.throw_exception_if_processing_interrupted()
@@ -50,6 +53,7 @@ class CLIPTextEncode:
         return {"required": {"text": ("STRING", {"multiline": True}), "clip": ("CLIP", )}}
     RETURN_TYPES = ("CONDITIONING",)
     FUNCTION = "encode"
+    COALESCE_INPUTS = ("text",)
 
     CATEGORY = "conditioning"
 
@@ -267,6 +271,19 @@ class VAEDecode:
     def decode(self, vae, samples):
         return (vae.decode(samples["samples"]), )
 
+class VAEDecodeStream:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": { "samples": ("LATENT", ), "vae": ("VAE", ),
+                              "chunk_size": ("INT", {"default": 8, "min": 0, "max": 4096})}}
+    RETURN_TYPES = ("IMAGE_STREAM",)
+    FUNCTION = "decode"
+
+    CATEGORY = "latent"
+
+    def decode(self, vae, samples, chunk_size):
+        return (vae.decode_stream(samples["samples"], max_batch=chunk_size), )
+
 class VAEDecodeTiled:
     @classmethod
     def INPUT_TYPES(s):
@@ -493,13 +510,16 @@ class CheckpointLoader:
                               "ckpt_name": (folder_paths.get_filename_list("checkpoints"), )}}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE")
     FUNCTION = "load_checkpoint"
+    PREFETCH = True
 
     CATEGORY = "advanced/loaders"
 
     def load_checkpoint(self, config_name, ckpt_name, output_vae=True, output_clip=True):
         config_path = folder_paths.get_full_path("configs", config_name)
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-        return comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        return comfy.model_cache.cache.load([config_path, ckpt_path], ("checkpoint_config", tuple(embedding_directory)),
+                                            lambda: comfy.sd.load_checkpoint(config_path, ckpt_path, output_vae=True, output_clip=True, embedding_directory=embedding_directory))
 
 class CheckpointLoaderSimple:
     @classmethod
@@ -508,12 +528,15 @@ class CheckpointLoaderSimple:
                              }}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE")
     FUNCTION = "load_checkpoint"
+    PREFETCH = True
 
     CATEGORY = "loaders"
 
     def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True):
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        out = comfy.model_cache.cache.load([ckpt_path], ("checkpoint", tuple(embedding_directory)),
+                                           lambda: comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=embedding_directory))
         return out[:3]
 
 class DiffusersLoader:
@@ -606,10 +629,12 @@ class LoraLoader:
                 del temp
 
         if lora is None:
-            lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+            #a lazy dict would be charged to the model cache before its tensors are read and keep the file open
+            lazy = not comfy.model_cache.cache.enabled()
+            lora = comfy.model_cache.cache.load([lora_path], ("lora",), lambda: comfy.utils.load_torch_file(lora_path, safe_load=True, lazy=lazy))
             self.loaded_lora = (lora_path, lora)
 
-        model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip)
+        model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, strength_model, strength_clip, source=comfy.text_encoder_cache.file_identity([lora_path]))
         return (model_lora, clip_lora)
 
 class LoraLoaderModelOnly(LoraLoader):
@@ -677,6 +702,7 @@ class VAELoader:
         return {"required": { "vae_name": (s.vae_list(), )}}
     RETURN_TYPES = ("VAE",)
     FUNCTION = "load_vae"
+    PREFETCH = True
 
     CATEGORY = "loaders"
 
@@ -684,10 +710,10 @@ class VAELoader:
     def load_vae(self, vae_name):
         if vae_name in ["taesd", "taesdxl"]:
             sd = self.load_taesd(vae_name)
+            vae = comfy.sd.VAE(sd=sd)
         else:
             vae_path = folder_paths.get_full_path("vae", vae_name)
-            sd = comfy.utils.load_torch_file(vae_path)
-        vae = comfy.sd.VAE(sd=sd)
+            vae = comfy.model_cache.cache.load([vae_path], ("vae",), lambda: comfy.sd.VAE(sd=comfy.utils.load_torch_file(vae_path)))
         return (vae,)
 
 class ControlNetLoader:
@@ -697,12 +723,13 @@ class ControlNetLoader:
 
     RETURN_TYPES = ("CONTROL_NET",)
     FUNCTION = "load_controlnet"
+    PREFETCH = True
 
     CATEGORY = "loaders"
 
     def load_controlnet(self, control_net_name):
         controlnet_path = folder_paths.get_full_path("controlnet", control_net_name)
-        controlnet = comfy.controlnet.load_controlnet(controlnet_path)
+        controlnet = comfy.model_cache.cache.load([controlnet_path], ("controlnet",), lambda: comfy.controlnet.load_controlnet(controlnet_path))
         return (controlnet,)
 
 class DiffControlNetLoader:
@@ -806,12 +833,13 @@ class UNETLoader:
                              }}
     RETURN_TYPES = ("MODEL",)
     FUNCTION = "load_unet"
+    PREFETCH = True
 
     CATEGORY = "advanced/loaders"
 
     def load_unet(self, unet_name):
         unet_path = folder_paths.get_full_path("unet", unet_name)
-        model = comfy.sd.load_unet(unet_path)
+        model = comfy.model_cache.cache.load([unet_path], ("unet",), lambda: comfy.sd.load_unet(unet_path))
         return (model,)
 
 class CLIPLoader:
@@ -822,6 +850,7 @@ class CLIPLoader:
                              }}
     RETURN_TYPES = ("CLIP",)
     FUNCTION = "load_clip"
+    PREFETCH = True
 
     CATEGORY = "advanced/loaders"
 
@@ -831,7 +860,9 @@ class CLIPLoader:
             clip_type = comfy.sd.CLIPType.STABLE_CASCADE
 
         clip_path = folder_paths.get_full_path("clip", clip_name)
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path], embedding_directory=folder_paths.get_folder_paths("embeddings"), clip_type=clip_type)
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        clip = comfy.model_cache.cache.load([clip_path], ("clip", clip_type.name, tuple(embedding_directory)),
+                                            lambda: comfy.sd.load_clip(ckpt_paths=[clip_path], embedding_directory=embedding_directory, clip_type=clip_type))
         return (clip,)
 
 class DualCLIPLoader:
@@ -841,13 +872,16 @@ class DualCLIPLoader:
                              }}
     RETURN_TYPES = ("CLIP",)
     FUNCTION = "load_clip"
+    PREFETCH = True
 
     CATEGORY = "advanced/loaders"
 
     def load_clip(self, clip_name1, clip_name2):
         clip_path1 = folder_paths.get_full_path("clip", clip_name1)
         clip_path2 = folder_paths.get_full_path("clip", clip_name2)
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2], embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        embedding_directory = folder_paths.get_folder_paths("embeddings")
+        clip = comfy.model_cache.cache.load([clip_path1, clip_path2], ("clip", tuple(embedding_directory)),
+                                            lambda: comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2], embedding_directory=embedding_directory))
         return (clip,)
 
 class CLIPVisionLoader:
@@ -1318,6 +1352,55 @@ def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
     out["samples"] = samples
     return (out, )
 
+def common_ksampler_batched(items):
+    #items: the common_ksampler keyword arguments of each prompt of a coalesced batch (see --coalesce-prompts),
+    #sampled in a single pass. Returns None if they differ in anything but the seed, conditioning and latent, or in
+    #the seed with a sampler that adds noise while sampling.
+    first = items[0]
+    for x in items[1:]:
+        for k in ("model", "steps", "cfg", "sampler_name", "scheduler", "denoise", "disable_noise", "start_step", "last_step", "force_full_denoise"):
+            if x.get(k, None) != first.get(k, None):
+                return None
+
+    #the noise drawn while sampling would only come from the first seed
+    if comfy.samplers.sampler_uses_noise(first["sampler_name"]) and any(x["seed"] != first["seed"] for x in items[1:]):
+        return None
+
+    latents = [x["latent"] for x in items]
+    for latent in latents:
+        if "noise_mask" in latent or latent["samples"].shape[1:] != latents[0]["samples"].shape[1:]:
+            return None
+    batch_sizes = [latent["samples"].shape[0] for latent in latents]
+    positive = comfy.sample.batch_conditioning([x["positive"] for x in items], batch_sizes)
+    negative = comfy.sample.batch_conditioning([x["negative"] for x in items], batch_sizes)
+    if positive is None or negative is None:
+        return None
+
+    latent_image = torch.cat([latent["samples"] for latent in latents])
+    disable_noise = first.get("disable_noise", False)
+    if disable_noise:
+        noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
+    else:
+        #same noise for each latent as when it's sampled on its own
+        noise = torch.cat([comfy.sample.prepare_noise(latent["samples"], x["seed"], latent.get("batch_index", None)) for x, latent in zip(items, latents)])
+
+    model = first["model"]
+    steps = first["steps"]
+    callback = latent_preview.prepare_callback(model, steps)
+    disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
+    samples = comfy.sample.sample(model, noise, steps, first["cfg"], first["sampler_name"], first["scheduler"], positive, negative, latent_image,
+                                  denoise=first.get("denoise", 1.0), disable_noise=disable_noise, start_step=first.get("start_step", None), last_step=first.get("last_step", None),
+                                  force_full_denoise=first.get("force_full_denoise", False), callback=callback, disable_pbar=disable_pbar, seed=first["seed"])
+
+    outputs = []
+    start = 0
+    for latent, batch_size in zip(latents, batch_sizes):
+        out = latent.copy()
+        out["samples"] = samples[start:start + batch_size]
+        outputs.append((out, ))
+        start += batch_size
+    return outputs
+
 class KSampler:
     @classmethod
     def INPUT_TYPES(s):
@@ -1337,12 +1420,18 @@ class KSampler:
 
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "sample"
+    COALESCE_INPUTS = ("seed",)
+    BATCHED_FUNCTION = "sample_batched"
 
     CATEGORY = "sampling"
 
     def sample(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
         return common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
 
+    def sample_batched(self, items):
+        return common_ksampler_batched([{"model": x["model"], "seed": x["seed"], "steps": x["steps"], "cfg": x["cfg"], "sampler_name": x["sampler_name"], "scheduler": x["scheduler"],
+                                         "positive": x["positive"], "negative": x["negative"], "latent": x["latent_image"], "denoise": x.get("denoise", 1.0)} for x in items])
+
 class KSamplerAdvanced:
     @classmethod
     def INPUT_TYPES(s):
@@ -1365,6 +1454,8 @@ class KSamplerAdvanced:
 
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "sample"
+    COALESCE_INPUTS = ("noise_seed",)
+    BATCHED_FUNCTION = "sample_batched"
 
     CATEGORY = "sampling"
 
@@ -1377,6 +1468,12 @@ class KSamplerAdvanced:
             disable_noise = True
         return common_ksampler(model, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise, disable_noise=disable_noise, start_step=start_at_step, last_step=end_at_step, force_full_denoise=force_full_denoise)
 
+    def sample_batched(self, items):
+        return common_ksampler_batched([{"model": x["model"], "seed": x["noise_seed"], "steps": x["steps"], "cfg": x["cfg"], "sampler_name": x["sampler_name"], "scheduler": x["scheduler"],
+                                         "positive": x["positive"], "negative": x["negative"], "latent": x["latent_image"], "denoise": x.get("denoise", 1.0),
+                                         "disable_noise": x["add_noise"] == "disable", "start_step": x["start_at_step"], "last_step": x["end_at_step"],
+                                         "force_full_denoise": x["return_with_leftover_noise"] != "enable"} for x in items])
+
 class SaveImage:
     def __init__(self):
         self.output_dir = folder_paths.get_output_directory()
@@ -1394,6 +1491,7 @@ class SaveImage:
 
     RETURN_TYPES = ()
     FUNCTION = "save_images"
+    CPU_THREAD_SAFE = True
 
     OUTPUT_NODE = True
 
@@ -1401,29 +1499,33 @@ class SaveImage:
 
     def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
         filename_prefix += self.prefix_append
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        writer = comfy_execution.image_writer.writer
+        full_output_folder, filename, counter, subfolder, filename_prefix = writer.get_save_image_path(filename_prefix, self.output_dir, images.shape[2], images.shape[1], reserve=len(images))
         results = list()
-        for (batch_number, image) in enumerate(images):
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            metadata = None
-            if not args.disable_metadata:
-                metadata = PngInfo()
-                if prompt is not None:
-                    metadata.add_text("prompt", json.dumps(prompt))
-                if extra_pnginfo is not None:
-                    for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-
-            filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
-            file = f"{filename_with_batch_num}_{counter:05}_.png"
-            img.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=self.compress_level)
-            results.append({
-                "filename": file,
-                "subfolder": subfolder,
-                "type": self.type
-            })
-            counter += 1
+        saved = 0
+        try:
+            for (batch_number, image) in enumerate(images):
+                metadata = None
+                if not args.disable_metadata:
+                    metadata = PngInfo()
+                    if prompt is not None:
+                        metadata.add_text("prompt", json.dumps(prompt))
+                    if extra_pnginfo is not None:
+                        for x in extra_pnginfo:
+                            metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+
+                filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
+                file = f"{filename_with_batch_num}_{counter:05}_.png"
+                saved += 1
+                writer.save_png(image, full_output_folder, filename, file, metadata, self.compress_level)
+                results.append({
+                    "filename": file,
+                    "subfolder": subfolder,
+                    "type": self.type
+                })
+                counter += 1
+        finally:
+            writer.release_counter((full_output_folder, filename), len(images) - saved)
 
         return { "ui": { "images": results } }
 
@@ -1441,6 +1543,17 @@ class PreviewImage(SaveImage):
                 "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
                 }
 
+    CPU_THREAD_SAFE = True
+
+class SaveImageStream(SaveImage):
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required":
+                    {"images": ("IMAGE_STREAM", ),
+                     "filename_prefix": ("STRING", {"default": "ComfyUI"})},
+                "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
+                }
+
 class LoadImage:
     @classmethod
     def INPUT_TYPES(s):
@@ -1454,6 +1567,7 @@ class LoadImage:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
+    CPU_THREAD_SAFE = True
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
         img = Image.open(image_path)
@@ -1513,6 +1627,7 @@ class LoadImageMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
+    CPU_THREAD_SAFE = True
     def load_image(self, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
         i = Image.open(image_path)
@@ -1721,6 +1836,7 @@ NODE_CLASS_MAPPINGS = {
     "CLIPTextEncode": CLIPTextEncode,
     "CLIPSetLastLayer": CLIPSetLastLayer,
     "VAEDecode": VAEDecode,
+    "VAEDecodeStream": VAEDecodeStream,
     "VAEEncode": VAEEncode,
     "VAEEncodeForInpaint": VAEEncodeForInpaint,
     "VAELoader": VAELoader,
@@ -1730,6 +1846,7 @@ NODE_CLASS_MAPPINGS = {
     "LatentFromBatch": LatentFromBatch,
     "RepeatLatentBatch": RepeatLatentBatch,
     "SaveImage": SaveImage,
+    "SaveImageStream": SaveImageStream,
     "PreviewImage": PreviewImage,
     "LoadImage": LoadImage,
     "LoadImageMask": LoadImageMask,
@@ -1816,6 +1933,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "VAEEncodeForInpaint": "VAE Encode (for Inpainting)",
     "SetLatentNoiseMask": "Set Latent Noise Mask",
     "VAEDecode": "VAE Decode",
+    "VAEDecodeStream": "VAE Decode (Streaming)",
     "VAEEncode": "VAE Encode",
     "LatentRotate": "Rotate Latent",
     "LatentFlip": "Flip Latent",
@@ -1829,6 +1947,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "RepeatLatentBatch": "Repeat Latent Batch",
     # Image
     "SaveImage": "Save Image",
+    "SaveImageStream": "Save Image (Streaming)",
     "PreviewImage": "Preview Image",
     "LoadImage": "Load Image",
     "LoadImageMask": "Load Image (as Mask)",
@@ -5,13 +5,15 @@ import traceback
 
 import nodes
 import folder_paths
+import latent_preview
 import execution
 import uuid
 import urllib
 import json
 import glob
 import struct
-from PIL import Image, ImageOps
+import threading
+from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
 
@@ -23,6 +25,11 @@ import mimetypes
 from comfy.cli_args import args
 import comfy.utils
 import comfy.model_management
+import comfy.text_encoder_cache
+import comfy.weight_cache
+import comfy.model_cache
+import comfy_execution.image_writer
+import comfy_execution.profiler
 
 from app.user_manager import UserManager
 
@@ -86,7 +93,9 @@ class PromptServer():
         routes = web.RouteTableDef()
         self.routes = routes
         self.last_node_id = None
+        self.last_prompt_id = None
         self.client_id = None
+        self.progress_targets = threading.local()
 
         self.on_prompt_handlers = []
 
@@ -271,6 +280,10 @@ class PromptServer():
                 filename = os.path.basename(filename)
                 file = os.path.join(output_dir, filename)
 
+                pending_write = comfy_execution.image_writer.writer.pending_file(file)
+                if pending_write is not None:
+                    await asyncio.wrap_future(pending_write)
+
                 if os.path.isfile(file):
                     if 'preview' in request.rel_url.query:
                         with Image.open(file) as img:
@@ -378,7 +391,10 @@ class PromptServer():
                         "torch_vram_total": torch_vram_total,
                         "torch_vram_free": torch_vram_free,
                     }
-                ]
+                ],
+                "text_encoder_cache": comfy.text_encoder_cache.cache.stats(),
+                "patched_weight_cache": comfy.weight_cache.cache.stats(),
+                "model_cache": comfy.model_cache.cache.stats(),
             }
             return web.json_response(system_stats)
 
@@ -437,6 +453,17 @@ class PromptServer():
             prompt_id = request.match_info.get("prompt_id", None)
             return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
 
+        @routes.get("/prompt/{prompt_id}/profile")
+        async def get_prompt_profile(request):
+            prompt_id = request.match_info.get("prompt_id", None)
+            history = self.prompt_queue.get_history(prompt_id=prompt_id)
+            if prompt_id not in history or "profile" not in history[prompt_id]:
+                return web.Response(status=404)
+            profile = history[prompt_id]["profile"]
+            if request.rel_url.query.get("format", None) == "chrome":
+                return web.json_response(comfy_execution.profiler.chrome_trace(profile))
+            return web.json_response(profile)
+
         @routes.get("/queue")
         async def get_queue(request):
             queue_info = {}
@@ -565,27 +592,7 @@ class PromptServer():
         return message
 
     async def send_image(self, image_data, sid=None):
-        image_type = image_data[0]
-        image = image_data[1]
-        max_size = image_data[2]
-        if max_size is not None:
-            if hasattr(Image, 'Resampling'):
-                resampling = Image.Resampling.BILINEAR
-            else:
-                resampling = Image.ANTIALIAS
-
-            image = ImageOps.contain(image, (max_size, max_size), resampling)
-        type_num = 1
-        if image_type == "JPEG":
-            type_num = 1
-        elif image_type == "PNG":
-            type_num = 2
-
-        bytesIO = BytesIO()
-        header = struct.pack(">I", type_num)
-        bytesIO.write(header)
-        image.save(bytesIO, format=image_type, quality=95, compress_level=1)
-        preview_bytes = bytesIO.getvalue()
+        preview_bytes = latent_preview.encode_preview_image(image_data)
         await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
 
     async def send_bytes(self, event, data, sid=None):
@@ -608,6 +615,14 @@ class PromptServer():
         elif sid in self.sockets:
             await send_socket_catch_exception(self.sockets[sid].send_json, message)
 
+    def set_progress_target(self, node_id, targets):
+        #the node running on the calling thread and the (prompt_id, client_id) its progress and previews are sent to,
+        #nodes running on the worker pool report next to the one running on the prompt thread
+        self.progress_targets.current = (node_id, targets)
+
+    def get_progress_target(self):
+        return getattr(self.progress_targets, "current", (self.last_node_id, [(self.last_prompt_id, self.client_id)]))
+
     def send_sync(self, event, data, sid=None):
         if self.loop:
             self.loop.call_soon_threadsafe(
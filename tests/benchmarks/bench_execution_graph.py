@@ -0,0 +1,77 @@
+"""
+Execution order benchmark: ExecutionGraph.execution_order and topological_sort against the recursive ordering the
+executor used before (re-walking the inputs of every output after each one is executed), on synthetic prompts.
+The recursive version counted shared inputs once per path when ranking the outputs so with several outputs the two
+can run them in a different order, the set of nodes executed is the same.
+
+    python tests/benchmarks/bench_execution_graph.py --nodes 1000 5000 10000 --outputs 1 100
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from comfy_execution.graph import ExecutionGraph
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--nodes", type=int, nargs="+", default=[1000, 5000, 10000])
+parser.add_argument("--outputs", type=int, nargs="+", default=[1, 100])
+parser.add_argument("--depth", type=int, default=20, help="every depth nodes one links further back than the previous node")
+bench_args = parser.parse_args()
+
+def synthetic_prompt(nodes, outputs, depth, sources=10):
+    rng = random.Random(0)
+    prompt = {}
+    for i in range(nodes):
+        if i < sources:
+            prompt[str(i)] = {"class_type": "Source", "inputs": {"seed": i}}
+        else:
+            a = i - 1 if i % depth else rng.randint(max(0, i - depth), i - 1)
+            prompt[str(i)] = {"class_type": "Op", "inputs": {"a": [str(a), 0], "b": [str(rng.randint(0, sources - 1)), 0]}}
+    for j in range(outputs):
+        prompt["out{}".format(j)] = {"class_type": "Output", "inputs": {"images": [str(nodes - 1 - j), 0]}}
+    return prompt
+
+def recursive_will_execute(prompt, outputs, unique_id, memo):
+    if unique_id in memo:
+        return memo[unique_id]
+    if unique_id in outputs:
+        return []
+    will_execute = []
+    for input_data in prompt[unique_id]["inputs"].values():
+        if isinstance(input_data, list) and input_data[0] not in outputs:
+            will_execute += recursive_will_execute(prompt, outputs, input_data[0], memo)
+    memo[unique_id] = will_execute + [unique_id]
+    return memo[unique_id]
+
+def recursive_order(prompt, execute_outputs):
+    executed = {}
+    order = []
+    to_execute = list(execute_outputs)
+    while len(to_execute) > 0:
+        memo = {}
+        to_execute = sorted(to_execute, key=lambda x: (len(recursive_will_execute(prompt, executed, x, memo)), x))
+        for unique_id in recursive_will_execute(prompt, executed, to_execute.pop(0), {}):
+            if unique_id not in executed:
+                executed[unique_id] = True
+                order.append(unique_id)
+    return order
+
+def timed(f):
+    t = time.perf_counter()
+    out = f()
+    return out, (time.perf_counter() - t) * 1000
+
+sys.setrecursionlimit(max(sys.getrecursionlimit(), max(bench_args.nodes) * 4)) #only the recursive version needs it
+for nodes in bench_args.nodes:
+    for outputs in bench_args.outputs:
+        prompt = synthetic_prompt(nodes, outputs, bench_args.depth)
+        execute_outputs = ["out{}".format(j) for j in range(outputs)]
+        old, t_old = timed(lambda: recursive_order(prompt, execute_outputs))
+        graph, t_build = timed(lambda: ExecutionGraph(prompt))
+        new, t_new = timed(lambda: graph.execution_order(execute_outputs, {}))
+        _, t_sort = timed(lambda: graph.topological_sort(list(prompt)))
+        print("nodes={} outputs={}: recursive {:.1f}ms, graph build {:.1f}ms + execution_order {:.1f}ms, topological_sort {:.1f}ms, same nodes: {}, same order: {}".format(nodes, outputs, t_old, t_build, t_new, t_sort, sorted(old) == sorted(new), old == new))
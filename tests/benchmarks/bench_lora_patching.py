@@ -0,0 +1,65 @@
+"""
+LoRA weight patching benchmark: ModelPatcher.patch_weights_to_device (plain loras of the same shape batched into one
+baddbmm) against the per key patch_weight_to_device loop, on SD1.5 sized attention projections.
+
+    python tests/benchmarks/bench_lora_patching.py --loras 3 --rank 32
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--loras", type=int, default=3)
+parser.add_argument("--rank", type=int, default=32)
+parser.add_argument("--runs", type=int, default=3)
+parser.add_argument("--cpu", action="store_true")
+bench_args = parser.parse_args()
+
+sys.argv = [sys.argv[0]] + (["--cpu"] if bench_args.cpu else [])
+import comfy.options
+comfy.options.enable_args_parsing()
+
+import torch
+import comfy.model_patcher
+import comfy.model_management
+
+device = comfy.model_management.get_torch_device()
+torch.manual_seed(0)
+shapes = [320] * 160 + [640] * 160 + [1280] * 120
+model = torch.nn.ModuleList([torch.nn.Linear(d, d, bias=False) for d in shapes]).half()
+for p in model.parameters():
+    p.requires_grad_(False)
+
+patcher = comfy.model_patcher.ModelPatcher(model, device, torch.device("cpu"))
+for s in range(bench_args.loras):
+    g = torch.Generator().manual_seed(s)
+    patcher.add_patches({"{}.weight".format(i): ("lora", (torch.randn(d, bench_args.rank, generator=g).half() * 0.1, torch.randn(bench_args.rank, d, generator=g).half() * 0.1, 16.0, None, None)) for i, d in enumerate(shapes)}, 0.7)
+keys = list(patcher.patches.keys())
+
+def per_key():
+    for k in keys:
+        patcher.patch_weight_to_device(k, device)
+
+def batched():
+    patcher.patch_weights_to_device(keys, device)
+
+results = {}
+times = {}
+for _ in range(bench_args.runs):
+    for name, f in [("per key", per_key), ("batched", batched)]:
+        comfy.model_management.soft_empty_cache()
+        t = time.perf_counter()
+        f()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times.setdefault(name, []).append(time.perf_counter() - t)
+        results[name] = [model[i].weight.float().cpu() for i in (0, 200, 400)]
+        patcher.unpatch_model()
+
+print("{} weights, {} loras of rank {} on {}".format(len(keys), bench_args.loras, bench_args.rank, device))
+for name, t in times.items():
+    print("{}: best {:.3f}s".format(name, min(t)))
+print("max abs difference: {:.2e}".format(max((a - b).abs().max().item() for a, b in zip(results["per key"], results["batched"]))))
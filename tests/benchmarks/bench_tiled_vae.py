@@ -0,0 +1,65 @@
+"""
+Tiled VAE decode benchmark: the old decode_tiled_ (average of three tiled_scale passes with different tile shapes)
+against the current single pass batched one, on an SD1.x AutoencoderKL with random weights.
+
+    python tests/benchmarks/bench_tiled_vae.py --size 64 --tile 32 --overlap 8
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--size", type=int, default=64, help="latent height and width")
+parser.add_argument("--tile", type=int, default=32)
+parser.add_argument("--overlap", type=int, default=8)
+parser.add_argument("--cpu", action="store_true")
+bench_args = parser.parse_args()
+
+sys.argv = [sys.argv[0]] + (["--cpu"] if bench_args.cpu else [])
+import comfy.options
+comfy.options.enable_args_parsing()
+
+import torch
+import comfy.sd
+import comfy.model_management
+from comfy.ldm.models.autoencoder import AutoencoderKL
+from tests.unit.test_tiled_scale import reference_three_pass, psnr
+
+def random_vae():
+    ddconfig = {'double_z': True, 'z_channels': 4, 'resolution': 256, 'in_channels': 3, 'out_ch': 3, 'ch': 128, 'ch_mult': [1, 2, 4, 4], 'num_res_blocks': 2, 'attn_resolutions': [], 'dropout': 0.0}
+    torch.manual_seed(0)
+    sd = AutoencoderKL(ddconfig=ddconfig, embed_dim=4).state_dict()
+    for k, v in sd.items(): #comfy ops skip the weight init
+        if v.dim() > 1:
+            torch.nn.init.kaiming_uniform_(v, a=5 ** 0.5)
+        elif "norm" in k and k.endswith("weight"):
+            v.fill_(1)
+        else:
+            v.zero_()
+    return comfy.sd.VAE(sd=sd)
+
+def timed(f):
+    t = time.perf_counter()
+    out = f()
+    comfy.model_management.soft_empty_cache()
+    return out, time.perf_counter() - t
+
+vae = random_vae()
+comfy.model_management.load_model_gpu(vae.patcher)
+torch.manual_seed(1)
+samples = torch.randn(1, 4, bench_args.size, bench_args.size)
+tile, overlap = bench_args.tile, bench_args.overlap
+
+with torch.inference_mode():
+    decode_fn = lambda a: vae.first_stage_model.decode(a.to(vae.vae_dtype).to(vae.device)).float()
+    full, t_full = timed(lambda: vae.decode(samples).movedim(-1, 1))
+    old, t_old = timed(lambda: vae.process_output(reference_three_pass(samples, decode_fn, tile, tile, overlap, vae.upscale_ratio)))
+    new, t_new = timed(lambda: vae.decode_tiled_(samples, tile, tile, overlap))
+
+print("decode {}x{} latent, tiles {} overlap {} on {}".format(bench_args.size, bench_args.size, tile, overlap, vae.device))
+print("no tiles: {:.2f}s".format(t_full))
+print("old 3 pass tiled: {:.2f}s, PSNR vs no tiles {:.1f} dB".format(t_old, psnr(old, full)))
+print("single pass tiled: {:.2f}s, PSNR vs no tiles {:.1f} dB, vs old {:.1f} dB".format(t_new, psnr(new, full), psnr(new, old)))
@@ -0,0 +1,4 @@
+from comfy.cli_args import args
+
+#the unit tests run on the cpu, this has to be set before comfy.model_management is imported
+args.cpu = True
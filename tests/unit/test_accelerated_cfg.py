@@ -0,0 +1,72 @@
+import torch
+
+import comfy.samplers
+from comfy_extras.nodes_custom_sampler import Guider_AcceleratedCFG
+
+class ModelSampling:
+    def percent_to_sigma(self, percent):
+        return 14.6 * (1.0 - percent)
+
+class InnerModel:
+    model_sampling = ModelSampling()
+
+class Patcher:
+    model_options = {}
+
+def guider(monkeypatch, uncond_interval=1, skip_uncond_percent=1.0, post_cfg=None):
+    evaluated = []
+    def calc_cond_batch(model, conds, x, timestep, model_options):
+        evaluated.append(conds[1] is not None)
+        cond_pred = x * 2.0 + timestep.reshape(-1, 1, 1, 1)
+        uncond_pred = x + timestep.reshape(-1, 1, 1, 1) * 0.5 if conds[1] is not None else torch.zeros_like(x)
+        return [cond_pred, uncond_pred]
+    monkeypatch.setattr(comfy.samplers, "calc_cond_batch", calc_cond_batch)
+
+    g = Guider_AcceleratedCFG(Patcher())
+    g.inner_model = InnerModel()
+    g.conds = {"positive": [{}], "negative": [{}]}
+    g.set_cfg(5.0)
+    g.set_schedule(uncond_interval, skip_uncond_percent)
+    g.calls = 0
+    g.uncond_saved = 0
+    g.guidance_delta = None
+    g.set_sigmas(torch.linspace(14.6, 0.0, 11))
+    model_options = {}
+    if post_cfg is not None:
+        model_options["sampler_post_cfg_function"] = [post_cfg]
+    return g, evaluated, model_options
+
+def test_negative_reused_between_intervals(monkeypatch):
+    g, evaluated, model_options = guider(monkeypatch, uncond_interval=2)
+    x = torch.ones(1, 4, 2, 2)
+    for step in range(4):
+        g.step = step
+        out = g.predict_noise(x, torch.tensor([10.0 - step]), model_options)
+    assert evaluated == [True, False, True, False]
+    assert g.uncond_saved == 2
+    #reused delta is x + t/2 from step 2 (t=8), the positive is fresh (t=7): uncond = 2x + 7 - (x + 4)
+    uncond = x * 2.0 + 7.0 - (x + 4.0)
+    assert torch.allclose(out, uncond + (x * 2.0 + 7.0 - uncond) * 5.0)
+
+def test_negative_dropped_from_host_schedule(monkeypatch):
+    g, evaluated, model_options = guider(monkeypatch, skip_uncond_percent=0.45)
+    assert g.skip_uncond_step == 5
+    x = torch.ones(1, 4, 2, 2)
+    for step in range(10):
+        g.step = step
+        g.predict_noise(x, torch.tensor([1.0]), model_options)
+    assert evaluated == [True] * 5 + [False] * 5
+
+def test_post_cfg_only_on_evaluated_negative(monkeypatch):
+    seen = []
+    def post_cfg(args):
+        seen.append(args["uncond_denoised"].clone())
+        return args["denoised"]
+    g, evaluated, model_options = guider(monkeypatch, uncond_interval=3, post_cfg=post_cfg)
+    x = torch.ones(1, 4, 2, 2)
+    for step in range(6):
+        g.step = step
+        g.predict_noise(x, torch.tensor([1.0]), model_options)
+    assert evaluated == [True, False, False, True, False, False]
+    assert len(seen) == 2
+    assert model_options["sampler_post_cfg_function"] == [post_cfg]
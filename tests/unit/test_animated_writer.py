@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+from PIL.PngImagePlugin import PngInfo
+
+from comfy_execution.animated_writer import APNGWriter, WEBPWriter
+
+def frames(count, channels=3):
+    rng = np.random.default_rng(0)
+    return [Image.fromarray((rng.random((24, 40, channels)) * 255).astype(np.uint8)) for _ in range(count)]
+
+def read_frames(path):
+    image = Image.open(path)
+    out = []
+    for frame in ImageSequence.Iterator(image):
+        out.append((np.array(frame.convert(image.mode)), frame.info.get("duration", None)))
+    return image, out
+
+def test_apng_round_trip(tmp_path):
+    path = str(tmp_path / "a.png")
+    metadata = PngInfo()
+    metadata.add_text("before", "idat")
+    metadata.add(b"comf", b"prompt\0{}", after_idat=True)
+    writer = APNGWriter(path, fps=8, compress_level=1, metadata=metadata)
+    expected = frames(5)
+    for f in expected:
+        writer.add(f)
+    writer.close()
+
+    image, out = read_frames(path)
+    assert image.n_frames == 5
+    assert image.info["before"] == "idat"
+    for (array, duration), f in zip(out, expected):
+        assert np.array_equal(array, np.array(f))
+        assert duration == 125
+
+@pytest.mark.parametrize("channels", [3, 4])
+def test_lossless_webp_round_trip(tmp_path, channels):
+    path = str(tmp_path / "a.webp")
+    exif = Image.Exif()
+    exif[0x0110] = "prompt:{}"
+    writer = WEBPWriter(path, fps=4, lossless=True, exif=exif.tobytes())
+    expected = frames(4, channels)
+    for f in expected:
+        writer.add(f)
+    writer.close()
+
+    image, out = read_frames(path)
+    assert image.n_frames == 4
+    assert image.getexif()[0x0110] == "prompt:{}"
+    for (array, duration), f in zip(out, expected):
+        f = np.array(f)
+        if channels == 4: #the color of fully transparent pixels isn't kept
+            visible = f[:, :, 3] > 0
+            array, f = array[visible], f[visible]
+        assert np.array_equal(array, f)
+        assert duration == 250
+
+def test_lossy_webp(tmp_path):
+    path = str(tmp_path / "a.webp")
+    writer = WEBPWriter(path, fps=4, lossless=False, quality=90)
+    for f in frames(3):
+        writer.add(f)
+    writer.close()
+    image, out = read_frames(path)
+    assert image.n_frames == 3
+    assert all(a.shape == (24, 40, 3) for a, _ in out)
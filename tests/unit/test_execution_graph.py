@@ -0,0 +1,125 @@
+import sys
+import random
+
+import pytest
+
+from comfy_execution.graph import ExecutionGraph, DependencyCycleError
+
+def node(class_type, *links, **widgets):
+    inputs = dict(widgets)
+    for i, link in enumerate(links):
+        inputs["input_{}".format(i)] = [link, 0]
+    return {"class_type": class_type, "inputs": inputs}
+
+def random_graph(seed, nodes=60, sources=5, outputs=6):
+    rng = random.Random(seed)
+    prompt = {}
+    for i in range(nodes):
+        if i < sources:
+            prompt[str(i)] = node("Source", seed=i)
+        else:
+            links = rng.sample(range(i), min(i, rng.randint(1, 3)))
+            prompt[str(i)] = node("Op", *[str(l) for l in links])
+    for j in range(outputs):
+        prompt["out{}".format(j)] = node("Output", str(rng.randint(sources, nodes - 1)))
+    return prompt
+
+def reference_order(prompt, execute_outputs, outputs):
+    #recursive version of the order: the outputs that need the least unexecuted nodes first, the nodes of each one
+    #depth first following the inputs in order
+    def needed(unique_id, executed):
+        if unique_id in executed:
+            return []
+        executed.add(unique_id)
+        order = []
+        for input_data in prompt[unique_id]["inputs"].values():
+            if isinstance(input_data, list):
+                order += needed(input_data[0], executed)
+        return order + [unique_id]
+
+    ranked = sorted(execute_outputs, key=lambda x: (len(needed(x, set(outputs))), x))
+    executed = set(outputs)
+    order = []
+    for output_unique_id in ranked:
+        order += needed(output_unique_id, executed)
+    return order
+
+def assert_dependencies_first(prompt, order):
+    position = {unique_id: i for i, unique_id in enumerate(order)}
+    for unique_id in order:
+        for input_data in prompt[unique_id]["inputs"].values():
+            if isinstance(input_data, list) and input_data[0] in position:
+                assert position[input_data[0]] < position[unique_id]
+
+def test_diamond():
+    prompt = {
+        "1": node("Source"),
+        "2": node("Op", "1"),
+        "3": node("Op", "1"),
+        "4": node("Op", "2", "3"),
+        "5": node("Output", "4"),
+    }
+    assert ExecutionGraph(prompt).execution_order(["5"], {}) == ["1", "2", "3", "4", "5"]
+
+def test_smallest_output_first():
+    prompt = {
+        "1": node("Source"),
+        "2": node("Op", "1"),
+        "3": node("Op", "2"),
+        "big": node("Output", "3"),
+        "small": node("Output", "1"),
+    }
+    assert ExecutionGraph(prompt).execution_order(["big", "small"], {}) == ["1", "small", "2", "3", "big"]
+
+def test_executed_nodes_skipped():
+    prompt = {
+        "1": node("Source"),
+        "2": node("Op", "1"),
+        "3": node("Output", "2"),
+    }
+    assert ExecutionGraph(prompt).execution_order(["3"], {"1": [[None]]}) == ["2", "3"]
+    assert ExecutionGraph(prompt).execution_order(["3"], {"3": [[None]]}) == []
+
+@pytest.mark.parametrize("seed", range(20))
+def test_same_order_as_recursive_reference(seed):
+    prompt = random_graph(seed)
+    execute_outputs = [x for x in prompt if x.startswith("out")]
+    outputs = {str(i): [[None]] for i in random.Random(seed).sample(range(60), 5)}
+    order = ExecutionGraph(prompt).execution_order(execute_outputs, outputs)
+    assert order == reference_order(prompt, execute_outputs, outputs)
+    assert_dependencies_first(prompt, order)
+
+def test_topological_sort():
+    prompt = random_graph(0)
+    graph = ExecutionGraph(prompt)
+    order = graph.topological_sort(list(prompt))
+    assert sorted(order) == sorted(prompt)
+    assert_dependencies_first(prompt, order)
+
+def test_cycle_rejected():
+    prompt = {
+        "1": node("Source"),
+        "2": node("Op", "1", "4"),
+        "3": node("Op", "2"),
+        "4": node("Op", "3"),
+        "5": node("Output", "4"),
+    }
+    with pytest.raises(DependencyCycleError) as e:
+        ExecutionGraph(prompt).execution_order(["5"], {})
+    assert "2, 3, 4" in str(e.value)
+
+def test_self_loop_rejected():
+    prompt = {"1": node("Op", "1"), "2": node("Output", "1")}
+    with pytest.raises(DependencyCycleError):
+        ExecutionGraph(prompt).execution_order(["2"], {})
+
+def test_chain_deeper_than_recursion_limit():
+    length = sys.getrecursionlimit() * 3
+    prompt = {"0": node("Source")}
+    for i in range(1, length):
+        prompt[str(i)] = node("Op", str(i - 1))
+    prompt["out"] = node("Output", str(length - 1))
+    graph = ExecutionGraph(prompt)
+    order = graph.execution_order(["out"], {})
+    assert order == [str(i) for i in range(length)] + ["out"]
+    assert graph.topological_sort(list(prompt)) == order
@@ -0,0 +1,81 @@
+import pytest
+import torch
+
+import comfy.model_patcher
+import comfy.weight_cache
+
+def lora(out_features, in_features, rank, seed, alpha=None, conv=False):
+    g = torch.Generator().manual_seed(seed)
+    if conv:
+        up = torch.randn(out_features, rank, 1, 1, generator=g) * 0.1
+        down = torch.randn(rank, in_features, 3, 3, generator=g) * 0.1
+    else:
+        up = torch.randn(out_features, rank, generator=g) * 0.1
+        down = torch.randn(rank, in_features, generator=g) * 0.1
+    return ("lora", (up, down, alpha, None, None))
+
+class Model(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.linears = torch.nn.ModuleList([torch.nn.Linear(32, 32) for _ in range(6)] + [torch.nn.Linear(48, 16)])
+        self.conv = torch.nn.Conv2d(8, 16, 3)
+        for p in self.parameters():
+            p.requires_grad_(False)
+
+def patched(patches_list, patch):
+    patcher = comfy.model_patcher.ModelPatcher(Model(), torch.device("cpu"), torch.device("cpu"))
+    for patches, strength in patches_list:
+        patcher.add_patches(patches, strength)
+    keys = list(patcher.patches.keys())
+    patch(patcher, keys)
+    return patcher.model.state_dict(), patcher
+
+def per_key(patcher, keys):
+    for key in keys:
+        patcher.patch_weight_to_device(key)
+
+def batched(patcher, keys):
+    patcher.patch_weights_to_device(keys, max_batch_size=32 * 32 * 4 * 4) #4 weights per baddbmm
+
+def patches_list():
+    first = {"linears.{}.weight".format(i): lora(32, 32, 4, i, alpha=2.0) for i in range(6)}
+    first["linears.6.weight"] = lora(16, 48, 8, 10)
+    first["conv.weight"] = lora(16, 8, 4, 11, conv=True)
+    second = {"linears.{}.weight".format(i): lora(32, 32, 4, 20 + i) for i in range(0, 6, 2)}
+    second["linears.1.bias"] = ("diff", (torch.full((32,), 0.5),)) #not a lora, falls back to calculate_weight
+    second["linears.3.weight"] = ("diff", (torch.full((32, 32), 0.1),))
+    return [(first, 0.8), (second, -0.5)]
+
+@pytest.fixture(autouse=True)
+def no_weight_cache(monkeypatch):
+    monkeypatch.setattr(comfy.weight_cache, "cache", comfy.weight_cache.PatchedWeightCache(0))
+
+def test_batched_same_as_calculate_weight():
+    expected, _ = patched(patches_list(), per_key)
+    out, _ = patched(patches_list(), batched)
+    assert out.keys() == expected.keys()
+    for k in expected:
+        assert torch.allclose(out[k], expected[k], atol=1e-6), k
+
+def test_unpatch_restores_weights():
+    original = Model().state_dict()
+    _, patcher = patched(patches_list(), batched)
+    patcher.unpatch_model()
+    for k, v in patcher.model.state_dict().items():
+        assert torch.equal(v, original[k]), k
+
+def test_cache_looked_up_once_per_key(monkeypatch):
+    cache = comfy.weight_cache.PatchedWeightCache(1024 ** 3)
+    monkeypatch.setattr(comfy.weight_cache, "cache", cache)
+    _, patcher = patched(patches_list(), batched)
+    keys = len(patcher.patches)
+    assert cache.stats()["misses"] == keys
+    assert cache.stats()["entries"] == keys
+
+    expected = patcher.model.state_dict()
+    patcher.unpatch_model()
+    patcher.patch_weights_to_device(list(patcher.patches.keys()))
+    assert cache.stats()["hits"] == keys
+    for k, v in patcher.model.state_dict().items():
+        assert torch.equal(v, expected[k]), k
@@ -0,0 +1,98 @@
+import math
+
+import pytest
+import torch
+
+import comfy.utils
+
+"""
+CPU tests of comfy.utils.tiled_scale against the implementation it replaced (per tile feather loop, tiled VAE
+decode as the average of three passes with different tile shapes).
+"""
+
+def reference_tiled_scale(samples, function, tile_x=64, tile_y=64, overlap=8, upscale_amount=4, out_channels=3):
+    output = torch.empty((samples.shape[0], out_channels, round(samples.shape[2] * upscale_amount), round(samples.shape[3] * upscale_amount)))
+    for b in range(samples.shape[0]):
+        s = samples[b:b+1]
+        out = torch.zeros((s.shape[0], out_channels, round(s.shape[2] * upscale_amount), round(s.shape[3] * upscale_amount)))
+        out_div = torch.zeros_like(out)
+        for y in range(0, s.shape[2], tile_y - overlap):
+            for x in range(0, s.shape[3], tile_x - overlap):
+                x = max(0, min(s.shape[-1] - overlap, x))
+                y = max(0, min(s.shape[-2] - overlap, y))
+                ps = function(s[:,:,y:y+tile_y,x:x+tile_x])
+                mask = torch.ones_like(ps)
+                feather = round(overlap * upscale_amount)
+                for t in range(feather):
+                    mask[:,:,t:1+t,:] *= ((1.0/feather) * (t + 1))
+                    mask[:,:,mask.shape[2] -1 -t: mask.shape[2]-t,:] *= ((1.0/feather) * (t + 1))
+                    mask[:,:,:,t:1+t] *= ((1.0/feather) * (t + 1))
+                    mask[:,:,:,mask.shape[3]- 1 - t: mask.shape[3]- t] *= ((1.0/feather) * (t + 1))
+                out[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += ps * mask
+                out_div[:,:,round(y*upscale_amount):round((y+tile_y)*upscale_amount),round(x*upscale_amount):round((x+tile_x)*upscale_amount)] += mask
+        output[b:b+1] = out/out_div
+    return output
+
+def reference_three_pass(samples, function, tile_x, tile_y, overlap, upscale_amount):
+    #what VAE.decode_tiled_ used to return
+    return (reference_tiled_scale(samples, function, tile_x // 2, tile_y * 2, overlap, upscale_amount) +
+            reference_tiled_scale(samples, function, tile_x * 2, tile_y // 2, overlap, upscale_amount) +
+            reference_tiled_scale(samples, function, tile_x, tile_y, overlap, upscale_amount)) / 3.0
+
+def psnr(a, b):
+    return 10 * math.log10(1.0 / ((a - b) ** 2).mean().item())
+
+class ToyDecoder(torch.nn.Module):
+    #a small convolutional "decoder" with a receptive field of several latent pixels so tile borders matter
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.convs = torch.nn.Sequential(torch.nn.Conv2d(4, 16, 3, padding=1), torch.nn.SiLU(), torch.nn.Conv2d(16, 16, 3, padding=1), torch.nn.SiLU(), torch.nn.Conv2d(16, 3, 3, padding=1))
+
+    @torch.inference_mode()
+    def forward(self, z):
+        out = torch.nn.functional.interpolate(self.convs(z), scale_factor=8, mode="bilinear")
+        return torch.clamp((torch.tanh(out) + 1.0) / 2.0, 0.0, 1.0)
+
+@pytest.mark.parametrize("shape,tile_x,tile_y,overlap", [((1, 4, 64, 64), 64, 64, 16), ((2, 4, 70, 93), 32, 48, 8), ((1, 4, 128, 96), 32, 128, 16)])
+@pytest.mark.parametrize("max_batch", [1, 4])
+def test_same_as_reference_with_same_tiles(shape, tile_x, tile_y, overlap, max_batch):
+    torch.manual_seed(1)
+    samples = torch.randn(shape)
+    function = ToyDecoder()
+    expected = reference_tiled_scale(samples, function, tile_x, tile_y, overlap, upscale_amount=8)
+    out = comfy.utils.tiled_scale(samples, function, tile_x, tile_y, overlap, upscale_amount=8, max_batch=max_batch)
+    assert torch.allclose(out, expected, atol=1e-5)
+
+def test_downscale_same_as_reference():
+    torch.manual_seed(2)
+    pixels = torch.rand(1, 3, 520, 776)
+    function = lambda a: torch.nn.functional.avg_pool2d(a, 8)
+    expected = reference_tiled_scale(pixels, function, 128, 256, 64, upscale_amount=1/8, out_channels=3)
+    out = comfy.utils.tiled_scale(pixels, function, 128, 256, 64, upscale_amount=1/8, out_channels=3, max_batch=3)
+    assert torch.allclose(out, expected, atol=1e-5)
+
+@pytest.mark.parametrize("height,width,feather", [(64, 64, 16), (24, 40, 16), (8, 8, 0), (512, 256, 128)])
+def test_feather_window_matches_loop_mask(height, width, feather):
+    mask = torch.ones(height, width)
+    for t in range(feather):
+        mask[t:1+t,:] *= ((1.0/feather) * (t + 1))
+        mask[mask.shape[0] -1 -t: mask.shape[0]-t,:] *= ((1.0/feather) * (t + 1))
+        mask[:,t:1+t] *= ((1.0/feather) * (t + 1))
+        mask[:,mask.shape[1]- 1 - t: mask.shape[1]- t] *= ((1.0/feather) * (t + 1))
+    assert torch.allclose(comfy.utils.feather_window(height, width, feather, "cpu"), mask, atol=1e-6)
+
+#tolerance of the single pass tiled decode against the old 3 pass output, both compared to a decode without tiles:
+#the single pass can't average out the tile seams so it may be slightly further from the full decode
+MIN_PSNR_VS_THREE_PASS = 35.0
+MAX_PSNR_DROP_VS_FULL = 3.0
+
+def test_single_pass_close_to_three_pass():
+    torch.manual_seed(3)
+    samples = torch.randn(1, 4, 96, 96)
+    function = ToyDecoder()
+    full = function(samples)
+    three_pass = reference_three_pass(samples, function, 32, 32, 8, 8)
+    single_pass = comfy.utils.tiled_scale(samples, function, 32, 32, 8, upscale_amount=8, max_batch=4)
+    assert psnr(single_pass, three_pass) >= MIN_PSNR_VS_THREE_PASS
+    assert psnr(single_pass, full) >= psnr(three_pass, full) - MAX_PSNR_DROP_VS_FULL
@@ -0,0 +1,59 @@
+import torch
+
+import comfy.model_patcher
+import comfy.weight_cache
+
+def lora_patches(seed, keys):
+    g = torch.Generator().manual_seed(seed)
+    return {k: ("lora", (torch.randn(8, 2, generator=g), torch.randn(2, 8, generator=g), 1.0, None, None)) for k in keys}
+
+def patcher():
+    model = torch.nn.Sequential(torch.nn.Linear(8, 8), torch.nn.Linear(8, 8))
+    return comfy.model_patcher.ModelPatcher(model, torch.device("cpu"), torch.device("cpu"))
+
+def cache_keys(p):
+    return {k: comfy.weight_cache.cache.key(p, k) for k in p.patches}
+
+def test_source_keys_without_hashing_content(monkeypatch):
+    hashed = []
+    original = comfy.weight_cache.hash_value
+    def hash_value(m, value):
+        if isinstance(value, torch.Tensor):
+            hashed.append(value)
+        original(m, value)
+    monkeypatch.setattr(comfy.weight_cache, "hash_value", hash_value)
+
+    base = patcher()
+    patches = lora_patches(0, ["0.weight", "1.weight"])
+    comfy.weight_cache.set_patches_source(patches, "lora_file")
+    a = base.clone()
+    a.add_patches(patches, 0.5)
+    b = base.clone()
+    b.add_patches(patches, 0.5)
+    c = base.clone()
+    c.add_patches(patches, 0.75)
+    assert cache_keys(a) == cache_keys(b)
+    assert cache_keys(a)["0.weight"] != cache_keys(c)["0.weight"]
+    assert len(hashed) == 0
+
+def test_anonymous_tensors_hashed_by_content():
+    base = patcher()
+    a = base.clone()
+    a.add_patches(lora_patches(0, ["0.weight"]), 1.0)
+    b = base.clone()
+    b.add_patches(lora_patches(0, ["0.weight"]), 1.0)
+    c = base.clone()
+    c.add_patches(lora_patches(1, ["0.weight"]), 1.0)
+    assert cache_keys(a) == cache_keys(b)
+    assert cache_keys(a) != cache_keys(c)
+
+def test_merge_patches_keyed_by_model():
+    other = patcher()
+    base = patcher()
+    merged = base.clone()
+    merged.add_patches(other.get_key_patches(), 0.3, 0.7)
+    again = base.clone()
+    again.add_patches(other.get_key_patches(), 0.3, 0.7)
+    for k in merged.patches:
+        assert merged.patches[k][0][1][0].weight_cache_source == ("model", comfy.weight_cache.model_weights_id(other.model), k)
+    assert cache_keys(merged) == cache_keys(again)
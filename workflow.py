@@ -8,6 +8,7 @@ import nodes
 import random
 import zipfile
 import execution
+import comfy_execution.image_writer
 import subprocess
 import folder_paths
 import urllib.request
@@ -57,6 +58,7 @@ def run_workflow(workflow: Any, extra_models: list[dict] = []):
         e = execution.PromptExecutor()
 
         e.execute(workflow, prompt_id, {}, outputs_to_execute)
+        comfy_execution.image_writer.writer.flush()
 
         current_time = time.perf_counter()
         execution_time = current_time - execution_start_time